@@ -1,3 +1,5 @@
+import os
+
 import yaml
 
 with open("config.yaml", "r") as c:
@@ -5,6 +7,16 @@ with open("config.yaml", "r") as c:
 
 workers = conffile["workers"]
 threads = conffile["threads"]
-bind = f"{conffile['bind_hosts']}:{conffile['port']}"
+# gevent for many concurrent /stream/wrs clients, e.g. a second instance started
+# with KACKY_WORKER_CLASS=gevent that only gets /stream/ routed to it
+worker_class = os.environ.get(
+    "KACKY_WORKER_CLASS", conffile.get("worker_class", "gthread")
+)
+if worker_class == "gevent":
+    # the app is preloaded, its locks must be gevent ones before it is imported
+    from gevent import monkey
+
+    monkey.patch_all()
+bind = f"{conffile['bind_hosts']}:{os.environ.get('KACKY_PORT', conffile['port'])}"
 wsgi_app = "kacky_records_api.app:app"
 preload_app = True
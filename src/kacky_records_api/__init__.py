@@ -25,10 +25,6 @@ finally:
 with open(Path(__file__).parents[2] / "config.yaml", "r") as conffile:
     config = yaml.load(conffile, Loader=yaml.FullLoader)
 
-# Read flask secret (required for flask.flash and flask_login)
-with open(Path(__file__).parents[2] / "secrets.yaml", "r") as secfile:
-    secrets = yaml.load(secfile, Loader=yaml.FullLoader)
-
 if config["logtype"] == "STDOUT":
     pass
     logging.basicConfig(format="%(name)s - %(levelname)s - %(message)s")
@@ -60,6 +56,24 @@ logger = logging.getLogger(config["logger_name"])
 logger.setLevel(eval("logging." + config["loglevel"]))
 
 
+class MissingSecrets(dict):
+    """Stands in for secrets.yaml if it is missing, fails as soon as a secret is read"""
+
+    def __missing__(self, key):
+        raise RuntimeError(f"secrets.yaml not found, secret '{key}' is needed")
+
+
+# Read flask secret (required for flask.flash and flask_login)
+secrets_path = Path(__file__).parents[2] / "secrets.yaml"
+if secrets_path.exists():
+    with open(secrets_path, "r") as secfile:
+        secrets = yaml.load(secfile, Loader=yaml.FullLoader)
+else:
+    # e.g. unit tests, the package imports but nothing connects anywhere
+    logger.warning(f"{secrets_path} not found, every use of a secret will fail")
+    secrets = MissingSecrets()
+
+
 def key_required(func):
     @functools.wraps(func)
     def decorator(*args, **kwargs):
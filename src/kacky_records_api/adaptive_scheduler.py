@@ -0,0 +1,210 @@
+import datetime
+import re
+import time
+from typing import Dict, List, Optional, Tuple
+
+from kacky_records_api.db_operators.operators import DBConnection
+from kacky_records_api.map_catalog import MapCatalog
+
+MAP_STATE_TABLE_QUERY = """
+    CREATE TABLE IF NOT EXISTS updater_map_state (
+        tm_uid VARCHAR(64) NOT NULL PRIMARY KEY,
+        campaign_id INT NOT NULL,
+        edition INT NULL,
+        last_polled DATETIME NULL,
+        last_change DATETIME NULL
+    );
+"""
+
+_CAMPAIGN_EDITION_PATTERN = re.compile(r"KR\s*(\d+)", re.IGNORECASE)
+
+
+class MapState:
+    __slots__ = ("tm_uid", "campaign_id", "edition", "last_polled", "last_change")
+
+    def __init__(
+        self,
+        tm_uid: str,
+        campaign_id: int,
+        edition: Optional[int],
+        last_polled: float = 0.0,
+        last_change: Optional[float] = None,
+    ):
+        self.tm_uid = tm_uid
+        self.campaign_id = campaign_id
+        self.edition = edition
+        self.last_polled = last_polled
+        self.last_change = last_change
+
+
+def _to_timestamp(value: Optional[datetime.datetime]) -> Optional[float]:
+    return value.timestamp() if value else None
+
+
+def _to_datetime(value: Optional[float]) -> Optional[datetime.datetime]:
+    return datetime.datetime.fromtimestamp(value) if value else None
+
+
+class AdaptiveMapScheduler:
+    """
+    Decides which KR maps are polled from Nadeo on an update tick.
+
+    Every map gets a poll interval from its priority: maps of a live edition (see
+    `live_events` in the config) are hot, maps with a recent WR change are warm,
+    everything else is cold. On each tick the most overdue maps are polled, limited
+    by a global request budget refilled at `requests_per_minute`. Poll and change
+    times are persisted in `updater_map_state`, so a restart continues where the
+    last run stopped instead of starting over.
+    """
+
+    def __init__(self, config, secrets):
+        self._config = config
+        self._secrets = secrets
+        self._conf = config.get("adaptive_updates", {})
+        self._backend_db = DBConnection(config, secrets)
+        self._states: Dict[str, MapState] = {}
+        self._campaigns_synced_at = 0.0
+        self._budget = float(self._conf.get("requests_per_minute", 60))
+        self._budget_refilled_at = time.time()
+        self._loaded = False
+
+    def load_state(self):
+        self._backend_db.execute(MAP_STATE_TABLE_QUERY, ())
+        rows = self._backend_db.fetchall(
+            """
+            SELECT tm_uid, campaign_id, edition, last_polled, last_change
+            FROM updater_map_state;
+            """,
+            (),
+        )
+        self._states = {
+            r[0]: MapState(
+                r[0], r[1], r[2], _to_timestamp(r[3]) or 0.0, _to_timestamp(r[4])
+            )
+            for r in rows
+        }
+        self._loaded = True
+
+    def live_editions(self) -> List[int]:
+        return [
+            int(ev["edition"])
+            for ev in self._config.get("live_events", [])
+            if str(ev.get("type", "")).upper() == "KR"
+        ]
+
+    def campaigns_outdated(self) -> bool:
+        if not self._loaded:
+            self.load_state()
+        return (
+            not self._states
+            or time.time() - self._campaigns_synced_at
+            > self._conf.get("campaign_refresh_seconds", 3600)
+        )
+
+    def sync_campaigns(self, campaigns: List[Tuple[int, str, List[str]]]):
+        """
+        Updates the set of known maps from the club campaigns.
+
+        Parameters
+        ----------
+        campaigns : List[Tuple[int, str, List[str]]]
+            (campaign id, campaign name, map uids) of every campaign
+        """
+        catalog = MapCatalog(self._config, self._secrets)
+        states = {}
+        for campaign_id, name, uids in campaigns:
+            match = _CAMPAIGN_EDITION_PATTERN.search(name)
+            name_edition = int(match.group(1)) if match else None
+            for uid in uids:
+                entry = catalog.by_uid("KR", uid)
+                edition = entry.edition if entry and entry.edition else name_edition
+                state = self._states.get(uid) or MapState(uid, campaign_id, edition)
+                state.campaign_id, state.edition = campaign_id, edition
+                states[uid] = state
+        if any(s.last_change is None for s in states.values()):
+            self._init_last_change(states)
+        self._states = states
+        self._campaigns_synced_at = time.time()
+
+    def _init_last_change(self, states: Dict[str, MapState]):
+        # maps never polled before inherit the date of their current WR
+        rows = self._backend_db.fetchall(
+            """
+            SELECT maps.tm_uid, wr.date
+            FROM worldrecords AS wr
+            INNER JOIN maps ON wr.map_id = maps.id
+            WHERE maps.tm_uid IS NOT NULL;
+            """,
+            (),
+        )
+        for uid, date in rows:
+            if uid in states and states[uid].last_change is None:
+                states[uid].last_change = _to_timestamp(date)
+
+    def interval(self, state: MapState, now: float) -> float:
+        if state.edition in self.live_editions():
+            return self._conf.get("hot_interval", 10)
+        warm_window = self._conf.get("warm_window_hours", 48) * 3600
+        if state.last_change and now - state.last_change < warm_window:
+            return self._conf.get("warm_interval", 300)
+        return self._conf.get("cold_interval", 3600)
+
+    def spend(self, requests: int = 1):
+        # overspending (auth, players of new WRs) delays the next polls by at most a
+        # minute, however long Nadeo was busy
+        per_minute = self._conf.get("requests_per_minute", 60)
+        self._budget = max(self._budget - requests, -float(per_minute))
+
+    def _refill_budget(self, now: float):
+        per_minute = self._conf.get("requests_per_minute", 60)
+        self._budget = min(
+            float(per_minute),
+            self._budget + (now - self._budget_refilled_at) * per_minute / 60,
+        )
+        self._budget_refilled_at = now
+
+    def due_maps(self) -> List[MapState]:
+        """
+        Maps to poll on this tick, most overdue (relative to their interval)
+        first. Limited by the request budget, every poll is one request.
+        """
+        now = time.time()
+        self._refill_budget(now)
+        overdue = []
+        for state in self._states.values():
+            interval = self.interval(state, now)
+            lateness = (now - state.last_polled) / interval
+            if lateness >= 1:
+                overdue.append((lateness, state))
+        overdue.sort(key=lambda o: o[0], reverse=True)
+        return [state for _, state in overdue[: max(int(self._budget), 0)]]
+
+    def mark_polled(self, state: MapState, changed: bool):
+        now = time.time()
+        state.last_polled = now
+        if changed:
+            state.last_change = now
+
+    def persist(self, states: List[MapState]):
+        self._backend_db.executemany(
+            """
+            INSERT INTO updater_map_state
+                (tm_uid, campaign_id, edition, last_polled, last_change)
+            VALUES (?, ?, ?, ?, ?)
+            ON DUPLICATE KEY UPDATE
+                campaign_id = VALUES(campaign_id),
+                edition = VALUES(edition),
+                last_polled = VALUES(last_polled),
+                last_change = VALUES(last_change);
+            """,
+            [
+                (
+                    s.tm_uid,
+                    s.campaign_id,
+                    s.edition,
+                    _to_datetime(s.last_polled),
+                    _to_datetime(s.last_change),
+                )
+                for s in states
+            ],
+        )
@@ -2,9 +2,10 @@ import atexit
 import datetime
 import logging
 import os
-from typing import Any
+from typing import Any, Dict, List, Optional
 
 import flask
+import mariadb
 from apscheduler.schedulers.background import BackgroundScheduler
 from flask_cors import CORS
 
@@ -12,22 +13,50 @@ from flask_cors import CORS
 from tmformatresolver import TMString
 
 from kacky_records_api import config, key_required, logger, secrets
+from kacky_records_api.batch_requests import run_batch, validate_subrequest
+from kacky_records_api.data_versions import (
+    EVENTS_DOMAIN,
+    GLOBAL_DOMAIN,
+    DataVersions,
+    leaderboard_domain,
+    pbs_domain,
+    records_domain,
+    wrs_domain,
+)
 from kacky_records_api.db_operators.operators import DBConnection
+from kacky_records_api.event_bundle import EventBundles
+from kacky_records_api.export import (
+    EXPORT_FORMATS,
+    EXPORT_KINDS,
+    export_lines,
+    export_slots,
+)
+from kacky_records_api.map_catalog import MapCatalog, parse_map_name
+from kacky_records_api.negotiation import preferred_variant
+from kacky_records_api.pagination import MAX_PAGE_SIZE, decode_cursor, encode_cursor
 from kacky_records_api.record_aggregators.kackiest_kacky_db import (
     KackiestKacky_KackyRecords,
 )
 from kacky_records_api.record_aggregators.kacky_reloaded_db import (
     KackyReloaded_KackyRecords,
 )
-from kacky_records_api.update_records import (
-    restore_wr_after_reset,
-    update_wrs_kackiest_kacky,
-    update_wrs_kacky_reloaded,
-)
+from kacky_records_api.response_cache import cached_response, negotiate_response
+from kacky_records_api.single_flight import SingleFlightError
+from kacky_records_api.wr_history import WRHistory
+from kacky_records_api.wr_stream import WRBroadcaster, WROutbox, sse_stream
 
 app = flask.Flask(__name__)
 CORS(app)
 app.config["CORS_HEADERS"] = "Content-Type"
+# compression and encodings by Accept/Accept-Encoding for every JSON response
+app.after_request(negotiate_response)
+
+# responses invalidated by data version stamps can be kept much longer than those
+# read straight from the game server record databases
+VERSIONED_TTL = config.get("response_cache", {}).get("versioned_ttl", 600)
+RECORDS_TTL = config.get("response_cache", {}).get("records_ttl", 30)
+# WR and event lists change rarely, an hour old list is better than a timeout
+VERSIONED_MAX_STALE = config.get("response_cache", {}).get("versioned_max_stale", 3600)
 
 
 class UpdatedJSONProvider(flask.json.provider.DefaultJSONProvider):
@@ -37,12 +66,29 @@ class UpdatedJSONProvider(flask.json.provider.DefaultJSONProvider):
         return super().default(o)
 
 
+@app.errorhandler(SingleFlightError)
+def single_flight_overloaded(e):
+    logger.warning(f"Coalesced request rejected: {e}")
+    return "Server busy, try again", 503, {"Retry-After": "1"}
+
+
 def check_api_key(userkey):
     if userkey == secrets["djinn_api_key"]:
         return True
     return False
 
 
+# data version domains of routes, needed when the routes are decorated
+def map_leaderboard_domain(eventtype: str, kacky_id: str) -> str:
+    # map boards change with the records of their edition
+    entry = MapCatalog(config, secrets).lookup(
+        eventtype, str(int(kacky_id)), flask.request.args.get("version", "")
+    )
+    if not entry or entry.edition is None:
+        raise ValueError("Map not in catalog")
+    return leaderboard_domain(eventtype, entry.edition)
+
+
 @app.route("/")
 @key_required
 def root():
@@ -51,6 +97,7 @@ def root():
 
 @app.route("/wrs/<event>/<edition>")
 @key_required
+@cached_response(VERSIONED_TTL, wrs_domain, VERSIONED_MAX_STALE)
 def wrs_per_event(event, edition):
     # log_access(f"/wrs/{event}/{edition}")
     # check if parameters are valid (this also is input sanitation)
@@ -63,11 +110,27 @@ def wrs_per_event(event, edition):
     )[0]
     if not event_id:
         return "Error: parameters out of range", 404
+    if "as_of" in flask.request.args:
+        # board as it stood back then, from the WR history
+        try:
+            as_of = datetime.datetime.fromisoformat(flask.request.args["as_of"])
+        except ValueError:
+            return "Invalid as_of, expected ISO 8601 date", 400
+        return flask.jsonify(WRHistory(config, secrets).board_as_of(event_id, as_of))
+    if "since" in flask.request.args:
+        # delta sync, only maps whose WR changed after the client's version
+        try:
+            since = parse_since()
+        except ValueError:
+            return "Invalid since argument", 400
+        version = delta_version()
+        changed = WRHistory(config, secrets).changes_since(event_id, since, version)
+        return flask.jsonify({"version": version, "changed": changed}), 200
     query = """
     SELECT maps.name, maps.kacky_id, wr.score, wr.nickname, wr.login
     FROM worldrecords AS wr
     INNER JOIN maps ON wr.map_id = maps.id
-    WHERE maps.kacky_id = ?;
+    WHERE maps.kackyevent = ?;
     """
     wrs_for_event = backend_db.fetchall(query, (event_id,))
     wrs_for_event_dicts = [
@@ -77,8 +140,22 @@ def wrs_per_event(event, edition):
     return flask.jsonify(wrs_for_event_dicts), 200
 
 
+@app.route("/wrs/history/<eventtype>/<kacky_id>")
+@key_required
+@cached_response(VERSIONED_TTL, lambda eventtype, kacky_id: GLOBAL_DOMAIN)
+def get_map_wr_progression(eventtype: str, kacky_id: str):
+    # every WR held on the map, oldest first
+    try:
+        check_event_edition_legal(eventtype, "1")
+    except AssertionError:
+        return "Invalid event type", 400
+    progression = WRHistory(config, secrets).map_progression(eventtype, kacky_id)
+    return flask.jsonify(progression), 200
+
+
 @app.route("/events")
 @key_required
+@cached_response(VERSIONED_TTL, lambda: EVENTS_DOMAIN, VERSIONED_MAX_STALE)
 def get_all_events():
     # log_access("/events")
     # set up connection to backend database
@@ -95,6 +172,7 @@ def get_all_events():
 
 @app.route("/pb/<user>/<eventtype>", methods=["GET", "POST"])
 @key_required
+@cached_response(RECORDS_TTL, lambda user, eventtype: records_domain(eventtype))
 def get_user_pbs(user: str, eventtype: str):
     # log_access(f"/pb/{user}/{eventtype}")
     if (
@@ -105,31 +183,30 @@ def get_user_pbs(user: str, eventtype: str):
         # user holds API key
         logger.info("authenticated user")
     check_event_edition_legal(eventtype, "1")
+    try:
+        changed_since = since_datetime(eventtype)
+    except ValueError:
+        return "Invalid since argument", 400
+    # read before the records, a later version could skip records
+    version = delta_version() if "since" in flask.request.args else None
     if eventtype.upper() == "KK":
-        pbs = KackiestKacky_KackyRecords(secrets).get_user_pbs(user)
+        pbs = KackiestKacky_KackyRecords(secrets).get_user_pbs(user, changed_since)
     elif eventtype.upper() == "KR":
-        pbs = KackyReloaded_KackyRecords(secrets).get_user_pbs(user)
+        pbs = KackyReloaded_KackyRecords(secrets).get_user_pbs(
+            user, MapCatalog(config, secrets).lobby_map_ids("KR"), changed_since
+        )
     else:
         return "ERROR, invalid params"
-    return (
-        flask.jsonify(
-            {
-                TMString(x[0])
-                .string.split("#")[1]
-                .split(" ")[0]: {
-                    "score": x[1],
-                    "kacky_rank": x[3],
-                    "date": x[2].timestamp(),
-                }
-                for x in pbs
-            }
-        ),
-        200,
-    )
+    return pbs_response(pbs, version)
 
 
 @app.route("/pb/<user>/<eventtype>/<edition>")
 @key_required
+@cached_response(
+    RECORDS_TTL,
+    # kacky_rank depends on every record of the edition, not only the player's
+    lambda user, eventtype, edition: leaderboard_domain(eventtype, edition),
+)
 def get_user_pbs_edition(user: str, eventtype: str, edition: int):
     # log_access(f"/pb/{user}/{eventtype}/{edition}")
     if (
@@ -140,31 +217,73 @@ def get_user_pbs_edition(user: str, eventtype: str, edition: int):
         # user holds API key
         logger.info("authenticated user")
     check_event_edition_legal(eventtype, edition)
+    try:
+        changed_since = since_datetime(eventtype)
+    except ValueError:
+        return "Invalid since argument", 400
+    # read before the records, a later version could skip records
+    version = delta_version() if "since" in flask.request.args else None
     if eventtype.upper() == "KK":
-        pbs = KackiestKacky_KackyRecords(secrets).get_user_pbs_edition(user, edition)
+        pbs = KackiestKacky_KackyRecords(secrets).get_user_pbs_edition(
+            user, edition, changed_since
+        )
     elif eventtype.upper() == "KR":
-        pbs = KackyReloaded_KackyRecords(secrets).get_user_pbs_edition(user, edition)
+        pbs = KackyReloaded_KackyRecords(secrets).get_user_pbs_edition(
+            user,
+            edition,
+            MapCatalog(config, secrets).lobby_map_ids("KR"),
+            changed_since,
+        )
     else:
         return "ERROR, invalid params"
-    return (
-        flask.jsonify(
-            {
-                TMString(x[0])
-                .string.split("#")[1]
-                .split(" ")[0]: {
-                    "score": x[1],
-                    "kacky_rank": x[3],
-                    "date": x[2].timestamp(),
-                }
-                for x in pbs
-            }
-        ),
-        200,
-    )
+    return pbs_response(pbs, version)
+
+
+@app.route("/pb/batch", methods=["POST"])
+@key_required
+def get_users_pbs_batch():
+    # PBs of several players from one ranked query, for team pages and comparisons
+    body = flask.request.get_json(silent=True) or {}
+    users = body.get("users")
+    eventtype = body.get("eventtype", "")
+    edition = body.get("edition")
+    max_users = config.get("pb_batch_max_users", 20)
+    if (
+        not isinstance(users, list)
+        or not users
+        or not all(isinstance(u, str) for u in users)
+    ):
+        return "Expected a list of users", 400
+    if len(users) > max_users:
+        return f"At most {max_users} users per batch", 400
+    try:
+        check_event_edition_legal(eventtype, "1" if edition is None else str(edition))
+    except AssertionError:
+        return "Invalid event or edition", 400
+    # logins compare case-insensitively in the record databases, PBs are answered
+    # under the login as requested
+    requested = {}
+    for user in users:
+        requested.setdefault(user.lower(), user)
+    users = list(requested.values())
+    edition = None if edition is None else int(edition)
+    if eventtype.upper() == "KK":
+        pbs = KackiestKacky_KackyRecords(secrets).get_users_pbs(users, edition)
+    else:
+        pbs = KackyReloaded_KackyRecords(secrets).get_users_pbs(
+            users, edition, MapCatalog(config, secrets).lobby_map_ids("KR")
+        )
+    by_user = {user: [] for user in users}
+    for pb in pbs:
+        user = requested.get(pb[0].lower())
+        if user is not None:
+            by_user[user].append(pb[1:])
+    return flask.jsonify({user: format_pbs(p) for user, p in by_user.items()}), 200
 
 
 @app.route("/performance/<login>/<eventtype>")
 @key_required
+@cached_response(RECORDS_TTL, lambda login, eventtype: pbs_domain(eventtype, login))
 def get_user_fin_count(login: str, eventtype: str):
     # log_access(f"/performance/{login}/{eventtype}")
     check_event_edition_legal(eventtype, "1")
@@ -177,10 +296,75 @@ def get_user_fin_count(login: str, eventtype: str):
     return flask.jsonify(fins), 200
 
 
+@app.route("/event/<eventtype>/<edition>/bundle")
+@key_required
+def get_event_bundle(eventtype: str, edition: str):
+    # maps, WRs, clips and TMX ids of an edition, serialized once per data version
+    try:
+        check_event_edition_legal(eventtype, edition)
+    except AssertionError:
+        return "Invalid event or edition", 400
+    bundle = EventBundles(config, secrets).get(eventtype, int(edition))
+    if not bundle.maps:
+        return "Error: parameters out of range", 404
+    variant = preferred_variant(flask.request)
+    etag = variant.etag(bundle.etag)
+    if flask.request.if_none_match.contains(etag):
+        response = flask.Response(status=304)
+    else:
+        response = flask.Response(bundle.variants[variant], mimetype=variant.mimetype)
+        if variant.encoding:
+            response.headers["Content-Encoding"] = variant.encoding
+    # encoded at build time, nothing left for `negotiate_response`
+    flask.g.negotiated = True
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+    response.vary.update(("Accept", "Accept-Encoding"))
+    return response
+
+
 @app.route("/event/leaderboard/<eventtype>/<edition>")
 @key_required
+@cached_response(
+    RECORDS_TTL,
+    lambda eventtype, edition: leaderboard_domain(eventtype, edition),
+)
 def get_leaderboard(eventtype: str, edition: int):
     # log_access(f"/event/leaderboard/{eventtype}/{edition}")
+    if "cursor" in flask.request.args:
+        # keyset pagination, cost per page does not grow with depth
+        check_event_edition_legal(eventtype, edition)
+        elems = flask.request.args.get("elems", default=10, type=int)
+        if not 0 < elems <= MAX_PAGE_SIZE:
+            return "Invalid elems argument", 400
+        try:
+            after = decode_cursor(flask.request.args["cursor"], 5)
+        except ValueError:
+            return "Invalid cursor", 400
+        if eventtype.upper() != "KK":
+            return flask.jsonify({"entries": [], "next": None}), 200
+        html = flask.request.args.get("html", "True").lower() == "true"
+        page, next_key = KackiestKacky_KackyRecords(secrets).get_leaderboard_page(
+            edition, elems, after, html
+        )
+        return flask.jsonify(paginated_response(page, next_key, elems)), 200
+    if "since" in flask.request.args:
+        # delta sync, only players with records after the client's version
+        check_event_edition_legal(eventtype, edition)
+        try:
+            changed_since = since_datetime(eventtype)
+        except ValueError:
+            return "Invalid since argument", 400
+        version = delta_version()
+        if eventtype.upper() != "KK":
+            return flask.jsonify({"version": version, "changed": []}), 200
+        html = flask.request.args.get("html", "True").lower() == "true"
+        if changed_since is None:
+            changed_since = datetime.datetime.fromtimestamp(0)
+        changed = KackiestKacky_KackyRecords(secrets).get_leaderboard_changes(
+            edition, changed_since, html
+        )
+        return flask.jsonify({"version": version, "changed": changed}), 200
     startrank = flask.request.args.get("start", default=0, type=int)
     elems = flask.request.args.get("elems", default=1, type=int)
     if eventtype.upper() == "KK":
@@ -195,6 +379,10 @@ def get_leaderboard(eventtype: str, edition: int):
 
 @app.route("/event/leaderboard/<eventtype>/<edition>/<login>")
 @key_required
+@cached_response(
+    RECORDS_TTL,
+    lambda eventtype, edition, login: leaderboard_domain(eventtype, edition),
+)
 def get_player_rank(eventtype: str, edition: int, login: str):
     # log_access(f"/event/leaderboard/{eventtype}/{edition}/{login}")
     check_event_edition_legal(eventtype, edition)
@@ -210,6 +398,7 @@ def get_player_rank(eventtype: str, edition: int, login: str):
 
 @app.route("/leaderboard/<eventtype>/<kacky_id>")
 @key_required
+@cached_response(RECORDS_TTL, map_leaderboard_domain)
 def get_map_leaderboard(eventtype: str, kacky_id: int):
     # log_access(f"/leaderboard/{eventtype}/{kacky_id}")
     check_event_edition_legal(eventtype, "1")
@@ -222,16 +411,27 @@ def get_map_leaderboard(eventtype: str, kacky_id: int):
     except ValueError:
         return "Invalid positions argument", 400
     if eventtype.upper() == "KR":
-        logger.debug(
-            (
-                kacky_id,
-                flask.request.args.get("version", ""),
-                flask.request.args.get("positions", 10),
-            )
+        catalog_entry = MapCatalog(config, secrets).lookup(
+            "KR", str(int(kacky_id)), flask.request.args.get("version", "")
         )
+        if "cursor" in flask.request.args:
+            elems = flask.request.args.get("elems", default=10, type=int)
+            if not 0 < elems <= MAX_PAGE_SIZE:
+                return "Invalid elems argument", 400
+            try:
+                after = decode_cursor(flask.request.args["cursor"], 3)
+            except ValueError:
+                return "Invalid cursor", 400
+            if not catalog_entry:
+                return flask.jsonify({"entries": [], "next": None}), 200
+            page, next_key = KackyReloaded_KackyRecords(
+                secrets
+            ).get_map_leaderboard_page(catalog_entry.source_map_id, elems, after)
+            return flask.jsonify(paginated_response(page, next_key, elems)), 200
+        if not catalog_entry:
+            return flask.jsonify([]), 200
         lb = KackyReloaded_KackyRecords(secrets).get_map_leaderboard(
-            int(kacky_id),
-            flask.request.args.get("version", ""),
+            catalog_entry.source_map_id,
             int(flask.request.args.get("positions", 10)),
         )
     else:
@@ -239,6 +439,212 @@ def get_map_leaderboard(eventtype: str, kacky_id: int):
     return flask.jsonify(lb), 200
 
 
+@app.route("/stream/wrs")
+@key_required
+def stream_wrs():
+    # Server-Sent Events, one event per new WR. Optional filters: event, edition
+    event = flask.request.args.get("event")
+    edition = flask.request.args.get("edition")
+    if event is not None or edition is not None:
+        try:
+            check_event_edition_legal(event or "kk", edition or "1")
+        except AssertionError:
+            return "Invalid event or edition", 400
+    broadcaster = WRBroadcaster(config, secrets)
+    last_event_id = flask.request.headers.get(
+        "Last-Event-ID", flask.request.args.get("last_event_id")
+    )
+    try:
+        after = int(last_event_id) if last_event_id else broadcaster.last_id()
+    except ValueError:
+        return "Invalid Last-Event-ID", 400
+    if not broadcaster.connect():
+        return "Too many streams, try again", 503, {"Retry-After": "5"}
+    response = flask.Response(
+        sse_stream(
+            broadcaster,
+            after,
+            event.upper() if event else None,
+            int(edition) if edition else None,
+            config.get("wr_stream", {}).get("max_seconds", 300),
+        ),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+    response.call_on_close(broadcaster.disconnect)
+    return response
+
+
+@app.route("/outbox/<consumer>/claim", methods=["POST"])
+@key_required
+def claim_wr_outbox(consumer: str):
+    # next batch of new WRs for a notification consumer, acknowledge with the cursor
+    if not check_consumer_legal(consumer):
+        return "Invalid consumer", 400
+    outbox_conf = config.get("wr_outbox", {})
+    try:
+        limit = min(
+            int(flask.request.args.get("limit", outbox_conf.get("batch_size", 50))),
+            outbox_conf.get("max_batch_size", 500),
+        )
+    except ValueError:
+        return "Invalid limit", 400
+    claimed = WROutbox(config, secrets).claim(consumer, max(limit, 1))
+    if claimed is None:
+        return "Previous batch not acknowledged yet", 409
+    events, cursor = claimed
+    return flask.jsonify({"events": events, "cursor": cursor}), 200
+
+
+@app.route("/outbox/<consumer>/ack", methods=["POST"])
+@key_required
+def ack_wr_outbox(consumer: str):
+    if not check_consumer_legal(consumer):
+        return "Invalid consumer", 400
+    try:
+        cursor = int(flask.request.get_json(silent=True)["cursor"])
+    except (TypeError, KeyError, ValueError):
+        return "Invalid cursor", 400
+    if not WROutbox(config, secrets).ack(consumer, cursor):
+        return "Cursor was not claimed", 409
+    return flask.jsonify({"cursor": cursor}), 200
+
+
+@app.route("/batch", methods=["POST"])
+@key_required
+def batch():
+    # several GET requests in one round trip, answered concurrently
+    batch_conf = config.get("batch", {})
+    body = flask.request.get_json(silent=True) or {}
+    subrequests = body.get("requests")
+    if not isinstance(subrequests, list) or not subrequests:
+        return "Expected a list of requests", 400
+    if len(subrequests) > batch_conf.get("max_requests", 10):
+        return f"At most {batch_conf.get('max_requests', 10)} requests per batch", 400
+    try:
+        paths = [validate_subrequest(sub) for sub in subrequests]
+    except ValueError as e:
+        return f"Invalid request: {e}", 400
+    results = run_batch(
+        app, paths, flask.request.headers, batch_conf.get("max_workers", 4)
+    )
+    return flask.jsonify({"responses": results}), 200
+
+
+@app.route("/export/<eventtype>/<edition>/<kind>")
+@key_required
+def export_edition(eventtype: str, edition: str, kind: str):
+    # whole edition as NDJSON or CSV, streamed with chunked transfer encoding
+    fmt = flask.request.args.get("format", "ndjson")
+    try:
+        check_event_edition_legal(eventtype, edition)
+    except AssertionError:
+        return "Invalid event or edition", 400
+    if kind not in EXPORT_KINDS or fmt not in EXPORT_FORMATS:
+        return "Invalid export", 400
+    slots = export_slots()
+    if not slots.acquire(blocking=False):
+        return "Too many exports, try again", 503, {"Retry-After": "30"}
+    try:
+        lines, close = export_lines(eventtype, int(edition), kind, fmt)
+    except ValueError as e:
+        slots.release()
+        return f"Invalid export: {e}", 400
+    except Exception:
+        slots.release()
+        raise
+    response = flask.Response(
+        lines,
+        mimetype=EXPORT_FORMATS[fmt],
+        headers={
+            "Content-Disposition": (
+                f"attachment; filename={eventtype.lower()}{edition}_{kind}.{fmt}"
+            ),
+            "X-Accel-Buffering": "no",
+        },
+    )
+    # also runs if the client leaves before the first row was read
+    response.call_on_close(close)
+    response.call_on_close(slots.release)
+    return response
+
+
+@app.route("/status/jobs")
+@key_required
+def get_job_stats():
+    # counters of the update jobs, as written by the updater's job runner
+    backend_db = DBConnection(config, secrets)
+    try:
+        rows, columns = backend_db.fetchall(
+            "SELECT * FROM updater_job_stats ORDER BY job;", (), columns=True
+        )
+    except mariadb.Error:
+        # updater did not run yet
+        return flask.jsonify([]), 200
+    return flask.jsonify([dict(zip(columns, r)) for r in rows]), 200
+
+
+def paginated_response(entries: List[Dict], next_key: Optional[List], elems: int):
+    # build link to the next page from the current request, only cursor changes
+    next_url = None
+    if next_key:
+        args = flask.request.args.to_dict()
+        args.update({"cursor": encode_cursor(next_key), "elems": elems})
+        next_url = flask.url_for(
+            flask.request.endpoint, **flask.request.view_args, **args
+        )
+    return {"entries": entries, "next": next_url}
+
+
+def parse_since() -> int:
+    # version of the client's last sync, 0 for everything
+    since = int(flask.request.args.get("since", 0))
+    if since < 0:
+        raise ValueError("since must not be negative")
+    return since
+
+
+def since_datetime(eventtype: str) -> Optional[datetime.datetime]:
+    # record watermark published at the client's version, None for everything
+    since = parse_since()
+    if not since:
+        return None
+    return DataVersions(config, secrets).watermark_at(
+        "KKDB" if eventtype.upper() == "KK" else "KRDB", since
+    )
+
+
+def delta_version() -> int:
+    # every delta endpoint syncs by the global data version, which writers draw in
+    # commit order. Read before the data, a later version could skip changes
+    return DataVersions(config, secrets).current(GLOBAL_DOMAIN)
+
+
+def format_pbs(pbs) -> Dict:
+    # kacky id -> PB of [map name, score, date, kacky rank] rows
+    formatted = {}
+    for x in pbs:
+        kacky_id, _ = parse_map_name(x[0])
+        if not kacky_id:
+            # would collide with every other unparsable name
+            logger.warning(f"PB on map {x[0]} without kacky id skipped")
+            continue
+        formatted[kacky_id] = {
+            "score": x[1],
+            "kacky_rank": x[3],
+            "date": x[2].timestamp(),
+        }
+    return formatted
+
+
+def pbs_response(pbs, version: Optional[int]):
+    # delta responses carry the version to sync from next time
+    pbs_dict = format_pbs(pbs)
+    if version is not None:
+        return flask.jsonify({"version": version, "changed": pbs_dict}), 200
+    return flask.jsonify(pbs_dict), 200
+
+
 def check_event_edition_legal(event: Any, edition: Any):
     # check if parameters are valid (this also is input sanitation)
     if (
@@ -251,6 +657,12 @@ def check_event_edition_legal(event: Any, edition: Any):
     raise AssertionError
 
 
+def check_consumer_legal(consumer: str) -> bool:
+    # consumer names end up in the database, keep them simple
+    stripped = consumer.replace("-", "").replace("_", "")
+    return 0 < len(consumer) <= 64 and stripped.isascii() and stripped.isalnum()
+
+
 def log_access(route: str, logged_in: bool = False):
     # temp suppress queries from own server
     if (
@@ -267,42 +679,17 @@ def log_access(route: str, logged_in: bool = False):
 log = logging.getLogger("werkzeug")
 log.setLevel(logging.ERROR)
 
-# setup schedule to update wrs
-scheduler = BackgroundScheduler()
-scheduler.add_job(
-    func=update_wrs_kackiest_kacky,
-    args=(config, secrets),
-    trigger="interval",
-    seconds=60,
-)
-scheduler.add_job(
-    func=update_wrs_kacky_reloaded,
-    args=(config, secrets),
-    # kwargs={"excluded_event": 4},
-    trigger="interval",
-    seconds=60,
-)
-# scheduler.add_job(
-#     func=update_wrs_kacky_reloaded,
-#     args=(config, secrets),
-#     kwargs={"only_event": 4},
-#     trigger="interval",
-#     seconds=60,
-# )
-scheduler.add_job(
-    func=restore_wr_after_reset,
-    args=(config, secrets),
-    trigger="interval",
-    seconds=60 * 10,
-)
-# start scheduler
-scheduler.start()
-# shutdown scheduler on exit
-atexit.register(lambda: scheduler.shutdown())
-
-# initial wr update on start
-# update_wrs_kackiest_kacky(config, secrets)
-# update_wrs_kacky_reloaded(config, secrets)
+if config.get("embedded_updater", False):
+    # single host setups may still run the update jobs inside the web process.
+    # Otherwise the jobs run in the standalone `kacky-records-updater` process, the
+    # web workers don't even import it.
+    from kacky_records_api.updater import add_update_jobs
+
+    scheduler = BackgroundScheduler()
+    add_update_jobs(scheduler, config, secrets)
+    scheduler.start()
+    # shutdown scheduler on exit
+    atexit.register(lambda: scheduler.shutdown())
 
 app.json = UpdatedJSONProvider(app)
 if "gunicorn" not in os.environ.get("SERVER_SOFTWARE", ""):
@@ -0,0 +1,72 @@
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+import flask
+
+# routes that cannot be answered inside a batch
+EXCLUDED_PREFIXES = ("/batch", "/stream/", "/export/")
+# request headers handed on to every sub-request. Not Accept(-Encoding), the
+# sub-responses are embedded as JSON and the batch response is negotiated as whole
+FORWARDED_HEADERS = ("X-ApiKey", "X-Forwarded-For")
+
+
+def validate_subrequest(sub) -> str:
+    """
+    Path (with query string) of a sub-request of a batch, a dict with "path" and
+    optional "args".
+
+    Raises
+    ------
+    ValueError
+        if the sub-request is malformed or targets an excluded route
+    """
+    if not isinstance(sub, dict) or not isinstance(sub.get("path"), str):
+        raise ValueError("every request needs a path")
+    path = sub["path"]
+    if not path.startswith("/") or path.startswith(EXCLUDED_PREFIXES):
+        raise ValueError(f"{path} can not be batched")
+    args = sub.get("args", {})
+    if not isinstance(args, dict):
+        raise ValueError("args must be an object")
+    if args:
+        path += ("&" if "?" in path else "?") + urllib.parse.urlencode(args)
+    return path
+
+
+def _dispatch(app: flask.Flask, path: str, headers: Dict[str, str]) -> Dict:
+    # full dispatch, so authentication, caches and error handlers apply as usual
+    with app.test_request_context(path, method="GET", headers=headers):
+        try:
+            response = app.full_dispatch_request()
+        except Exception as e:
+            response = app.make_response(app.handle_exception(e))
+        result = {"path": path, "status": response.status_code}
+        if response.is_streamed and response.status_code < 400:
+            # never drained into a batch, closing runs the call_on_close hooks.
+            # Error pages count as streamed too, but are short
+            response.close()
+            result["status"] = 400
+            result["body"] = f"{path} can not be batched"
+        elif response.is_json:
+            result["body"] = response.get_json()
+        else:
+            result["body"] = response.get_data(as_text=True)
+        if response.headers.get("ETag"):
+            result["etag"] = response.headers["ETag"]
+        return result
+
+
+def run_batch(
+    app: flask.Flask, paths: List[str], headers: Dict[str, str], max_workers: int
+) -> List[Dict]:
+    """
+    Answers GET requests to `paths` concurrently within this process, sharing its
+    database pool, response cache and single flight. Results keep the order of
+    `paths`.
+    """
+    forwarded = {h: headers[h] for h in FORWARDED_HEADERS if h in headers}
+    with ThreadPoolExecutor(
+        max_workers=min(max_workers, len(paths)), thread_name_prefix="batch"
+    ) as executor:
+        return list(executor.map(lambda p: _dispatch(app, p, forwarded), paths))
@@ -0,0 +1,220 @@
+import datetime
+import threading
+import time
+from typing import Optional
+
+from kacky_records_api.db_operators.operators import DBConnection
+
+DATA_VERSIONS_TABLE_QUERY = """
+    CREATE TABLE IF NOT EXISTS data_versions (
+        domain VARCHAR(128) NOT NULL PRIMARY KEY,
+        version BIGINT UNSIGNED NOT NULL DEFAULT 0,
+        updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+        INDEX idx_data_versions_version (version)
+    );
+"""
+
+RECORD_WATERMARKS_TABLE_QUERY = """
+    CREATE TABLE IF NOT EXISTS record_watermarks (
+        source VARCHAR(4) NOT NULL PRIMARY KEY,
+        watermark DATETIME NOT NULL
+    );
+"""
+
+# watermark of a record database at the data versions its changes were published
+# with, so delta clients can sync PBs from a data version
+RECORD_WATERMARK_VERSIONS_TABLE_QUERY = """
+    CREATE TABLE IF NOT EXISTS record_watermark_versions (
+        source VARCHAR(4) NOT NULL,
+        version BIGINT UNSIGNED NOT NULL,
+        watermark DATETIME NOT NULL,
+        PRIMARY KEY (source, version)
+    );
+"""
+
+# counter all domain versions are drawn from, keeps versions unique across domains
+GLOBAL_DOMAIN = "global"
+EVENTS_DOMAIN = "events"
+
+
+def wrs_domain(event: str, edition) -> str:
+    return f"wrs:{event.upper()}:{int(edition)}"
+
+
+def leaderboard_domain(event: str, edition) -> str:
+    return f"leaderboard:{event.upper()}:{int(edition)}"
+
+
+def pbs_domain(event: str, user: str) -> str:
+    return f"pbs:{event.upper()}:{user}"
+
+
+def records_domain(event: str) -> str:
+    # any record of the event, PBs carry ranks that move when other players improve
+    return f"records:{event.upper()}"
+
+
+class DataVersions:
+    """
+    Monotonically increasing version stamps of the data served by the API, kept in
+    the `data_versions` table of the backend database. Writers bump the stamp of
+    every domain they change, readers use it for ETags and to invalidate cached
+    responses. Every process polls the table for changed domains at most once per
+    `data_version_poll_seconds`, so reading a version never touches the database.
+
+    Writers are serialized by the lock `begin_write` takes on the global counter, so
+    versions become visible in increasing order and polling for versions above the
+    highest one seen misses none.
+    """
+
+    _versions = {}
+    _fetched_at = 0.0
+    _last_seen: Optional[int] = None
+    _schema_ready = False
+    _lock = threading.Lock()
+
+    def __init__(self, config, secrets):
+        self._config = config
+        self._backend_db = DBConnection(config, secrets)
+
+    def _ensure_schema(self):
+        if not DataVersions._schema_ready:
+            self._backend_db.execute(DATA_VERSIONS_TABLE_QUERY, ())
+            self._backend_db.execute(RECORD_WATERMARKS_TABLE_QUERY, ())
+            self._backend_db.execute(RECORD_WATERMARK_VERSIONS_TABLE_QUERY, ())
+            DataVersions._schema_ready = True
+
+    def _refresh(self):
+        max_age = self._config.get("data_version_poll_seconds", 2)
+        if time.time() - DataVersions._fetched_at < max_age:
+            return
+        with DataVersions._lock:
+            if time.time() - DataVersions._fetched_at < max_age:
+                return
+            self._ensure_schema()
+            if DataVersions._last_seen is None:
+                rows = self._backend_db.fetchall(
+                    "SELECT domain, version FROM data_versions;", ()
+                )
+            else:
+                rows = self._backend_db.fetchall(
+                    "SELECT domain, version FROM data_versions WHERE version > ?;",
+                    (DataVersions._last_seen,),
+                )
+            versions = dict(DataVersions._versions)
+            versions.update({r[0]: r[1] for r in rows})
+            DataVersions._versions = versions
+            DataVersions._last_seen = max(
+                [DataVersions._last_seen or 0] + [r[1] for r in rows]
+            )
+            DataVersions._fetched_at = time.time()
+
+    def current(self, domain: str = GLOBAL_DOMAIN) -> int:
+        self._refresh()
+        return DataVersions._versions.get(domain, 0)
+
+    def begin_write(self, cursor) -> int:
+        """
+        Draws a new version from the global counter inside the caller's transaction.
+        The counter row stays locked until that transaction ends, so writers calling
+        this first are serialized: versions, and the AUTO_INCREMENT ids of the rows
+        they write afterwards (e.g. `wr_events`), become visible in commit order.
+
+        Returns
+        -------
+        int
+            The new version, assign it with `stamp` in the same transaction
+
+        Raises
+        ------
+        ValueError
+            if `cursor` commits every statement, the lock would end right away
+        """
+        if cursor.connection.autocommit:
+            raise ValueError("begin_write needs a cursor of DBConnection.transaction")
+        self._ensure_schema()
+        cursor.execute(
+            """
+            INSERT INTO data_versions (domain, version) VALUES (?, LAST_INSERT_ID(1))
+            ON DUPLICATE KEY UPDATE version = LAST_INSERT_ID(version + 1);
+            """,
+            (GLOBAL_DOMAIN,),
+        )
+        # read right away, later inserts of the transaction overwrite it
+        cursor.execute("SELECT LAST_INSERT_ID();")
+        return cursor.fetchone()[0]
+
+    def stamp(self, cursor, version: int, *domains: str):
+        """Assigns `version` (see `begin_write`) to all given domains."""
+        for domain in set(domains):
+            cursor.execute(
+                """
+                INSERT INTO data_versions (domain, version) VALUES (?, ?)
+                ON DUPLICATE KEY UPDATE version = VALUES(version);
+                """,
+                (domain, version),
+            )
+        # make own writes visible to this process right away
+        DataVersions._fetched_at = 0.0
+
+    def bump(self, *domains: str) -> int:
+        """
+        Draws a new version from the global counter and assigns it to all given
+        domains in one transaction.
+
+        Returns
+        -------
+        int
+            The new version
+        """
+        with self._backend_db.transaction() as cursor:
+            version = self.begin_write(cursor)
+            self.stamp(cursor, version, *domains)
+        return version
+
+    def get_watermark(self, source: str) -> Optional[datetime.datetime]:
+        self._ensure_schema()
+        row = self._backend_db.fetchone(
+            "SELECT watermark FROM record_watermarks WHERE source = ?;", (source,)
+        )
+        return row[0] if row else None
+
+    def set_watermark(
+        self, source: str, watermark: datetime.datetime, version: Optional[int] = None
+    ):
+        """Stores the watermark, logged for `version` if given (see `watermark_at`)."""
+        self._ensure_schema()
+        with self._backend_db.transaction() as cursor:
+            cursor.execute(
+                """
+                INSERT INTO record_watermarks (source, watermark) VALUES (?, ?)
+                ON DUPLICATE KEY UPDATE watermark = VALUES(watermark);
+                """,
+                (source, watermark),
+            )
+            if version is not None:
+                cursor.execute(
+                    """
+                    INSERT IGNORE INTO record_watermark_versions
+                        (source, version, watermark)
+                    VALUES (?, ?, ?);
+                    """,
+                    (source, version, watermark),
+                )
+
+    def watermark_at(self, source: str, version: int) -> Optional[datetime.datetime]:
+        """
+        Newest watermark of `source` published up to data version `version`. All
+        records up to it existed before `version` was visible, None if none was
+        published yet.
+        """
+        self._ensure_schema()
+        row = self._backend_db.fetchone(
+            """
+            SELECT watermark FROM record_watermark_versions
+            WHERE source = ? AND version <= ?
+            ORDER BY version DESC LIMIT 1;
+            """,
+            (source, version),
+        )
+        return row[0] if row else None
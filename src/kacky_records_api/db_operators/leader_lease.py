@@ -0,0 +1,87 @@
+import logging
+
+import mariadb
+
+
+class LeaderLease:
+    """
+    Cluster wide leader election on top of MariaDB's GET_LOCK. The named lock is
+    bound to one dedicated connection to the backend database, so it is released by
+    the server as soon as the holder disconnects or dies. All instances connecting
+    to the same backend database compete for it, only the holder is leader.
+    """
+
+    def __init__(self, config, secrets, name: str):
+        self._config = config
+        self._secrets = secrets
+        self._name = name
+        self._logger = logging.getLogger(self._config["logger_name"])
+        self.connection = None
+        self.cursor = None
+
+    def _connect(self):
+        try:
+            self.connection = mariadb.connect(
+                host=self._secrets["backend_host"],
+                user=self._secrets["backend_user"],
+                passwd=self._secrets["backend_passwd"],
+                database=self._secrets["backend_db"],
+            )
+        except mariadb.Error as e:
+            self._logger.error(f"Connecting to database failed! {e}")
+            raise e
+        self.cursor = self.connection.cursor()
+
+    def acquire(self) -> bool:
+        """
+        Tries to take the lease without waiting.
+
+        Returns
+        -------
+        bool
+            True if this instance is leader now
+        """
+        try:
+            if self.connection is None:
+                self._connect()
+            self.cursor.execute("SELECT GET_LOCK(?, 0);", (self._name,))
+            return self.cursor.fetchone()[0] == 1
+        except mariadb.Error as e:
+            self._logger.error(f"Acquiring leader lease failed! {e}")
+            self._reset()
+            return False
+
+    def is_held(self) -> bool:
+        """
+        Checks that the lease is still held by this instance. A dropped connection
+        means the server already released the lock.
+        """
+        if self.connection is None:
+            return False
+        try:
+            self.cursor.execute(
+                "SELECT IS_USED_LOCK(?) = CONNECTION_ID();", (self._name,)
+            )
+            return self.cursor.fetchone()[0] == 1
+        except mariadb.Error as e:
+            self._logger.error(f"Checking leader lease failed! {e}")
+            self._reset()
+            return False
+
+    def release(self):
+        if self.connection is None:
+            return
+        try:
+            self.cursor.execute("SELECT RELEASE_LOCK(?);", (self._name,))
+            self.cursor.fetchone()
+        except mariadb.Error as e:
+            self._logger.error(f"Releasing leader lease failed! {e}")
+        self._reset()
+
+    def _reset(self):
+        try:
+            if self.connection is not None:
+                self.connection.close()
+        except mariadb.Error:
+            pass
+        self.connection, self.cursor = None, None
@@ -1,6 +1,7 @@
+import contextlib
 import logging
 import queue
-from typing import Tuple
+from typing import List, Tuple
 
 import mariadb
 
@@ -63,19 +64,22 @@ class DBConnection:
     ):
         # Get a connection from the pool. Times out after 2 seconds
         con = DBConnection.connections.get(block=True, timeout=2)
-        con.cursor.execute(query, args)
-        # print(f"using connection {con}")
-        result = None
-        colnames = []
-        if columns:
-            colnames = [col[0] for col in con.cursor.description]
-
-        if fetch == "all":
-            result = con.cursor.fetchall()
-        elif fetch == "one":
-            result = con.cursor.fetchone()
-        con.connection.commit()
-        DBConnection.connections.put(con)
+        try:
+            con.cursor.execute(query, args)
+            # print(f"using connection {con}")
+            result = None
+            colnames = []
+            if columns:
+                colnames = [col[0] for col in con.cursor.description]
+
+            if fetch == "all":
+                result = con.cursor.fetchall()
+            elif fetch == "one":
+                result = con.cursor.fetchone()
+            con.connection.commit()
+        finally:
+            # always hand the connection back, a failed query must not shrink the pool
+            DBConnection.connections.put(con)
         return (result, colnames) if columns else result
 
     def fetchall(self, query: str, args: Tuple, columns: bool = False):
@@ -87,3 +91,29 @@ class DBConnection:
 
     def execute(self, query: str, args: Tuple):
         return self._get_execute(query, args)
+
+    def executemany(self, query: str, args: List[Tuple]):
+        if not args:
+            return
+        con = DBConnection.connections.get(block=True, timeout=2)
+        try:
+            con.cursor.executemany(query, args)
+            con.connection.commit()
+        finally:
+            DBConnection.connections.put(con)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Hands out the cursor of one pooled connection. Everything executed on it is
+        committed together when the block is left, or rolled back on error.
+        """
+        con = DBConnection.connections.get(block=True, timeout=2)
+        try:
+            yield con.cursor
+            con.connection.commit()
+        except Exception:
+            con.connection.rollback()
+            raise
+        finally:
+            DBConnection.connections.put(con)
@@ -0,0 +1,114 @@
+import json
+import threading
+from typing import Dict, NamedTuple, Tuple
+
+from kacky_records_api.data_versions import EVENTS_DOMAIN, DataVersions, wrs_domain
+from kacky_records_api.db_operators.operators import DBConnection
+from kacky_records_api.negotiation import (
+    Variant,
+    encode,
+    offered_encodings,
+    offered_mimetypes,
+)
+
+
+class Bundle(NamedTuple):
+    version: int
+    maps: int
+    etag: str
+    # every representation and compression offered by `negotiation`
+    variants: Dict[Variant, bytes]
+
+
+class EventBundles:
+    """
+    Maps, current WRs, clips and TMX ids of a whole edition as one document. Each
+    bundle is encoded to all negotiable variants once per data version and kept in
+    memory, so serving it is a copy of bytes. The version is the newest of the WR
+    domain of the edition and the events domain (maps, clips), as all versions are
+    drawn from one counter either bump changes it.
+    """
+
+    _bundles: Dict[Tuple[str, int], Bundle] = {}
+    _lock = threading.Lock()
+
+    def __init__(self, config, secrets):
+        self._config = config
+        self._secrets = secrets
+        self._backend_db = DBConnection(config, secrets)
+
+    def version(self, eventtype: str, edition: int) -> int:
+        versions = DataVersions(self._config, self._secrets)
+        return max(
+            versions.current(wrs_domain(eventtype, edition)),
+            versions.current(EVENTS_DOMAIN),
+        )
+
+    def get(self, eventtype: str, edition: int) -> Bundle:
+        key = (eventtype.upper(), int(edition))
+        version = self.version(*key)
+        bundle = EventBundles._bundles.get(key)
+        if bundle is not None and bundle.version == version:
+            return bundle
+        with EventBundles._lock:
+            # built by another thread in the meantime
+            bundle = EventBundles._bundles.get(key)
+            if bundle is not None and bundle.version == version:
+                return bundle
+            bundle = self._build(*key, version)
+            EventBundles._bundles[key] = bundle
+        return bundle
+
+    def _build(self, eventtype: str, edition: int, version: int) -> Bundle:
+        rows = self._backend_db.fetchall(
+            """
+            SELECT maps.kacky_id, maps.name, maps.tmx_id, maps.tm_uid,
+                   maps.default_clip, wr.score, wr.login, wr.nickname, wr.source,
+                   wr.date
+            FROM maps
+            INNER JOIN events ON maps.kackyevent = events.id
+            LEFT JOIN worldrecords AS wr ON wr.map_id = maps.id
+            WHERE events.type = ? AND events.edition = ?
+            ORDER BY maps.kacky_id_int, maps.kacky_id;
+            """,
+            (eventtype, edition),
+        )
+        document = {
+            "event": eventtype,
+            "edition": edition,
+            "version": version,
+            "maps": [
+                {
+                    "kid": r[0],
+                    "name": r[1],
+                    "tmx_id": r[2],
+                    "tm_uid": r[3],
+                    "clip": r[4],
+                    # reset WRs (score 1) are shown as missing
+                    "wr": {
+                        "score": r[5],
+                        "login": r[6],
+                        "nick": r[7],
+                        "source": r[8],
+                        "date": r[9].isoformat() if r[9] else None,
+                    }
+                    if r[5] is not None and r[5] != 1
+                    else None,
+                }
+                for r in rows
+            ],
+        }
+        body = json.dumps(document, separators=(",", ":")).encode()
+        # built once per version, worth the strongest gzip level
+        conf = {"compression": {**self._config.get("compression", {}), "gzip_level": 9}}
+        variants = [
+            Variant(mimetype, encoding)
+            for mimetype in offered_mimetypes()
+            for encoding in offered_encodings() + [None]
+        ]
+        return Bundle(
+            version,
+            len(rows),
+            f"bundle-{eventtype}-{edition}-{version}",
+            {v: encode(body, v, conf) for v in variants},
+        )
@@ -0,0 +1,166 @@
+"""
+Streaming export of the PBs or the leaderboard of a whole edition as NDJSON or
+CSV. Rows are read from an unbuffered cursor and written as they arrive, memory
+use does not depend on the size of the edition.
+
+Served at `/export/<eventtype>/<edition>/<kind>` and through the
+`kacky-records-export` console script.
+"""
+import argparse
+import csv
+import datetime
+import decimal
+import io
+import json
+import sys
+import threading
+from typing import Callable, Iterable, Iterator, List, Tuple
+
+from kacky_records_api import config, secrets
+from kacky_records_api.map_catalog import MapCatalog
+from kacky_records_api.record_aggregators.kackiest_kacky_db import (
+    KackiestKacky_KackyRecords,
+)
+from kacky_records_api.record_aggregators.kacky_reloaded_db import (
+    KackyReloaded_KackyRecords,
+)
+
+EXPORT_KINDS = ["pbs", "leaderboard"]
+EXPORT_FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+
+def _plain(value):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    return value
+
+
+def export_rows(
+    eventtype: str, edition: int, kind: str, chunk_size: int
+) -> Tuple[List[str], Iterator[Tuple], Callable[[], None]]:
+    """
+    Column names and rows of an export, straight from the record database, and the
+    function releasing its cursor and connection. Call it once the export is done
+    or abandoned, whether rows were read or not.
+
+    Raises
+    ------
+    ValueError
+        for exports that do not exist (the KR leaderboard)
+    """
+    if kind not in EXPORT_KINDS:
+        raise ValueError(f"unknown export {kind}")
+    if eventtype.upper() == "KK":
+        records = KackiestKacky_KackyRecords(secrets)
+        if kind == "pbs":
+            columns, rows = records.stream_edition_pbs(edition, chunk_size)
+        else:
+            columns, rows = records.stream_leaderboard(edition, chunk_size)
+    elif kind == "leaderboard":
+        raise ValueError("KR has no edition leaderboard")
+    else:
+        records = KackyReloaded_KackyRecords(secrets)
+        columns, rows = records.stream_edition_pbs(
+            edition, MapCatalog(config, secrets).lobby_map_ids("KR"), chunk_size
+        )
+
+    def close():
+        # the record DB connection of an export is not used for anything else
+        rows.close()
+        records.connection.close()
+
+    return columns, rows, close
+
+
+def ndjson_lines(
+    columns: List[str], rows: Iterable[Tuple], chunk_size: int
+) -> Iterator[str]:
+    # a chunk of lines per write, not one write per row
+    lines = []
+    for row in rows:
+        lines.append(json.dumps(dict(zip(columns, map(_plain, row)))) + "\n")
+        if len(lines) >= chunk_size:
+            yield "".join(lines)
+            lines = []
+    if lines:
+        yield "".join(lines)
+
+
+def csv_lines(
+    columns: List[str], rows: Iterable[Tuple], chunk_size: int
+) -> Iterator[str]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    written = 0
+    for row in rows:
+        writer.writerow([_plain(v) for v in row])
+        written += 1
+        if written % chunk_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def export_lines(
+    eventtype: str, edition: int, kind: str, fmt: str
+) -> Tuple[Iterator[str], Callable[[], None]]:
+    """
+    The export in format `fmt` ("ndjson" or "csv"), chunk by chunk, and its close
+    function (see `export_rows`).
+    """
+    chunk_size = config.get("export", {}).get("chunk_size", 1000)
+    columns, rows, close = export_rows(eventtype, edition, kind, chunk_size)
+    if fmt == "csv":
+        return csv_lines(columns, rows, chunk_size), close
+    return ndjson_lines(columns, rows, chunk_size), close
+
+
+_export_slots = None
+
+
+def export_slots() -> threading.BoundedSemaphore:
+    # exports hold a worker thread and a record DB connection until they are done
+    global _export_slots
+    if _export_slots is None:
+        _export_slots = threading.BoundedSemaphore(
+            config.get("export", {}).get("max_concurrent", 2)
+        )
+    return _export_slots
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description="Kacky Records edition export")
+    parser.add_argument("eventtype", choices=["kk", "kr"])
+    parser.add_argument("edition", type=int)
+    parser.add_argument("kind", choices=EXPORT_KINDS)
+    parser.add_argument("--format", choices=list(EXPORT_FORMATS), default="ndjson")
+    parser.add_argument("--output", help="write the export to this file, not stdout")
+    parsed = parser.parse_args(args)
+
+    try:
+        lines, close = export_lines(
+            parsed.eventtype, parsed.edition, parsed.kind, parsed.format
+        )
+    except ValueError as e:
+        parser.error(str(e))
+    try:
+        if parsed.output:
+            with open(parsed.output, "w", newline="") as out:
+                out.writelines(lines)
+        else:
+            sys.stdout.writelines(lines)
+    finally:
+        close()
+
+
+def run():
+    main(sys.argv[1:])
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,161 @@
+import logging
+import threading
+import time
+from typing import Callable, Optional
+
+from kacky_records_api.db_operators.operators import DBConnection
+
+JOB_STATS_TABLE_QUERY = """
+    CREATE TABLE IF NOT EXISTS updater_job_stats (
+        job VARCHAR(64) NOT NULL PRIMARY KEY,
+        runs INT UNSIGNED NOT NULL DEFAULT 0,
+        skips INT UNSIGNED NOT NULL DEFAULT 0,
+        catch_up_runs INT UNSIGNED NOT NULL DEFAULT 0,
+        overruns INT UNSIGNED NOT NULL DEFAULT 0,
+        failures INT UNSIGNED NOT NULL DEFAULT 0,
+        last_duration DOUBLE NOT NULL DEFAULT 0,
+        max_duration DOUBLE NOT NULL DEFAULT 0,
+        total_duration DOUBLE NOT NULL DEFAULT 0,
+        last_run_at DATETIME NULL,
+        last_error VARCHAR(512) NULL
+    );
+"""
+
+
+class JobStats:
+    def __init__(self):
+        self.runs = 0
+        self.skips = 0
+        self.catch_up_runs = 0
+        self.overruns = 0
+        self.failures = 0
+        self.last_duration = 0.0
+        self.max_duration = 0.0
+        self.total_duration = 0.0
+        self.last_error = None
+
+
+class SingleFlightJob:
+    """
+    Wraps an update job so that at most one run of it is active at any time.
+
+    Ticks arriving while a run is active are not queued up; they are coalesced
+    into a single catch-up run started right after the active one finishes. The
+    lock is released no matter how a run ends, so a failing run never blocks
+    later ticks. Runs taking longer than `deadline` seconds are counted and logged
+    as overruns (Python threads cannot be interrupted, so the run itself goes on).
+
+    Schedule with `max_instances` >= 2, so overlapping ticks reach the wrapper and
+    are counted instead of being dropped by the scheduler. Stats count from process
+    start and are mirrored to the `updater_job_stats` table if `stats_db` is given.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        func: Callable,
+        deadline: float,
+        config,
+        stats_db: Optional[DBConnection] = None,
+    ):
+        self.name = name
+        self.stats = JobStats()
+        self._func = func
+        self._deadline = deadline
+        self._config = config
+        self._stats_db = stats_db
+        self._logger = logging.getLogger(self._config["logger_name"])
+        self._state_lock = threading.Lock()
+        self._running = False
+        self._pending = False
+
+    def __call__(self, *args, **kwargs):
+        with self._state_lock:
+            if self._running:
+                self._pending = True
+                self.stats.skips += 1
+                self._logger.warning(
+                    f"{self.name}: previous run still active, tick coalesced"
+                )
+                return
+            self._running = True
+
+        catch_up = False
+        try:
+            while True:
+                self._run_once(catch_up, *args, **kwargs)
+                with self._state_lock:
+                    if not self._pending:
+                        self._running = False
+                        return
+                    self._pending = False
+                catch_up = True
+        except BaseException:
+            with self._state_lock:
+                self._running = False
+            raise
+
+    def _run_once(self, catch_up: bool, *args, **kwargs):
+        start = time.monotonic()
+        error = None
+        try:
+            self._func(*args, **kwargs)
+        except Exception as e:
+            error = e
+            self._logger.exception(f"{self.name}: run failed")
+        duration = time.monotonic() - start
+
+        self.stats.runs += 1
+        self.stats.catch_up_runs += int(catch_up)
+        self.stats.last_duration = duration
+        self.stats.max_duration = max(self.stats.max_duration, duration)
+        self.stats.total_duration += duration
+        if error is not None:
+            self.stats.failures += 1
+            self.stats.last_error = str(error)[:512]
+        if duration > self._deadline:
+            self.stats.overruns += 1
+            self._logger.warning(
+                f"{self.name}: run took {duration:.1f}s, deadline is {self._deadline}s"
+            )
+        self._persist_stats()
+
+    def _persist_stats(self):
+        if self._stats_db is None:
+            return
+        try:
+            self._stats_db.execute(JOB_STATS_TABLE_QUERY, ())
+            self._stats_db.execute(
+                """
+                INSERT INTO updater_job_stats
+                    (job, runs, skips, catch_up_runs, overruns, failures, last_duration,
+                     max_duration, total_duration, last_run_at, last_error)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, NOW(), ?)
+                ON DUPLICATE KEY UPDATE
+                    runs = VALUES(runs),
+                    skips = VALUES(skips),
+                    catch_up_runs = VALUES(catch_up_runs),
+                    overruns = VALUES(overruns),
+                    failures = VALUES(failures),
+                    last_duration = VALUES(last_duration),
+                    max_duration = VALUES(max_duration),
+                    total_duration = VALUES(total_duration),
+                    last_run_at = VALUES(last_run_at),
+                    last_error = VALUES(last_error);
+                """,
+                (
+                    self.name,
+                    self.stats.runs,
+                    self.stats.skips,
+                    self.stats.catch_up_runs,
+                    self.stats.overruns,
+                    self.stats.failures,
+                    self.stats.last_duration,
+                    self.stats.max_duration,
+                    self.stats.total_duration,
+                    self.stats.last_error,
+                ),
+            )
+        except Exception as e:
+            # stats are informational, never let them break a job
+            self._logger.error(f"{self.name}: storing job stats failed! {e}")
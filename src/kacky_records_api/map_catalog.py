@@ -0,0 +1,237 @@
+import logging
+import re
+import threading
+import time
+from typing import Dict, FrozenSet, Iterable, List, NamedTuple, Optional, Tuple
+
+from tmformatresolver import TMString
+
+from kacky_records_api.db_operators.operators import DBConnection
+
+# matches the trailing "#<kacky id>" and an optional " [<version>]" of a map name
+_KACKY_NAME_PATTERN = re.compile(r"#\s*([^\s\[\]#]+)\s*(?:\[([^\]]*)\])?\s*$")
+
+CATALOG_TABLE_QUERY = """
+    CREATE TABLE IF NOT EXISTS map_catalog (
+        source VARCHAR(4) NOT NULL,
+        uid VARCHAR(64) NOT NULL,
+        source_map_id INT NULL,
+        name VARCHAR(255) NOT NULL,
+        kacky_id VARCHAR(32) NOT NULL,
+        version VARCHAR(32) NOT NULL DEFAULT '',
+        edition INT NULL,
+        is_lobby TINYINT(1) NOT NULL DEFAULT 0,
+        PRIMARY KEY (source, uid),
+        UNIQUE INDEX idx_map_catalog_map_id (source, source_map_id),
+        INDEX idx_map_catalog_kid (source, kacky_id, version),
+        INDEX idx_map_catalog_edition (source, edition)
+    );
+"""
+
+
+class CatalogEntry(NamedTuple):
+    source: str
+    uid: str
+    source_map_id: Optional[int]
+    name: str
+    kacky_id: str
+    version: str
+    edition: Optional[int]
+    is_lobby: bool
+
+
+def kacky_id_from_name(name: str) -> str:
+    """
+    Kacky ID as used throughout the updaters: everything after the '#' of a map
+    name, with en dashes replaced by regular dashes.
+    """
+    return name.split("#")[1].replace("\u2013", "-")
+
+
+def parse_map_name(name: str) -> Tuple[str, str]:
+    """
+    Splits a (possibly TM formatted) map name into kacky id and version.
+
+    Parameters
+    ----------
+    name : str
+        Map name, e.g. "$f00Kacky Reloaded #201 [v2]"
+
+    Returns
+    -------
+    Tuple[str, str]
+        (kacky_id, version). Both are empty strings if name holds no kacky id.
+    """
+    plain = TMString(name).string.replace("\u2013", "-")
+    match = _KACKY_NAME_PATTERN.search(plain)
+    if not match:
+        return "", ""
+    return match.group(1), match.group(2) or ""
+
+
+def build_catalog_entry(
+    source: str,
+    uid: str,
+    source_map_id: Optional[int],
+    name: str,
+    edition: Optional[int],
+    file: str = "",
+) -> Optional[CatalogEntry]:
+    if not name:
+        # deleted maps have no name, nothing to index
+        return None
+    kacky_id, version = parse_map_name(name)
+    is_lobby = "lobby" in (file or "").lower() or "lobby" in name.lower()
+    if not kacky_id and not is_lobby:
+        return None
+    return CatalogEntry(
+        source,
+        uid,
+        source_map_id,
+        name,
+        kacky_id,
+        version,
+        edition,
+        is_lobby,
+    )
+
+
+class MapCatalog:
+    """
+    Kacky ID keyed index of all KK and KR maps. Kacky id, version, edition and
+    lobby flag are parsed from map names once (when the catalog is rebuilt by the
+    updater) and stored in the indexed `map_catalog` table of the backend database.
+    Every process keeps an in-memory copy that is reloaded periodically.
+    """
+
+    _by_uid: Dict[Tuple[str, str], CatalogEntry] = {}
+    _by_kid: Dict[Tuple[str, str, str], CatalogEntry] = {}
+    _by_map_id: Dict[Tuple[str, int], CatalogEntry] = {}
+    _by_edition: Dict[Tuple[str, int], List[CatalogEntry]] = {}
+    _lobby_ids: Dict[str, FrozenSet[int]] = {}
+    _loaded_at = 0.0
+    _lock = threading.Lock()
+
+    def __init__(self, config, secrets):
+        self._config = config
+        self._logger = logging.getLogger(self._config["logger_name"])
+        self._backend_db = DBConnection(config, secrets)
+
+    def _ensure_loaded(self):
+        max_age = self._config.get("map_catalog_reload_seconds", 300)
+        if time.time() - MapCatalog._loaded_at < max_age:
+            return
+        with MapCatalog._lock:
+            # another thread might have reloaded while we were waiting
+            if time.time() - MapCatalog._loaded_at >= max_age:
+                self.load()
+
+    def load(self):
+        self._backend_db.execute(CATALOG_TABLE_QUERY, ())
+        rows = self._backend_db.fetchall(
+            """
+            SELECT source, uid, source_map_id, name, kacky_id, version, edition, is_lobby
+            FROM map_catalog;
+            """,
+            (),
+        )
+        if not rows:
+            self._logger.warning("Map catalog is empty. Was it built by the updater?")
+        self._index(
+            CatalogEntry(r[0], r[1], r[2], r[3], r[4], r[5], r[6], bool(r[7]))
+            for r in rows
+        )
+
+    def _index(self, entries: Iterable[CatalogEntry]):
+        by_uid, by_kid, by_map_id, by_edition, lobby_ids = {}, {}, {}, {}, {}
+        for entry in entries:
+            by_uid[(entry.source, entry.uid)] = entry
+            if entry.source_map_id is not None:
+                by_map_id[(entry.source, entry.source_map_id)] = entry
+            if entry.is_lobby:
+                lobby_ids.setdefault(entry.source, set()).add(entry.source_map_id)
+                continue
+            by_kid[(entry.source, entry.kacky_id, entry.version)] = entry
+            if entry.edition is not None:
+                by_edition.setdefault((entry.source, entry.edition), []).append(entry)
+        # swap complete indexes, readers never see a half built catalog
+        MapCatalog._by_uid = by_uid
+        MapCatalog._by_kid = by_kid
+        MapCatalog._by_map_id = by_map_id
+        MapCatalog._by_edition = by_edition
+        MapCatalog._lobby_ids = {k: frozenset(v) for k, v in lobby_ids.items()}
+        MapCatalog._loaded_at = time.time()
+
+    def rebuild(self, entries: List[CatalogEntry]) -> bool:
+        """
+        Writes freshly parsed entries to the `map_catalog` table and swaps the
+        in-memory index of this process. `entries` is the complete catalog, rows of
+        maps missing from it are deleted (unless their source has no entries).
+
+        Returns
+        -------
+        bool
+            True if the catalog changed
+        """
+        self._ensure_loaded()
+        changed = set(entries) != set(MapCatalog._by_uid.values())
+        self._backend_db.execute(CATALOG_TABLE_QUERY, ())
+        with self._backend_db.transaction() as cursor:
+            cursor.executemany(
+                """
+                INSERT INTO map_catalog
+                    (source, uid, source_map_id, name, kacky_id, version, edition,
+                     is_lobby)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON DUPLICATE KEY UPDATE
+                    source_map_id = VALUES(source_map_id),
+                    name = VALUES(name),
+                    kacky_id = VALUES(kacky_id),
+                    version = VALUES(version),
+                    edition = VALUES(edition),
+                    is_lobby = VALUES(is_lobby);
+                """,
+                [tuple(e[:7]) + (int(e.is_lobby),) for e in entries],
+            )
+            cursor.execute("SELECT source, uid FROM map_catalog;")
+            seen = {(e.source, e.uid) for e in entries}
+            # a source without any maps is more likely broken than emptied
+            sources = {e.source for e in entries}
+            removed = {
+                (r[0], r[1])
+                for r in cursor.fetchall()
+                if r[0] in sources and (r[0], r[1]) not in seen
+            }
+            if removed:
+                cursor.executemany(
+                    "DELETE FROM map_catalog WHERE source = ? AND uid = ?;",
+                    sorted(removed),
+                )
+        with MapCatalog._lock:
+            self._index(entries)
+        self._logger.info(
+            f"Map catalog rebuilt with {len(entries)} maps, {len(removed)} removed"
+        )
+        return changed or bool(removed)
+
+    def lookup(
+        self, source: str, kacky_id: str, version: str = ""
+    ) -> Optional[CatalogEntry]:
+        self._ensure_loaded()
+        return MapCatalog._by_kid.get((source.upper(), str(kacky_id), version))
+
+    def by_uid(self, source: str, uid: str) -> Optional[CatalogEntry]:
+        self._ensure_loaded()
+        return MapCatalog._by_uid.get((source.upper(), uid))
+
+    def by_map_id(self, source: str, map_id: int) -> Optional[CatalogEntry]:
+        self._ensure_loaded()
+        return MapCatalog._by_map_id.get((source.upper(), map_id))
+
+    def lobby_map_ids(self, source: str) -> FrozenSet[int]:
+        self._ensure_loaded()
+        return MapCatalog._lobby_ids.get(source.upper(), frozenset())
+
+    def edition_maps(self, source: str, edition: int) -> List[CatalogEntry]:
+        self._ensure_loaded()
+        return MapCatalog._by_edition.get((source.upper(), int(edition)), [])
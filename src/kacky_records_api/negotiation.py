@@ -0,0 +1,93 @@
+"""
+Content negotiation of JSON responses: representation by `Accept` (JSON, columnar
+JSON, MessagePack) and compression by `Accept-Encoding` (zstd, gzip, deflate).
+MessagePack and zstd need the optional `msgpack` and `zstandard` packages and are
+not offered without them.
+"""
+import gzip
+import json
+import zlib
+from typing import Any, NamedTuple, Optional
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+JSON = "application/json"
+COLUMNAR_JSON = "application/vnd.kacky.columnar+json"
+MSGPACK = "application/msgpack"
+
+
+class Variant(NamedTuple):
+    mimetype: str
+    encoding: Optional[str]
+
+    @property
+    def is_identity(self) -> bool:
+        return self.mimetype == JSON and self.encoding is None
+
+    @property
+    def name(self) -> str:
+        representation = self.mimetype.rsplit("/", 1)[1]
+        return f"{representation}.{self.encoding or 'identity'}"
+
+    def etag(self, etag: str) -> str:
+        # every representation is a different entity and needs its own tag
+        return etag if self.is_identity else f"{etag}.{self.name}"
+
+
+def offered_mimetypes():
+    return [JSON, COLUMNAR_JSON] + ([MSGPACK] if msgpack else [])
+
+
+def offered_encodings():
+    return (["zstd"] if zstandard else []) + ["gzip", "deflate"]
+
+
+def preferred_variant(request) -> Variant:
+    """Best variant for the Accept and Accept-Encoding headers of `request`."""
+    mimetype = request.accept_mimetypes.best_match(offered_mimetypes(), JSON)
+    encoding = request.accept_encodings.best_match(offered_encodings())
+    return Variant(mimetype, encoding)
+
+
+def columnar(data: Any) -> Any:
+    """
+    Lists of objects with the same keys become {"columns": [...], "rows": [[...]]},
+    also inside paginated responses. Everything else is returned unchanged.
+    """
+    if isinstance(data, dict) and isinstance(data.get("entries"), list):
+        return {**data, "entries": columnar(data["entries"])}
+    if (
+        not isinstance(data, list)
+        or not data
+        or not all(isinstance(d, dict) for d in data)
+    ):
+        return data
+    columns = list(data[0])
+    if any(list(d) != columns for d in data):
+        return data
+    return {"columns": columns, "rows": [[d[c] for c in columns] for d in data]}
+
+
+def encode(body: bytes, variant: Variant, config) -> bytes:
+    """Converts a JSON body to `variant`."""
+    conf = config.get("compression", {})
+    if variant.mimetype == COLUMNAR_JSON:
+        body = json.dumps(columnar(json.loads(body)), separators=(",", ":")).encode()
+    elif variant.mimetype == MSGPACK:
+        body = msgpack.packb(json.loads(body))
+    if variant.encoding == "zstd":
+        return zstandard.ZstdCompressor(level=conf.get("zstd_level", 3)).compress(body)
+    if variant.encoding == "gzip":
+        return gzip.compress(body, compresslevel=conf.get("gzip_level", 6))
+    if variant.encoding == "deflate":
+        # HTTP deflate is the zlib format
+        return zlib.compress(body, conf.get("gzip_level", 6))
+    return body
@@ -0,0 +1,65 @@
+import base64
+import datetime
+import decimal
+import json
+from typing import Any, List, Optional
+
+MAX_PAGE_SIZE = 100
+
+
+def _encode_value(value: Any):
+    if isinstance(value, datetime.datetime):
+        return {"dt": value.isoformat()}
+    if isinstance(value, decimal.Decimal):
+        return {"dec": str(value)}
+    return value
+
+
+def _decode_value(value: Any):
+    if isinstance(value, dict):
+        if "dt" in value:
+            return datetime.datetime.fromisoformat(value["dt"])
+        if "dec" in value:
+            return decimal.Decimal(value["dec"])
+        raise ValueError("Malformed cursor")
+    return value
+
+
+def encode_cursor(values: List[Any]) -> str:
+    """
+    Builds an opaque cursor from the sort key of the last element of a page.
+
+    Parameters
+    ----------
+    values : List[Any]
+        Sort key, e.g. (score, date, player id). datetime and Decimal values are kept
+        exact, so ties are resolved identically on the next page.
+
+    Returns
+    -------
+    str
+        URL safe cursor string
+    """
+    raw = json.dumps([_encode_value(v) for v in values], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: Optional[str], length: int) -> Optional[List[Any]]:
+    """
+    Inverse of `encode_cursor`. Returns None for an empty cursor (first page).
+
+    Raises
+    ------
+    ValueError
+        If the cursor is malformed or does not hold `length` values
+    """
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        values = json.loads(raw)
+    except (ValueError, TypeError) as e:
+        raise ValueError("Malformed cursor") from e
+    if not isinstance(values, list) or len(values) != length:
+        raise ValueError("Malformed cursor")
+    return [_decode_value(v) for v in values]
@@ -0,0 +1,355 @@
+"""
+Full WR reconciliation. Compares the WR of every map in every source system with
+the `worldrecords` table and reports the differences as JSON lines, optionally
+applying the WRs the backend is missing through the batch writer.
+
+Runs as scheduled job of the updater (see `reconcile` in config.yaml) or through
+the `kacky-records-reconcile` console script.
+"""
+import argparse
+import json
+import queue
+import sys
+import threading
+import time
+from typing import Callable, Dict, Iterable, Iterator, List, TextIO
+
+from kacky_records_api import config, secrets
+from kacky_records_api.db_operators.operators import DBConnection
+from kacky_records_api.record_aggregators.kackiest_kacky_db import (
+    KackiestKacky_KackyRecords,
+)
+from kacky_records_api.record_aggregators.kacky_reloaded_db import (
+    KackyReloaded_KackyRecords,
+)
+from kacky_records_api.record_aggregators.tmnf_exchange import TmnfTmxApi
+from kacky_records_api.record_sources import NadeoSource
+from kacky_records_api.update_records import candidate_scores, chunked, write_new_wrs
+
+RECONCILE_SOURCES = ["KKDB", "KRDB", "TMX", "DEDI", "NADO"]
+
+# source beats the backend, the backend missed an update. Applied with --apply
+BEHIND = "behind"
+# backend beats the source, usually because another source has the better WR
+AHEAD = "ahead"
+# map of the source unknown to the backend
+UNKNOWN_MAP = "unknown_map"
+# backend WR is reset (score 1), restore_wr_after_reset takes care of it
+RESET = "reset"
+
+
+class RequestBudget:
+    """Counts requests to external APIs. Shared by all sources of one run."""
+
+    def __init__(self, limit: int):
+        self.remaining = limit
+        self._lock = threading.Lock()
+
+    def take(self, requests: int = 1) -> bool:
+        with self._lock:
+            if self.remaining < requests:
+                return False
+            self.remaining -= requests
+            return True
+
+    def spend(self, requests: int = 1):
+        # requests already made by a client counting on its own, e.g. NadeoSource
+        with self._lock:
+            self.remaining = max(self.remaining - requests, 0)
+
+
+class Reconciler:
+    def __init__(self, config, secrets, sources: Iterable[str] = RECONCILE_SOURCES):
+        self._config = config
+        self._secrets = secrets
+        self._conf = config.get("reconcile", {})
+        self._sources = [s.upper() for s in sources]
+        self._backend_db = DBConnection(config, secrets)
+        self._budget = RequestBudget(self._conf.get("max_requests", 2000))
+        self._budget_exhausted = []
+        self._nadeo = None
+
+    # source loaders, each yields score dicts (see `build_score`)
+
+    def _kkdb(self) -> Iterator[Dict]:
+        wrs = KackiestKacky_KackyRecords(self._secrets).get_all_world_records()
+        # row layout of get_recent_world_records
+        rows = (
+            (
+                w["uid"],
+                w["name"],
+                w["edition"],
+                w["author"],
+                w["score"],
+                w["date"],
+                w["login"],
+                w["nick"],
+            )
+            for w in wrs.values()
+        )
+        return candidate_scores(rows, "kkdb")
+
+    def _krdb(self) -> Iterator[Dict]:
+        wrs = KackyReloaded_KackyRecords(self._secrets).get_all_world_records()
+        rows = (
+            {
+                "tm_uid": w["uid"],
+                "kid": w["name"],
+                "score": w["score"],
+                "date": w["date"],
+                "login": w["login"],
+                "nick": w["nick"],
+            }
+            for w in wrs.values()
+        )
+        return candidate_scores(rows, "krdb")
+
+    def _tmx(self) -> Iterator[Dict]:
+        if not self._budget.take():
+            self._report_budget("TMX")
+            return iter(())
+        return candidate_scores(TmnfTmxApi(self._config).get_kacky_wrs(), "tmx")
+
+    def _dedi(self) -> Iterator[Dict]:
+        tmx = TmnfTmxApi(self._config)
+        if not self._budget.take():
+            self._report_budget("DEDI")
+            return iter(())
+        dedi_wrs = {}
+        for kid, tmx_id in tmx.get_kacky_tmx_ids().items():
+            if not self._budget.take():
+                self._report_budget("DEDI")
+                break
+            dedi_wrs.update(tmx.get_map_dedimania_wr(tmx_id, kacky_id=kid))
+        return candidate_scores(dedi_wrs, "dedi")
+
+    def _nado(self) -> Iterator[Dict]:
+        # charged to this run, the updater's KR scheduler keeps its own budget
+        self._nadeo = NadeoSource(self._config, self._secrets, self._budget.spend)
+        tm_uids = [
+            r[0]
+            for r in self._backend_db.fetchall(
+                """
+                SELECT maps.tm_uid
+                FROM maps
+                INNER JOIN events ON events.id = maps.kackyevent
+                WHERE events.type = 'KR' AND maps.tm_uid IS NOT NULL;
+                """,
+                (),
+            )
+        ]
+
+        def budgeted_uids():
+            # every map is one request, spent by get_map_scores
+            for tm_uid in tm_uids:
+                if self._budget.remaining < 1:
+                    self._report_budget("NADO")
+                    return
+                yield tm_uid
+
+        return (
+            {
+                "score": mapscore["score"],
+                "tm_uid": tm_uid,
+                "account_id": mapscore["accountId"],
+            }
+            for tm_uid, mapscore in self._nadeo.get_map_scores(budgeted_uids())
+        )
+
+    def _report_budget(self, source: str):
+        self._budget_exhausted.append(source)
+
+    def _loaders(self) -> Dict[str, Callable[[], Iterator[Dict]]]:
+        loaders = {
+            "KKDB": self._kkdb,
+            "KRDB": self._krdb,
+            "TMX": self._tmx,
+            "DEDI": self._dedi,
+            "NADO": self._nado,
+        }
+        return {name: loaders[name] for name in self._sources}
+
+    def _produce(self, name: str, loader, chunk_size: int, out: queue.Queue):
+        try:
+            for chunk in chunked(loader(), chunk_size):
+                out.put((name, chunk))
+        except (Exception, SystemExit) as e:
+            # the aggregators exit() on connection errors
+            out.put((name, e))
+        finally:
+            out.put((name, None))
+
+    def _stored_wrs(self, key: str, keys: List[str]) -> Dict[str, tuple]:
+        rows = self._backend_db.fetchall(
+            f"""
+            SELECT maps.{key}, maps.kacky_id, wr.score, wr.login, wr.nickname
+            FROM worldrecords AS wr
+            INNER JOIN maps ON wr.map_id = maps.id
+            WHERE maps.{key} IN ({", ".join("?" * len(keys))});
+            """,
+            tuple(keys),
+        )
+        return {str(r[0]): r[1:] for r in rows}
+
+    def _compare(self, name: str, chunk: List[Dict]) -> Iterator[Dict]:
+        key = "tmx_id" if name in ("TMX", "DEDI") else "tm_uid"
+        stored = self._stored_wrs(key, [c[key] for c in chunk])
+        for candidate in chunk:
+            diff = {
+                "source": name,
+                key: candidate[key],
+                "found": candidate["score"],
+                "found_holder": candidate.get("login") or candidate.get("nick"),
+            }
+            if candidate[key] not in stored:
+                yield {**diff, "status": UNKNOWN_MAP, "candidate": candidate}
+                continue
+            kacky_id, score, login, nick = stored[candidate[key]]
+            diff.update(kid=kacky_id, stored=score, stored_holder=login or nick)
+            if score == 1:
+                status = RESET
+            elif candidate["score"] < score:
+                status = BEHIND
+            elif candidate["score"] > score:
+                status = AHEAD
+            else:
+                continue
+            yield {**diff, "status": status, "candidate": candidate}
+
+    def _apply(self, name: str, diffs: List[Dict]) -> int:
+        candidates = [d["candidate"] for d in diffs if d["status"] == BEHIND]
+        if name == "NADO":
+            # resolve the players of the few changed maps only
+            resolved = []
+            for c in candidates:
+                # two requests, spent by build_map_wr
+                if self._budget.remaining < 2:
+                    self._report_budget("NADO")
+                    break
+                wr = self._nadeo.build_map_wr(c["tm_uid"], self._raw_nado(c))
+                if wr is not None:
+                    resolved.append(wr)
+            candidates = resolved
+        write_new_wrs(candidates, self._config, self._secrets)
+        return len(candidates)
+
+    def _raw_nado(self, candidate: Dict) -> Dict:
+        return {"score": candidate["score"], "accountId": candidate["account_id"]}
+
+    def run(self, out: TextIO, apply: bool = False, report_ahead: bool = False) -> Dict:
+        """
+        Reconciles all selected sources at once and writes one JSON line per
+        difference to `out`, followed by a summary line.
+
+        Parameters
+        ----------
+        out : TextIO
+            stream receiving the diff
+        apply : bool
+            write WRs the backend is behind on
+        report_ahead : bool
+            also report maps where the backend beats the source
+
+        Returns
+        -------
+        Dict
+            summary of the run
+        """
+        start = time.monotonic()
+        chunk_size = self._conf.get("chunk_size", 200)
+        # bounded, slow comparisons make the sources wait instead of piling up
+        chunks = queue.Queue(maxsize=self._conf.get("queue_chunks", 8))
+        loaders = self._loaders()
+        for name, loader in loaders.items():
+            threading.Thread(
+                target=self._produce,
+                args=(name, loader, chunk_size, chunks),
+                name=f"reconcile_{name}",
+                daemon=True,
+            ).start()
+
+        summary = {
+            name: {"checked": 0, BEHIND: 0, AHEAD: 0, UNKNOWN_MAP: 0, RESET: 0}
+            for name in loaders
+        }
+        errors = {}
+        applied = 0
+        running = set(loaders)
+        while running:
+            name, chunk = chunks.get()
+            if chunk is None:
+                running.discard(name)
+                continue
+            if isinstance(chunk, BaseException):
+                errors[name] = repr(chunk)
+                continue
+            summary[name]["checked"] += len(chunk)
+            diffs = list(self._compare(name, chunk))
+            for diff in diffs:
+                summary[name][diff["status"]] += 1
+                if diff["status"] == AHEAD and not report_ahead:
+                    continue
+                line = {k: v for k, v in diff.items() if k != "candidate"}
+                out.write(json.dumps(line, default=str) + "\n")
+            if apply:
+                applied += self._apply(name, diffs)
+
+        result = {
+            "summary": summary,
+            "applied": applied,
+            "errors": errors,
+            "budget_exhausted": sorted(set(self._budget_exhausted)),
+            "requests_left": self._budget.remaining,
+            "seconds": round(time.monotonic() - start, 1),
+        }
+        out.write(json.dumps(result) + "\n")
+        out.flush()
+        return result
+
+
+def reconcile_wrs(config, secrets):
+    """Scheduled variant, writes the diff to `reconcile.report_path`."""
+    conf = config.get("reconcile", {})
+    with open(conf.get("report_path", "reconcile_report.jsonl"), "w") as report:
+        Reconciler(config, secrets, conf.get("sources", RECONCILE_SOURCES)).run(
+            report, apply=conf.get("apply", False)
+        )
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description="Kacky Records WR reconciliation")
+    parser.add_argument(
+        "--sources",
+        default=",".join(RECONCILE_SOURCES),
+        help="comma separated sources to reconcile (default: all)",
+    )
+    parser.add_argument(
+        "--apply", action="store_true", help="write WRs the backend is behind on"
+    )
+    parser.add_argument(
+        "--all",
+        action="store_true",
+        help="also report maps where the backend beats the source",
+    )
+    parser.add_argument("--output", help="write the diff to this file, not stdout")
+    parsed = parser.parse_args(args)
+
+    sources = [s.strip().upper() for s in parsed.sources.split(",") if s.strip()]
+    unknown = set(sources) - set(RECONCILE_SOURCES)
+    if unknown:
+        parser.error(f"unknown sources: {', '.join(sorted(unknown))}")
+
+    reconciler = Reconciler(config, secrets, sources)
+    if parsed.output:
+        with open(parsed.output, "w") as out:
+            reconciler.run(out, apply=parsed.apply, report_ahead=parsed.all)
+    else:
+        reconciler.run(sys.stdout, apply=parsed.apply, report_ahead=parsed.all)
+
+
+def run():
+    main(sys.argv[1:])
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,163 @@
+import logging
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Guards calls to one external source or endpoint. After `failure_threshold`
+    consecutive failures the circuit opens and calls are rejected right away with
+    `CircuitOpen`. Once the cool-down passed, a single probe call is let through
+    (half-open): success closes the circuit, failure opens it again with twice the
+    cool-down, up to `max_cooldown` seconds.
+
+    Breakers are shared per name within a process, get them with `CircuitBreaker.get`.
+    Names are "<source>" for a whole source and "<source>:<endpoint>" for a single
+    endpoint of it, see `guarded_call`.
+    """
+
+    _breakers: Dict[str, "CircuitBreaker"] = {}
+    _registry_lock = threading.Lock()
+
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = 5,
+        cooldown: float = 30,
+        max_cooldown: float = 600,
+        logger_name: str = "KackyRecords",
+    ):
+        self.name = name
+        self._failure_threshold = failure_threshold
+        self._base_cooldown = cooldown
+        self._max_cooldown = max_cooldown
+        self._logger = logging.getLogger(logger_name)
+        self._lock = threading.Lock()
+        self.state = CLOSED
+        self.failures = 0
+        self.cooldown = cooldown
+        self.opened_at = 0.0
+        self._probing = False
+
+    @classmethod
+    def get(cls, name: str, config: Optional[dict] = None) -> "CircuitBreaker":
+        with cls._registry_lock:
+            if name not in cls._breakers:
+                conf = (config or {}).get("circuit_breakers", {})
+                cls._breakers[name] = cls(
+                    name,
+                    conf.get("failure_threshold", 5),
+                    conf.get("cooldown", 30),
+                    conf.get("max_cooldown", 600),
+                    (config or {}).get("logger_name", "KackyRecords"),
+                )
+            return cls._breakers[name]
+
+    @classmethod
+    def all(cls) -> Dict[str, "CircuitBreaker"]:
+        with cls._registry_lock:
+            return dict(cls._breakers)
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN:
+                if time.monotonic() - self.opened_at < self.cooldown:
+                    return False
+                self.state = HALF_OPEN
+                self._probing = False
+            # half open, only one probe at a time
+            if self._probing:
+                return False
+            self._probing = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            if self.state != CLOSED:
+                self._logger.info(f"Circuit {self.name} closed, source recovered")
+            self.state = CLOSED
+            self.failures = 0
+            self.cooldown = self._base_cooldown
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == HALF_OPEN:
+                # probe failed, back off further
+                self.cooldown = min(self.cooldown * 2, self._max_cooldown)
+            elif self.failures < self._failure_threshold:
+                return
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+            self._probing = False
+            self._logger.warning(
+                f"Circuit {self.name} open after {self.failures} failures, "
+                f"retrying in {self.cooldown:.0f}s"
+            )
+
+    def release_probe(self):
+        with self._lock:
+            self._probing = False
+
+    def call(self, func: Callable, *args, **kwargs):
+        """
+        Runs `func` through the breaker. Every exception raised by `func` counts
+        as failure and is re-raised.
+
+        Raises
+        ------
+        CircuitOpen
+            if the circuit is open
+        """
+        if not self.allow():
+            raise CircuitOpen(f"Circuit {self.name} is open")
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            self.record_failure()
+            raise
+        self.record_success()
+        return result
+
+
+def guarded_call(
+    source: str, endpoint: str, func: Callable, *args, config=None, **kwargs
+):
+    """
+    Runs `func` through the breakers of `source` and of `source:endpoint`. Failures
+    count for both. A dead source opens after a few failed calls to any endpoint,
+    a single broken endpoint opens on its own while the others keep the source
+    circuit closed.
+
+    Raises
+    ------
+    CircuitOpen
+        if one of the circuits is open
+    """
+    source_breaker = CircuitBreaker.get(source, config)
+    endpoint_breaker = CircuitBreaker.get(f"{source}:{endpoint}", config)
+    if not source_breaker.allow():
+        raise CircuitOpen(f"Circuit {source} is open")
+    try:
+        result = endpoint_breaker.call(func, *args, **kwargs)
+    except CircuitOpen:
+        # nothing was sent, a half open source may be probed by the next call
+        source_breaker.release_probe()
+        raise
+    except Exception:
+        source_breaker.record_failure()
+        raise
+    source_breaker.record_success()
+    return result
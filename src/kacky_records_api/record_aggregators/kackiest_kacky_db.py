@@ -1,10 +1,121 @@
 import datetime
+from typing import Any, List, Optional
 
 import mariadb
 
 # from kacky_records_api.tm_string.tm_format_resolver import TMString
 from tmformatresolver import TMString
 
+from kacky_records_api.map_catalog import kacky_id_from_name
+from kacky_records_api.record_aggregators.streaming import stream_query
+from kacky_records_api.record_mirror import record_db_login
+
+# Per player finish count and average rank for an edition, banned players are left
+# out. Needs the edition twice. Boards order by fins DESC, ev_avg ASC, ties share
+# their rank (RANK()) and are listed by lpid.
+EDITION_BOARD_QUERY = """
+    SELECT
+        COUNT(DISTINCT challenge_uid) as fins,
+        players.login as llogin,
+        players.nickname as lnick,
+        players.id as lpid,
+        (
+        SELECT AVG(pbs.kacky_rank)
+            FROM (
+                SELECT
+                    records.challenge_id,
+                    records.score,
+                    records.date,
+                    players.nickname,
+                    players.login,
+                    RANK() OVER (
+                        PARTITION BY records.challenge_id
+                        ORDER BY records.score, records.date ASC
+                    ) AS kacky_rank
+                    FROM records
+                    INNER JOIN players ON records.player_id = players.id
+                    INNER JOIN challenges ON records.challenge_id = challenges.id
+                    WHERE players.banned = 0 AND challenges.edition = ? AND server_id IN (1, 22,23,24,25)
+            ) AS pbs
+            INNER JOIN challenges ON pbs.challenge_id = challenges.id
+            WHERE pbs.login = llogin
+        ) as ev_avg
+    FROM records
+    INNER JOIN challenges ON records.challenge_uid = challenges.uid
+    INNER JOIN players ON players.id = player_id
+    WHERE players.banned = 0 AND edition = ? AND server_id IN (1, 22,23,24,25)
+    GROUP BY player_id
+"""
+
+
+# Same columns and players as EDITION_BOARD_QUERY, ranks computed once for the whole
+# edition instead of per player. Needs the edition once, takes a HAVING clause.
+EDITION_BOARD_PAGE_QUERY = """
+    SELECT
+        COUNT(DISTINCT pbs.challenge_id) AS fins,
+        pbs.login AS llogin,
+        pbs.nickname AS lnick,
+        pbs.player_id AS lpid,
+        AVG(pbs.kacky_rank) AS ev_avg
+    FROM (
+        SELECT
+            records.challenge_id,
+            records.player_id,
+            players.login,
+            players.nickname,
+            RANK() OVER (
+                PARTITION BY records.challenge_id
+                ORDER BY records.score, records.date ASC
+            ) AS kacky_rank
+        FROM records
+        INNER JOIN players ON records.player_id = players.id
+        INNER JOIN challenges ON records.challenge_id = challenges.id
+        WHERE players.banned = 0 AND challenges.edition = ? AND server_id IN (1, 22,23,24,25)
+    ) AS pbs
+    GROUP BY pbs.player_id
+"""
+
+
+def _avg(value) -> Optional[float]:
+    return None if value is None else float(value)
+
+
+def _board_ranks(rows, position: int = 0, previous=None, rank: int = 0):
+    """
+    Ranks of leaderboard rows (fins first, average rank last) in board order, ties
+    share the rank of their first row like RANK() does.
+
+    Parameters
+    ----------
+    rows :
+    position : int
+        Rows before `rows`, i.e. of the previous pages
+    previous :
+        (fins, avg) of the row before `rows`, None if there is none
+    rank : int
+        Rank of the row before `rows`
+    """
+    for row in rows:
+        position += 1
+        if (row[0], row[4]) != previous:
+            rank = position
+            previous = (row[0], row[4])
+        yield rank, row
+
+
+def _changed_maps_filter(changed_since: Optional[datetime.datetime]) -> str:
+    # restricts a PB query to maps with records updated after `changed_since`
+    if changed_since is None:
+        return ""
+    return """
+                    AND records.challenge_id IN (
+                        SELECT challenge_id FROM records WHERE updated_at > ?
+                    )"""
+
+
+def _changed_args(changed_since: Optional[datetime.datetime]) -> tuple:
+    return () if changed_since is None else (changed_since,)
+
 
 class KackiestKacky_KackyRecords:
     def __init__(self, secrets):
@@ -13,19 +124,16 @@ class KackiestKacky_KackyRecords:
 
     def open_db_connection(self, secrets):
         try:
-            self.connection = mariadb.connect(
-                host=secrets["kkdb_host"],
-                user=secrets["kkdb_user"],
-                passwd=secrets["kkdb_passwd"],
-                database=secrets["kkdb_db"],
-            )
+            # the local mirror if record_mirror.serve_reads is set
+            self.connection = mariadb.connect(**record_db_login(secrets, "KK"))
             print("Connection to MySQL DB successful")
         except mariadb.Error as e:
             print(f"The error '{e}' occurred")
             exit(-1)
         self.cursor = self.connection.cursor()
 
-    def get_all_world_records_and_equals(self):
+    def iter_all_world_records_and_equals(self, chunk_size: int = 1000):
+        """WRs and equal scores of all maps, read lazily with `stream_query`"""
         query = """
                 SELECT records.challenge_uid,
                        challenges.name,
@@ -50,12 +158,10 @@ class KackiestKacky_KackyRecords:
                        LEFT JOIN challenges
                               ON challenges.uid = records.challenge_uid;
         """
-        self.cursor.execute(query)
-        top_recs_raw = self.cursor.fetchall()
-        top_recs = []
-        for rec in top_recs_raw:
-            record = {
-                "kid": rec[1].split("#")[1].replace("\u2013", "-"),
+        _, rows = stream_query(self.connection, query, (), chunk_size)
+        for rec in rows:
+            yield {
+                "kid": kacky_id_from_name(rec[1]),
                 "uid": rec[0],
                 "name": rec[1],
                 "edition": rec[2],
@@ -65,11 +171,13 @@ class KackiestKacky_KackyRecords:
                 "login": rec[6],
                 "nick": rec[7],
             }
-            top_recs.append(record)
-        return top_recs
+
+    def get_all_world_records_and_equals(self):
+        return list(self.iter_all_world_records_and_equals())
 
     def get_all_world_records(self):
-        top_recs = self.get_all_world_records_and_equals()
+        # consumed lazily, only the WR of each map is kept
+        top_recs = self.iter_all_world_records_and_equals()
         wrs = {}
         for rec in top_recs:
             if rec["kid"] not in wrs:
@@ -127,6 +235,25 @@ class KackiestKacky_KackyRecords:
         self.cursor.execute(query)
         return self.cursor.fetchall()
 
+    def get_map_catalog_rows(self):
+        # (challenge id, uid, name, edition, file) - KK has no lobby files
+        query = "SELECT id, uid, name, edition, '' FROM challenges;"
+        self.cursor.execute(query)
+        return self.cursor.fetchall()
+
+    def get_changed_records(self, since: datetime.datetime):
+        # (login, edition, newest update) of every player with records after `since`
+        query = """
+            SELECT players.login, challenges.edition, MAX(records.updated_at)
+            FROM records
+            INNER JOIN players ON records.player_id = players.id
+            INNER JOIN challenges ON records.challenge_id = challenges.id
+            WHERE records.updated_at > ?
+            GROUP BY players.login, challenges.edition;
+            """
+        self.cursor.execute(query, (since,))
+        return self.cursor.fetchall()
+
     def get_user_records(self, user_login, key: str = None, raw: bool = False):
         """
 
@@ -171,7 +298,7 @@ class KackiestKacky_KackyRecords:
             result_dict = {row[0]: dict(zip(columns, row)) for row in records_vals}
             # replace all keys (challenge_uid) with Kacky IDs
             for kid in kacky_ids:
-                kid_number = int(kid[1].split("#")[1].replace("\u2013", "-"))
+                kid_number = int(kacky_id_from_name(kid[1]))
                 try:
                     result_dict[kid_number] = result_dict.pop(kid[0])
                 except KeyError:
@@ -196,8 +323,12 @@ class KackiestKacky_KackyRecords:
                 """
         query
 
-    def get_user_pbs(self, user: str):
-        q = """
+    def get_user_pbs(
+        self, user: str, changed_since: Optional[datetime.datetime] = None
+    ):
+        # with `changed_since`, only maps with records after it are ranked
+        changed_filter = _changed_maps_filter(changed_since)
+        q = f"""
             SELECT challenges.name, pbs.score, pbs.date, pbs.kacky_rank
             FROM (
                 SELECT
@@ -212,12 +343,12 @@ class KackiestKacky_KackyRecords:
                     ) AS kacky_rank
                 FROM records
                 INNER JOIN players ON records.player_id = players.id
-                WHERE players.banned = 0
+                WHERE players.banned = 0{changed_filter}
             ) AS pbs
             INNER JOIN challenges ON pbs.challenge_id = challenges.id
             WHERE pbs.login = ?;
         """
-        self.cursor.execute(q, (user,))
+        self.cursor.execute(q, _changed_args(changed_since) + (user,))
         qres = self.cursor.fetchall()
         # replace \u2013 with - in map name
         return list(
@@ -239,8 +370,11 @@ class KackiestKacky_KackyRecords:
         qres = self.cursor.fetchall()
         return [{"edition": r[0], "fins": r[1]} for r in qres]
 
-    def get_user_pbs_edition(self, tmlogin, edition):
-        query = """
+    def get_user_pbs_edition(
+        self, tmlogin, edition, changed_since: Optional[datetime.datetime] = None
+    ):
+        changed_filter = _changed_maps_filter(changed_since)
+        query = f"""
         SELECT challenges.name, pbs.score, pbs.date, pbs.kacky_rank
         FROM (
             SELECT
@@ -256,18 +390,60 @@ class KackiestKacky_KackyRecords:
                 FROM records
                 INNER JOIN players ON records.player_id = players.id
                 INNER JOIN challenges ON records.challenge_id = challenges.id
-                WHERE players.banned = 0 AND challenges.edition = ?
+                WHERE players.banned = 0 AND challenges.edition = ?{changed_filter}
         ) AS pbs
         INNER JOIN challenges ON pbs.challenge_id = challenges.id
         WHERE pbs.login = ?;
         """
-        self.cursor.execute(query, (edition, tmlogin))
+        self.cursor.execute(
+            query, (edition,) + _changed_args(changed_since) + (tmlogin,)
+        )
         qres = self.cursor.fetchall()
         # replace \u2013 with - in map name
         return list(
             map(lambda elem: [elem[0].replace("\u2013", "-")] + list(elem[1:]), qres)
         )
 
+    def get_users_pbs(self, users: List[str], edition: Optional[int] = None):
+        """
+        PBs and ranks of several players from one ranked pass over the records.
+
+        Returns
+        -------
+        List[List]
+            [login, map name, score, date, kacky rank] per PB
+        """
+        if not users:
+            return []
+        edition_filter = " AND challenges.edition = ?" if edition is not None else ""
+        query = f"""
+            SELECT pbs.login, challenges.name, pbs.score, pbs.date, pbs.kacky_rank
+            FROM (
+                SELECT
+                    records.challenge_id,
+                    records.score,
+                    records.date,
+                    players.login,
+                    RANK() OVER (
+                        PARTITION BY records.challenge_id
+                        ORDER BY records.score, records.date ASC
+                    ) AS kacky_rank
+                FROM records
+                INNER JOIN players ON records.player_id = players.id
+                INNER JOIN challenges ON records.challenge_id = challenges.id
+                WHERE players.banned = 0{edition_filter}
+            ) AS pbs
+            INNER JOIN challenges ON pbs.challenge_id = challenges.id
+            WHERE pbs.login IN ({", ".join("?" * len(users))});
+        """
+        args = ((edition,) if edition is not None else ()) + tuple(users)
+        self.cursor.execute(query, args)
+        # replace \u2013 with - in map name
+        return [
+            [elem[0], elem[1].replace("\u2013", "-")] + list(elem[2:])
+            for elem in self.cursor.fetchall()
+        ]
+
     def get_player_avg_edition(self, edition, login):
         query = """
             SELECT challenges.name, pbs.score, pbs.date, AVG(pbs.kacky_rank)
@@ -305,44 +481,17 @@ class KackiestKacky_KackyRecords:
     ):
         if endrank - startrank > 100 and not force:
             raise ValueError("Range of ranks to big!")
-        query = """
-            SELECT
-                COUNT(DISTINCT challenge_uid) as fins,
-                players.login as llogin,
-                players.nickname as lnick,
-                players.id as lpid,
-                (
-                SELECT AVG(pbs.kacky_rank)
-                    FROM (
-                        SELECT
-                            records.challenge_id,
-                            records.score,
-                            records.date,
-                            players.nickname,
-                            players.login,
-                            RANK() OVER (
-                                PARTITION BY records.challenge_id
-                                ORDER BY records.score, records.date ASC
-                            ) AS kacky_rank
-                            FROM records
-                            INNER JOIN players ON records.player_id = players.id
-                            INNER JOIN challenges ON records.challenge_id = challenges.id
-                            WHERE players.banned = 0 AND challenges.edition = ? AND server_id IN (1, 22,23,24,25)
-                    ) AS pbs
-                    INNER JOIN challenges ON pbs.challenge_id = challenges.id
-                    WHERE pbs.login = llogin
-                ) as ev_avg
-            FROM records
-            INNER JOIN challenges ON records.challenge_uid = challenges.uid
-            INNER JOIN players ON players.id = player_id
-            WHERE edition = 8 AND server_id IN (1, 22,23,24,25)
-            GROUP BY player_id
-            ORDER BY fins DESC, ev_avg ASC
+        query = (
+            EDITION_BOARD_QUERY
+            + """
+            ORDER BY fins DESC, ev_avg ASC, lpid ASC
             LIMIT ?, ?;
         """
+        )
         self.cursor.execute(
             query,
             (
+                edition,
                 edition,
                 startrank,
                 (endrank - startrank if endrank - startrank > 0 else 1),
@@ -366,17 +515,158 @@ class KackiestKacky_KackyRecords:
             for elem in qres
         ]
 
-    def get_login_rank(self, edition, login, html: bool = False):
-        leaderboard = self.get_leaderboard(
-            edition, startrank=0, endrank=100000, force=True, raw=True
+    def get_leaderboard_page(
+        self,
+        edition,
+        elems: int = 10,
+        after: Optional[List[Any]] = None,
+        html: bool = False,
+    ):
+        """
+        Keyset paginated edition leaderboard, ordered by finishes, average rank and
+        player id.
+
+        Parameters
+        ----------
+        edition :
+        elems : int
+            Page size
+        after : Optional[List[Any]]
+            Sort key (fins, avg, player id) of the last entry of the previous page
+            followed by its position and rank, as returned by this method. None for
+            the first page.
+        html : bool
+
+        Returns
+        -------
+        Tuple[List[Dict], Optional[List[Any]]]
+            Page entries and sort key for the next page (None on the last page)
+        """
+        query = EDITION_BOARD_PAGE_QUERY
+        args = [edition]
+        position, previous, rank = 0, None, 0
+        if after:
+            fins, avg, pid, position, rank = after
+            previous = (fins, avg)
+            # keyset applied while aggregating, not on a materialized board
+            query += """
+                HAVING fins < ?
+                    OR (fins = ? AND (ev_avg > ? OR (ev_avg = ? AND lpid > ?)))
+            """
+            args += [fins, fins, avg, avg, pid]
+        query += " ORDER BY fins DESC, ev_avg ASC, lpid ASC LIMIT ?;"
+        args.append(elems)
+        self.cursor.execute(query, tuple(args))
+        qres = self.cursor.fetchall()
+        page = [
+            {
+                "rank": rank,
+                "login": elem[1],
+                "nick": TMString(elem[2]).html if html else elem[2],
+                "fins": elem[0],
+                "avg": _avg(elem[4]),
+            }
+            for rank, elem in _board_ranks(qres, position, previous, rank)
+        ]
+        if len(qres) < elems:
+            return page, None
+        last = qres[-1]
+        return page, [last[0], last[4], last[3], position + len(qres), page[-1]["rank"]]
+
+    def get_leaderboard_changes(
+        self, edition, changed_since: datetime.datetime, html: bool = False
+    ):
+        """
+        Current leaderboard entries of the players with records in `edition`
+        updated after `changed_since`. Ranks of the other players may have shifted,
+        clients re-sort by fins and avg.
+        """
+        query = (
+            "SELECT * FROM (SELECT board.*, RANK() OVER (ORDER BY fins DESC, ev_avg)"
+            " AS board_rank FROM ("
+            + EDITION_BOARD_QUERY
+            + """
+            ) AS board) AS ranked
+            WHERE lpid IN (
+                SELECT records.player_id
+                FROM records
+                INNER JOIN challenges ON records.challenge_id = challenges.id
+                WHERE challenges.edition = ? AND records.updated_at > ?
+            )
+            ORDER BY board_rank;
+        """
         )
-        rank = 1
-        for elem in leaderboard:
+        self.cursor.execute(query, (edition, edition, edition, changed_since))
+        return [
+            {
+                "rank": elem[5],
+                "login": elem[1],
+                "nick": TMString(elem[2]).html if html else elem[2],
+                "fins": elem[0],
+                "avg": _avg(elem[4]),
+            }
+            for elem in self.cursor.fetchall()
+        ]
+
+    def stream_edition_pbs(self, edition, chunk_size: int = 1000):
+        """PBs and ranks of all players on all maps of `edition`, see `stream_query`"""
+        query = """
+            SELECT pbs.login, pbs.nickname AS nick, challenges.name AS map,
+                   pbs.score, pbs.date, pbs.kacky_rank
+            FROM (
+                SELECT
+                    records.challenge_id,
+                    records.score,
+                    records.date,
+                    players.nickname,
+                    players.login,
+                    RANK() OVER (
+                        PARTITION BY records.challenge_id
+                        ORDER BY records.score, records.date ASC
+                    ) AS kacky_rank
+                FROM records
+                INNER JOIN players ON records.player_id = players.id
+                INNER JOIN challenges ON records.challenge_id = challenges.id
+                WHERE players.banned = 0 AND challenges.edition = ?
+            ) AS pbs
+            INNER JOIN challenges ON pbs.challenge_id = challenges.id
+            ORDER BY pbs.challenge_id, pbs.kacky_rank;
+        """
+        return stream_query(self.connection, query, (edition,), chunk_size)
+
+    def stream_leaderboard(self, edition, chunk_size: int = 1000):
+        """Whole leaderboard of `edition`, see `stream_query`"""
+        query = (
+            """
+            SELECT RANK() OVER (ORDER BY fins DESC, ev_avg ASC) AS `rank`,
+                   llogin AS login, lnick AS nick, fins, ev_avg AS avg
+            FROM ("""
+            + EDITION_BOARD_QUERY
+            + """) AS board
+            ORDER BY fins DESC, ev_avg ASC, lpid ASC;
+        """
+        )
+        return stream_query(self.connection, query, (edition, edition), chunk_size)
+
+    def iter_leaderboard(self, edition, chunk_size: int = 1000):
+        """
+        Raw rows of the whole leaderboard of `edition`, in the order of
+        `get_leaderboard`, read lazily with `stream_query`.
+        """
+        query = EDITION_BOARD_QUERY + " ORDER BY fins DESC, ev_avg ASC, lpid ASC;"
+        _, rows = stream_query(self.connection, query, (edition, edition), chunk_size)
+        return rows
+
+    def get_login_rank(self, edition, login, html: bool = False):
+        # stops reading the leaderboard at the player
+        rank, elem = 0, None
+        leaderboard = self.iter_leaderboard(edition)
+        for rank, elem in _board_ranks(leaderboard):
             if elem[1] == login:
                 break
-            rank += 1
+        leaderboard.close()
         # inequality when login not found in leaderboard. return empty dict
-        if login != elem[1]:
+        if elem is None or login != elem[1]:
             return {}
         if html:
             return {
@@ -1,9 +1,28 @@
 import datetime
 import json
 import zlib
+from typing import Any, Collection, List, Optional
 
 import mariadb
 
+from kacky_records_api.map_catalog import kacky_id_from_name
+from kacky_records_api.record_aggregators.streaming import stream_query
+from kacky_records_api.record_mirror import record_db_login
+
+
+def _changed_maps_filter(changed_since: Optional[datetime.datetime]) -> str:
+    # restricts a PB query to maps with records updated after `changed_since`
+    if changed_since is None:
+        return ""
+    return """
+                WHERE localrecord.map_id IN (
+                    SELECT map_id FROM localrecord WHERE updated_at > ?
+                )"""
+
+
+def _changed_args(changed_since: Optional[datetime.datetime]) -> tuple:
+    return () if changed_since is None else (changed_since,)
+
 
 class KackyReloaded_KackyRecords:
     def __init__(self, secrets):
@@ -12,18 +31,15 @@ class KackyReloaded_KackyRecords:
 
     def open_db_connection(self, secrets):
         try:
-            self.connection = mariadb.connect(
-                host=secrets["krdb_host"],
-                user=secrets["krdb_user"],
-                passwd=secrets["krdb_passwd"],
-                database=secrets["krdb_db"],
-            )
+            # the local mirror if record_mirror.serve_reads is set
+            self.connection = mariadb.connect(**record_db_login(secrets, "KR"))
         except mariadb.Error as e:
             print(f"The error '{e}' occurred")
             exit(-1)
         self.cursor = self.connection.cursor()
 
-    def get_all_world_records_and_equals(self):
+    def iter_all_world_records_and_equals(self, chunk_size: int = 1000):
+        """WRs and equal scores of all maps, read lazily with `stream_query`"""
         query = """
         SELECT kackychallenges.uid,
                kackychallenges.name,
@@ -45,13 +61,11 @@ class KackyReloaded_KackyRecords:
                INNER JOIN kackychallenges
                       ON kackychallenges.id = localrecord.map_id;
         """
-        self.cursor.execute(query)
-        top_recs_raw = self.cursor.fetchall()
-        top_recs = []
-        for rec in top_recs_raw:
+        _, rows = stream_query(self.connection, query, (), chunk_size)
+        for rec in rows:
             try:
-                record = {
-                    "kid": rec[1].split("#")[1].replace("\u2013", "-"),
+                yield {
+                    "kid": kacky_id_from_name(rec[1]),
                     "uid": rec[0],
                     "name": rec[1],
                     "edition": rec[2],
@@ -61,14 +75,16 @@ class KackyReloaded_KackyRecords:
                     "login": rec[6],
                     "nick": rec[7],
                 }
-                top_recs.append(record)
             except AttributeError:
                 # found deleted map, 'name', 'edition', 'author' are NULL
                 pass
-        return top_recs
+
+    def get_all_world_records_and_equals(self):
+        return list(self.iter_all_world_records_and_equals())
 
     def get_all_world_records(self):
-        top_recs = self.get_all_world_records_and_equals()
+        # consumed lazily, only the WR of each map is kept
+        top_recs = self.iter_all_world_records_and_equals()
         wrs = {}
         for rec in top_recs:
             if rec["kid"] not in wrs:
@@ -130,13 +146,46 @@ class KackyReloaded_KackyRecords:
         self.cursor.execute(query)
         return self.cursor.fetchall()
 
-    def get_user_pbs(self, user: str):
-        q = """
+    def get_map_catalog_rows(self):
+        # (map id, uid, name, edition, file)
+        query = """
+            SELECT map.id, map.uid, map.name, kackychallenges.edition, map.file
+            FROM map
+            LEFT JOIN kackychallenges ON map.uid = kackychallenges.uid;
+            """
+        self.cursor.execute(query)
+        return self.cursor.fetchall()
+
+    def get_changed_records(self, since: datetime.datetime):
+        # (uplay nickname, edition, newest update) of every player with records
+        # after `since`. PBs are looked up by uplay nickname for KR.
+        query = """
+            SELECT player.uplay_nickname, kackychallenges.edition, MAX(localrecord.updated_at)
+            FROM localrecord
+            INNER JOIN player ON localrecord.player_id = player.id
+            INNER JOIN map ON localrecord.map_id = map.id
+            LEFT JOIN kackychallenges ON map.uid = kackychallenges.uid
+            WHERE localrecord.updated_at > ?
+            GROUP BY player.uplay_nickname, kackychallenges.edition;
+            """
+        self.cursor.execute(query, (since,))
+        return self.cursor.fetchall()
+
+    def get_user_pbs(
+        self,
+        user: str,
+        exclude_map_ids: Collection[int] = (),
+        changed_since: Optional[datetime.datetime] = None,
+    ):
+        # with `changed_since`, only maps with records after it are ranked
+        changed_filter = _changed_maps_filter(changed_since)
+        q = f"""
             SELECT
                 map.name,
                 pbs.score,
                 pbs.updated_at,
-                pbs.kacky_rank
+                pbs.kacky_rank,
+                pbs.map_id
             FROM (
                 SELECT
                     localrecord.map_id,
@@ -150,25 +199,35 @@ class KackyReloaded_KackyRecords:
                         ORDER BY localrecord.score, localrecord.updated_at ASC
                     ) AS kacky_rank
                 FROM localrecord
-                INNER JOIN player ON localrecord.player_id = player.id
+                INNER JOIN player ON localrecord.player_id = player.id{changed_filter}
             ) AS pbs
-            INNER JOIN map ON pbs.map_id = map.id AND UPPER(map.file) NOT LIKE UPPER("%%Lobby%")
+            INNER JOIN map ON pbs.map_id = map.id
             WHERE uplay_nickname = ?;
         """
-        self.cursor.execute(q, (user,))
+        self.cursor.execute(q, _changed_args(changed_since) + (user,))
         qres = self.cursor.fetchall()
-        # replace \u2013 with - in map name
-        return list(
-            map(lambda elem: [elem[0].replace("\u2013", "-")] + list(elem[1:]), qres)
-        )
+        # drop lobby maps, replace \u2013 with - in map name
+        return [
+            [elem[0].replace("\u2013", "-")] + list(elem[1:4])
+            for elem in qres
+            if elem[4] not in exclude_map_ids
+        ]
 
-    def get_user_pbs_edition(self, user: str, edition: int):
-        q = """
+    def get_user_pbs_edition(
+        self,
+        user: str,
+        edition: int,
+        exclude_map_ids: Collection[int] = (),
+        changed_since: Optional[datetime.datetime] = None,
+    ):
+        changed_filter = _changed_maps_filter(changed_since)
+        q = f"""
             SELECT
                 map.name,
                 pbs.score,
                 pbs.updated_at,
-                pbs.kacky_rank
+                pbs.kacky_rank,
+                pbs.map_id
             FROM (
                 SELECT
                     localrecord.map_id,
@@ -182,17 +241,122 @@ class KackyReloaded_KackyRecords:
                         ORDER BY localrecord.score, localrecord.updated_at ASC
                     ) AS kacky_rank
                 FROM localrecord
-                INNER JOIN player ON localrecord.player_id = player.id
+                INNER JOIN player ON localrecord.player_id = player.id{changed_filter}
             ) AS pbs
-            INNER JOIN map ON pbs.map_id = map.id AND UPPER(map.file) NOT LIKE UPPER("%%Lobby%")
+            INNER JOIN map ON pbs.map_id = map.id
             INNER JOIN kackychallenges ON map.uid = kackychallenges.uid
             WHERE uplay_nickname = ? and kackychallenges.edition = ?;
         """
-        self.cursor.execute(q, (user, edition))
+        self.cursor.execute(q, _changed_args(changed_since) + (user, edition))
         qres = self.cursor.fetchall()
-        # replace \u2013 with - in map name
-        return list(
-            map(lambda elem: [elem[0].replace("\u2013", "-")] + list(elem[1:]), qres)
+        # drop lobby maps, replace \u2013 with - in map name
+        return [
+            [elem[0].replace("\u2013", "-")] + list(elem[1:4])
+            for elem in qres
+            if elem[4] not in exclude_map_ids
+        ]
+
+    def get_users_pbs(
+        self,
+        users: List[str],
+        edition: Optional[int] = None,
+        exclude_map_ids: Collection[int] = (),
+    ):
+        """
+        PBs and ranks of several players (by uplay nickname) from one ranked pass
+        over the records.
+
+        Returns
+        -------
+        List[List]
+            [uplay nickname, map name, score, date, kacky rank] per PB
+        """
+        if not users:
+            return []
+        # ranks are per map, only ranking the maps of the edition changes nothing
+        edition_filter = (
+            """
+                WHERE localrecord.map_id IN (
+                    SELECT map.id FROM map
+                    INNER JOIN kackychallenges ON map.uid = kackychallenges.uid
+                    WHERE kackychallenges.edition = ?
+                )"""
+            if edition is not None
+            else ""
+        )
+        q = f"""
+            SELECT
+                pbs.uplay_nickname,
+                map.name,
+                pbs.score,
+                pbs.updated_at,
+                pbs.kacky_rank,
+                pbs.map_id
+            FROM (
+                SELECT
+                    localrecord.map_id,
+                    localrecord.score,
+                    localrecord.updated_at,
+                    player.uplay_nickname,
+                    RANK() OVER (
+                        PARTITION BY localrecord.map_id
+                        ORDER BY localrecord.score, localrecord.updated_at ASC
+                    ) AS kacky_rank
+                FROM localrecord
+                INNER JOIN player ON localrecord.player_id = player.id{edition_filter}
+            ) AS pbs
+            INNER JOIN map ON pbs.map_id = map.id
+            WHERE pbs.uplay_nickname IN ({", ".join("?" * len(users))});
+        """
+        args = ((edition,) if edition is not None else ()) + tuple(users)
+        self.cursor.execute(q, args)
+        # drop lobby maps, replace \u2013 with - in map name
+        return [
+            [elem[0], elem[1].replace("\u2013", "-")] + list(elem[2:5])
+            for elem in self.cursor.fetchall()
+            if elem[5] not in exclude_map_ids
+        ]
+
+    def stream_edition_pbs(
+        self,
+        edition: int,
+        exclude_map_ids: Collection[int] = (),
+        chunk_size: int = 1000,
+    ):
+        """PBs and ranks of all players on all maps of `edition`, see `stream_query`"""
+        exclude = (
+            f" WHERE map.id NOT IN ({', '.join('?' * len(exclude_map_ids))})"
+            if exclude_map_ids
+            else ""
+        )
+        query = f"""
+            SELECT pbs.uplay_nickname AS uplay, pbs.login, pbs.nickname AS nick,
+                   map.name AS map, pbs.score, pbs.updated_at AS date, pbs.kacky_rank
+            FROM (
+                SELECT
+                    localrecord.map_id,
+                    localrecord.score,
+                    localrecord.updated_at,
+                    player.nickname,
+                    player.login,
+                    player.uplay_nickname,
+                    RANK() OVER (
+                        PARTITION BY localrecord.map_id
+                        ORDER BY localrecord.score, localrecord.updated_at ASC
+                    ) AS kacky_rank
+                FROM localrecord
+                INNER JOIN player ON localrecord.player_id = player.id
+                WHERE localrecord.map_id IN (
+                    SELECT map.id FROM map
+                    INNER JOIN kackychallenges ON map.uid = kackychallenges.uid
+                    WHERE kackychallenges.edition = ?
+                )
+            ) AS pbs
+            INNER JOIN map ON pbs.map_id = map.id{exclude}
+            ORDER BY pbs.map_id, pbs.kacky_rank;
+        """
+        return stream_query(
+            self.connection, query, (edition, *exclude_map_ids), chunk_size
         )
 
     def get_user_fin_count(self, tmlogin: str):
@@ -213,8 +377,7 @@ class KackyReloaded_KackyRecords:
 
     def get_map_leaderboard(
         self,
-        kacky_id: int,
-        version: str,
+        map_id: int,
         positions: int = 10,
         raw: bool = False,
         compressed: bool = False,
@@ -227,26 +390,17 @@ class KackyReloaded_KackyRecords:
                 player.login,
                 player.uplay_nickname,
                 RANK() OVER (
-                    PARTITION BY localrecord.map_id
                     ORDER BY localrecord.score, localrecord.updated_at ASC
                 ) AS lb_rank
             FROM localrecord
             INNER JOIN player ON localrecord.player_id = player.id
-            INNER JOIN map ON map.id = localrecord.map_id
-            WHERE map.name LIKE ?
+            WHERE localrecord.map_id = ?
+            ORDER BY lb_rank
         """
-        import logging
-
-        a = logging.getLogger("KackyRecords")
         if positions > 0:
-            q += f"LIMIT {positions}"
-        a.debug(q)
-        a.debug((f"{kacky_id}{(f' [{version}]' if version else '')}",))
-        self.cursor.execute(
-            q + ";", (f"%#{kacky_id}{(f' [{version}]' if version else '')}",)
-        )
+            q += f"LIMIT {int(positions)}"
+        self.cursor.execute(q + ";", (map_id,))
         qres = self.cursor.fetchall()
-        a.debug(qres)
         if raw:
             return (
                 zlib.compress(json.dumps(qres, default=json_serial).encode())
@@ -258,6 +412,64 @@ class KackyReloaded_KackyRecords:
             raise ValueError("compression only work with raw values")
         return [{k: v for k, v in zip(keys, entry)} for entry in qres]
 
+    def get_map_leaderboard_page(
+        self, map_id: int, elems: int = 10, after: Optional[List[Any]] = None
+    ):
+        """
+        Keyset paginated map leaderboard, ordered by score, date and player id.
+
+        Parameters
+        ----------
+        map_id : int
+        elems : int
+            Page size
+        after : Optional[List[Any]]
+            Sort key (score, date, player id) of the last entry of the previous page,
+            as returned by this method. None for the first page.
+
+        Returns
+        -------
+        Tuple[List[Dict], Optional[List[Any]]]
+            Page entries and sort key for the next page (None on the last page)
+        """
+        q = """
+            SELECT
+                lr.score,
+                lr.updated_at,
+                player.nickname,
+                player.login,
+                player.uplay_nickname,
+                (
+                    SELECT COUNT(*) + 1
+                    FROM localrecord AS better
+                    WHERE better.map_id = lr.map_id
+                      AND (better.score < lr.score
+                           OR (better.score = lr.score AND better.updated_at < lr.updated_at))
+                ) AS lb_rank,
+                lr.player_id
+            FROM localrecord AS lr
+            INNER JOIN player ON lr.player_id = player.id
+            WHERE lr.map_id = ?
+        """
+        args = [map_id]
+        if after:
+            score, date, pid = after
+            q += """
+              AND (lr.score > ?
+                   OR (lr.score = ? AND (lr.updated_at > ?
+                                         OR (lr.updated_at = ? AND lr.player_id > ?))))
+            """
+            args += [score, score, date, date, pid]
+        q += " ORDER BY lr.score, lr.updated_at, lr.player_id LIMIT ?;"
+        args.append(elems)
+        self.cursor.execute(q, tuple(args))
+        qres = self.cursor.fetchall()
+        keys = ["score", "date", "nickname", "login", "uplay", "rank"]
+        page = [{k: v for k, v in zip(keys, entry)} for entry in qres]
+        if len(qres) < elems:
+            return page, None
+        return page, [qres[-1][0], qres[-1][1], qres[-1][6]]
+
 
 def datetimetostr(dictin):
     dictin["date"] = dictin["date"].strftime("%m/%d/%Y, %H:%M:%S")
@@ -268,6 +480,6 @@ def json_serial(obj):
     """JSON serializer for objects not serializable by default json code"""
     """https://stackoverflow.com/a/22238613"""
 
-    if isinstance(obj, (datetime)):
+    if isinstance(obj, (datetime.date, datetime.datetime)):
         return obj.isoformat()
     raise TypeError("Type %s not serializable" % type(obj))
@@ -0,0 +1,54 @@
+from typing import Iterator, List, Tuple
+
+
+class StreamedRows:
+    """
+    Rows of `stream_query`, fetched `chunk_size` at a time. The cursor is closed
+    once the rows are exhausted or `close` is called, also if no row was read yet
+    (a generator's finally would not run then).
+    """
+
+    def __init__(self, cursor, chunk_size: int):
+        self._cursor = cursor
+        self._chunk_size = chunk_size
+        self._chunk = iter(())
+
+    def __iter__(self) -> Iterator[Tuple]:
+        return self
+
+    def __next__(self) -> Tuple:
+        for row in self._chunk:
+            return row
+        if self._cursor is None:
+            raise StopIteration
+        chunk = self._cursor.fetchmany(self._chunk_size)
+        if not chunk:
+            self.close()
+            raise StopIteration
+        self._chunk = iter(chunk)
+        return next(self._chunk)
+
+    def close(self):
+        if self._cursor is not None:
+            self._cursor.close()
+            self._cursor = None
+
+
+def stream_query(
+    connection, query: str, args: Tuple, chunk_size: int = 1000
+) -> Tuple[List[str], StreamedRows]:
+    """
+    Runs `query` on an unbuffered cursor and hands the rows out in `chunk_size`
+    batches as they arrive from the server, so memory does not grow with the
+    result. The connection can not run other queries until the rows are exhausted
+    or closed.
+
+    Returns
+    -------
+    Tuple[List[str], StreamedRows]
+        column names and the rows
+    """
+    cursor = connection.cursor(buffered=False)
+    cursor.execute(query, args)
+    columns = [col[0] for col in cursor.description]
+    return columns, StreamedRows(cursor, chunk_size)
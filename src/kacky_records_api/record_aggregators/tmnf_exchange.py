@@ -1,8 +1,15 @@
 import datetime
 import logging
+from typing import Optional
 
 import requests
 
+from kacky_records_api.map_catalog import kacky_id_from_name
+from kacky_records_api.record_aggregators.circuit_breaker import (
+    CircuitOpen,
+    guarded_call,
+)
+
 
 class TmnfTmxApi:
     BASEURL = "https://tmnf.exchange/api/"
@@ -10,16 +17,37 @@ class TmnfTmxApi:
     def __init__(self, config):
         self._config = config
         self._logger = logging.getLogger(config["logger_name"])
+        self._timeout = config.get("tmx_request_timeout", 10)
+
+    def _request(self, url):
+        r = requests.get(url, timeout=self._timeout)
+        if r.status_code >= 500:
+            # server side trouble counts as failure, 4xx are our own fault
+            r.raise_for_status()
+        return r
+
+    def _get(self, endpoint: str, url: str) -> Optional[requests.Response]:
+        """
+        GET through the TMX circuit breakers. Returns None if the request failed or
+        was skipped because TMX (or this endpoint) is currently considered down.
+        """
+        try:
+            return guarded_call(
+                "tmx", endpoint, self._request, url, config=self._config
+            )
+        except CircuitOpen as e:
+            self._logger.debug(f"Skipping TMX request. {e}")
+        except requests.exceptions.RequestException as e:
+            self._logger.error(f"Error connecting to TMX! {e}")
+        return None
 
     def get_wr(self, tmxid):
         urn = (
             f"replays?trackId={tmxid}&best=1&count=1&fields=User.Name"
             "%2CReplayTime%2CPosition"
         )
-        try:
-            r = requests.get(self.BASEURL + urn, timeout=10)
-        except requests.exceptions.RequestException:
-            self._logger.error("Error connecting to TMX!")
+        r = self._get("replays", self.BASEURL + urn)
+        if r is None:
             return {}
         return r.json()
 
@@ -34,17 +62,13 @@ class TmnfTmxApi:
             "tracks?authoruserid=6655156&count=99999&fields=TrackId"
             "%2CTrackName%2CWRReplay.User.Name%2CWRReplay.ReplayTime"
         )
-        try:
-            r = requests.get(self.BASEURL + urn, timeout=10)
-        except requests.exceptions.RequestException:
-            self._logger.error("Error connecting to TMX!")
+        r = self._get("tracks", self.BASEURL + urn)
+        if r is None:
             return {}
         if raw:
             return r.json()
         return {
-            m["TrackName"]
-            .split("#")[1]
-            .replace("\u2013", "-"): {
+            kacky_id_from_name(m["TrackName"]): {
                 "tid": m["TrackId"],
                 "wrscore": m["WRReplay"]["ReplayTime"],
                 "wruser": m["WRReplay"]["User"]["Name"],
@@ -61,17 +85,13 @@ class TmnfTmxApi:
             "tracks?authoruserid=6655156&count=20&order1=10&fields=TrackId"
             "%2CTrackName%2CWRReplay.User.Name%2CWRReplay.ReplayTime%2CActivityAt"
         )
-        try:
-            r = requests.get(self.BASEURL + urn, timeout=10)
-        except requests.exceptions.RequestException:
-            self._logger.error("Error connecting to TMX!")
+        r = self._get("activity", self.BASEURL + urn)
+        if r is None:
             return {}
         if raw:
             return r.json()
         return {
-            m["TrackName"]
-            .split("#")[1]
-            .replace("\u2013", "-"): {
+            kacky_id_from_name(m["TrackName"]): {
                 "tid": m["TrackId"],
                 "wrscore": m["WRReplay"]["ReplayTime"],
                 "wruser": m["WRReplay"]["User"]["Name"],
@@ -84,10 +104,8 @@ class TmnfTmxApi:
         # https://tmnf.exchange/api/tracks?id=7255006&count=20&order1=10&
         # fields=TrackId%2CTrackName%2CWRReplay.User.Name%2CWRReplay.ReplayTime%2CActivityAt
         urn = f"tracks?id={map_id}&fields=WRReplay.User.Name%2CWRReplay.ReplayTime"
-        try:
-            r = requests.get(self.BASEURL + urn, timeout=10)
-        except requests.exceptions.RequestException:
-            self._logger.error("Error connecting to TMX!")
+        r = self._get("tracks", self.BASEURL + urn)
+        if r is None:
             return {}
         if raw:
             return r.json()
@@ -105,36 +123,31 @@ class TmnfTmxApi:
             "https://tmnf.exchange/api/tracks?authoruserid=6655156&"
             "count=1000&fields=TrackId%2CTrackName"
         )
-        try:
-            r = requests.get(kacky_maps, timeout=10)
-        except requests.exceptions.RequestException:
-            self._logger.error("Error connecting to TMX!")
+        r = self._get("tracks", kacky_maps)
+        if r is None:
             return {}
         return {
-            m["TrackName"].split("#")[1].replace("\u2013", "-"): m["TrackId"]
+            kacky_id_from_name(m["TrackName"]): m["TrackId"]
             for m in r.json()["Results"]
         }
 
     def get_map_dedimania_wr(self, tmxid, kacky_id=None):
         urn_dedi = f"tracks/dedimania?trackId={tmxid}&count=1&fields=Time,Login"
         urn_info = f"tracks?id={tmxid}&fields=TrackName%5B%5D"
-        try:
-            r_dedi = requests.get(self.BASEURL + urn_dedi, timeout=10)
-            if not kacky_id:
-                r_info = requests.get(self.BASEURL + urn_info, timeout=10)
-        except requests.exceptions.RequestException:
+        r_dedi = self._get("dedimania", self.BASEURL + urn_dedi)
+        r_info = None
+        if r_dedi is not None and not kacky_id:
+            r_info = self._get("tracks", self.BASEURL + urn_info)
+        if r_dedi is None or (r_info is None and not kacky_id):
             self._logger.error(
-                "Error connecting to TMX! Could not get Dedimania WR for tmxid = "
-                f"{tmxid}/{kacky_id}"
+                f"Could not get Dedimania WR for tmxid = {tmxid}/{kacky_id}"
             )
             return {}
         try:
             return {
                 kacky_id
                 if kacky_id
-                else r_info.json()["Results"][0]["TrackName"]
-                .split("#")[1]
-                .replace("\u2013", "-"): {
+                else kacky_id_from_name(r_info.json()["Results"][0]["TrackName"]): {
                     "tid": tmxid,
                     "wrscore": r_dedi.json()["Results"][0]["Time"],
                     "wruser": r_dedi.json()["Results"][0]["Login"],
@@ -0,0 +1,482 @@
+"""
+Local mirror of the KK and KR record databases. The game server databases also
+serve the live game servers, so with `record_mirror.serve_reads` set the API and
+the update jobs read the tables the aggregators query from a local copy (same table
+and column names, own indexes), and only the replicator reads the game servers.
+
+Tables are copied in batches along the id (full passes, new players and maps) or
+along (updated_at, id) (new and improved records) and upserted into the mirror. The
+watermarks live in the mirror and are written with every batch, an interrupted run
+resumes where it stopped.
+
+Runs as job of the updater (see `record_mirror` in config.yaml) or through the
+`kacky-records-mirror` console script.
+"""
+import argparse
+import contextlib
+import datetime
+import json
+import sys
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import mariadb
+
+from kacky_records_api import config, logger, secrets
+
+MIRROR_WATERMARKS_TABLE_QUERY = """
+    CREATE TABLE IF NOT EXISTS mirror_watermarks (
+        table_name VARCHAR(64) NOT NULL PRIMARY KEY,
+        pass_started DATETIME NULL,
+        pass_id BIGINT NULL,
+        synced_at DATETIME NULL,
+        changed_at DATETIME NULL
+    );
+"""
+
+
+class MirrorTable(NamedTuple):
+    name: str
+    # copied columns, the primary key `id` first
+    columns: Tuple[str, ...]
+    create_query: str
+    # records are improved in place, copied incrementally by (updated_at, id)
+    tracks_updates: bool
+
+
+# indexes follow the aggregator queries: ranks per map ordered by score and date,
+# lookups by login and uid, maps by edition and changes by updated_at
+MIRROR_TABLES = {
+    "KK": [
+        MirrorTable(
+            "records",
+            (
+                "id",
+                "challenge_id",
+                "challenge_uid",
+                "player_id",
+                "server_id",
+                "score",
+                "date",
+                "created_at",
+                "updated_at",
+            ),
+            """
+            CREATE TABLE IF NOT EXISTS records (
+                id BIGINT NOT NULL PRIMARY KEY,
+                challenge_id INT NULL,
+                challenge_uid VARCHAR(64) NULL,
+                player_id INT NULL,
+                server_id INT NULL,
+                score INT NULL,
+                date DATETIME NULL,
+                created_at DATETIME NULL,
+                updated_at DATETIME NULL,
+                INDEX idx_records_rank (challenge_id, score, date),
+                INDEX idx_records_wr (challenge_uid, score),
+                INDEX idx_records_player (player_id, challenge_id),
+                INDEX idx_records_updated (updated_at, id)
+            );
+            """,
+            True,
+        ),
+        MirrorTable(
+            "players",
+            ("id", "login", "nickname", "banned"),
+            """
+            CREATE TABLE IF NOT EXISTS players (
+                id BIGINT NOT NULL PRIMARY KEY,
+                login VARCHAR(64) NULL,
+                nickname VARCHAR(255) NULL,
+                banned TINYINT NULL,
+                INDEX idx_players_login (login)
+            );
+            """,
+            False,
+        ),
+        MirrorTable(
+            "challenges",
+            ("id", "uid", "name", "author", "edition"),
+            """
+            CREATE TABLE IF NOT EXISTS challenges (
+                id BIGINT NOT NULL PRIMARY KEY,
+                uid VARCHAR(64) NULL,
+                name VARCHAR(255) NULL,
+                author VARCHAR(255) NULL,
+                edition INT NULL,
+                INDEX idx_challenges_uid (uid),
+                INDEX idx_challenges_edition (edition)
+            );
+            """,
+            False,
+        ),
+    ],
+    "KR": [
+        MirrorTable(
+            "localrecord",
+            ("id", "map_id", "player_id", "score", "created_at", "updated_at"),
+            """
+            CREATE TABLE IF NOT EXISTS localrecord (
+                id BIGINT NOT NULL PRIMARY KEY,
+                map_id INT NULL,
+                player_id INT NULL,
+                score INT NULL,
+                created_at DATETIME NULL,
+                updated_at DATETIME NULL,
+                INDEX idx_localrecord_rank (map_id, score, updated_at),
+                INDEX idx_localrecord_player (player_id, map_id),
+                INDEX idx_localrecord_updated (updated_at, id)
+            );
+            """,
+            True,
+        ),
+        MirrorTable(
+            "player",
+            ("id", "login", "nickname", "uplay_nickname"),
+            """
+            CREATE TABLE IF NOT EXISTS player (
+                id BIGINT NOT NULL PRIMARY KEY,
+                login VARCHAR(64) NULL,
+                nickname VARCHAR(255) NULL,
+                uplay_nickname VARCHAR(255) NULL,
+                INDEX idx_player_uplay (uplay_nickname),
+                INDEX idx_player_login (login)
+            );
+            """,
+            False,
+        ),
+        MirrorTable(
+            "kackychallenges",
+            ("id", "uid", "name", "author", "edition"),
+            """
+            CREATE TABLE IF NOT EXISTS kackychallenges (
+                id BIGINT NOT NULL PRIMARY KEY,
+                uid VARCHAR(64) NULL,
+                name VARCHAR(255) NULL,
+                author VARCHAR(255) NULL,
+                edition INT NULL,
+                INDEX idx_kackychallenges_uid (uid),
+                INDEX idx_kackychallenges_edition (edition)
+            );
+            """,
+            False,
+        ),
+        # joined by the KR PB and map catalog queries
+        MirrorTable(
+            "map",
+            ("id", "uid", "name", "file"),
+            """
+            CREATE TABLE IF NOT EXISTS map (
+                id BIGINT NOT NULL PRIMARY KEY,
+                uid VARCHAR(64) NULL,
+                name VARCHAR(255) NULL,
+                file VARCHAR(255) NULL,
+                INDEX idx_map_uid (uid)
+            );
+            """,
+            False,
+        ),
+    ],
+}
+
+
+@contextlib.contextmanager
+def _batch(connection):
+    # one transaction on the mirror, like `DBConnection.transaction`
+    cursor = connection.cursor()
+    try:
+        yield cursor
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+def _login(secrets, prefix: str) -> Dict[str, str]:
+    return {
+        "host": secrets[f"{prefix}_host"],
+        "user": secrets[f"{prefix}_user"],
+        "passwd": secrets[f"{prefix}_passwd"],
+        "database": secrets[f"{prefix}_db"],
+    }
+
+
+def record_db_login(secrets, source: str) -> Dict[str, str]:
+    """
+    Connection arguments of the record database of `source` ("KK" or "KR") for
+    reads, the mirror if `record_mirror.serve_reads` is set.
+    """
+    mirror = config.get("record_mirror", {}).get("serve_reads", False)
+    return _login(secrets, source.lower() + ("mirror" if mirror else "db"))
+
+
+class _MirrorState(NamedTuple):
+    # remote time the running (or last) full pass started at
+    pass_started: Optional[datetime.datetime]
+    # last id copied by the running full pass, None if no pass is running
+    pass_id: Optional[int]
+    # start of the last complete full pass, None before the first one
+    synced_at: Optional[datetime.datetime]
+    # newest updated_at copied, for tables with `tracks_updates`
+    changed_at: Optional[datetime.datetime]
+
+
+class RecordMirror:
+    """Replicates the tables of one record database ("KK" or "KR") into its mirror."""
+
+    _schema_ready = set()
+
+    def __init__(self, config, secrets, source: str):
+        self._conf = config.get("record_mirror", {})
+        self._secrets = secrets
+        self._source = source.upper()
+        self._tables = MIRROR_TABLES[self._source]
+        self._batch_size = self._conf.get("batch_size", 5000)
+
+    def run(self) -> Dict[str, int]:
+        """
+        Brings every table of the mirror up to date.
+
+        Returns
+        -------
+        Dict[str, int]
+            table -> rows copied
+        """
+        prefix = self._source.lower()
+        remote = mariadb.connect(**_login(self._secrets, f"{prefix}db"))
+        # no snapshot held open on the game server DB between batches
+        remote.autocommit = True
+        mirror = mariadb.connect(**_login(self._secrets, f"{prefix}mirror"))
+        try:
+            self._ensure_schema(mirror)
+            return {
+                table.name: self._replicate(table, remote, mirror)
+                for table in self._tables
+            }
+        finally:
+            remote.close()
+            mirror.close()
+
+    def _ensure_schema(self, mirror):
+        if self._source in RecordMirror._schema_ready:
+            return
+        with _batch(mirror) as cursor:
+            cursor.execute(MIRROR_WATERMARKS_TABLE_QUERY)
+            for table in self._tables:
+                cursor.execute(table.create_query)
+        RecordMirror._schema_ready.add(self._source)
+
+    def _replicate(self, table: MirrorTable, remote, mirror) -> int:
+        state = self._state(mirror, table)
+        now = self._fetch(remote, "SELECT NOW();", ())[0][0]
+        if self._needs_full_pass(table, state, now):
+            return self._full_pass(table, remote, mirror, state, now)
+        if table.tracks_updates:
+            return self._copy_changed(table, remote, mirror, state)
+        return self._copy_new(table, remote, mirror)
+
+    def _needs_full_pass(
+        self, table: MirrorTable, state: _MirrorState, now: datetime.datetime
+    ) -> bool:
+        if state.synced_at is None or state.pass_id is not None:
+            return True
+        if table.tracks_updates:
+            # deleted records are only noticed by full passes
+            hours = self._conf.get("records_full_sync_hours", 24)
+            return bool(hours) and now - state.synced_at >= datetime.timedelta(
+                hours=hours
+            )
+        # players and maps have no updated_at, renames and bans need a full pass
+        minutes = self._conf.get("full_sync_minutes", 30)
+        return now - state.synced_at >= datetime.timedelta(minutes=minutes)
+
+    def _full_pass(
+        self,
+        table: MirrorTable,
+        remote,
+        mirror,
+        state: _MirrorState,
+        now: datetime.datetime,
+    ) -> int:
+        # copies the whole table along the id and drops the rows gone from the source
+        if state.pass_id is None:
+            started, after = now, 0
+        else:
+            started, after = state.pass_started, state.pass_id
+        copied = 0
+        while True:
+            rows = self._fetch(
+                remote,
+                f"SELECT {', '.join(table.columns)} FROM {table.name}"
+                " WHERE id > ? ORDER BY id LIMIT ?;",
+                (after, self._batch_size),
+            )
+            done = len(rows) < self._batch_size
+            with _batch(mirror) as cursor:
+                self._upsert(cursor, table, rows)
+                self._delete_gone(cursor, table, after, rows, done)
+                if done:
+                    values = {"pass_id": None, "synced_at": started}
+                    if state.changed_at is None:
+                        # changes made during the pass are read again
+                        values["changed_at"] = started
+                    self._save_state(cursor, table, **values)
+                else:
+                    self._save_state(
+                        cursor, table, pass_started=started, pass_id=rows[-1][0]
+                    )
+            copied += len(rows)
+            if done:
+                logger.info(f"mirror {table.name}: full pass copied {copied} rows")
+                return copied
+            after = rows[-1][0]
+
+    def _copy_changed(
+        self, table: MirrorTable, remote, mirror, state: _MirrorState
+    ) -> int:
+        # rows committed late can carry an updated_at just below the watermark
+        after_at = state.changed_at - datetime.timedelta(
+            seconds=self._conf.get("overlap_seconds", 5)
+        )
+        after_id = 0
+        updated = table.columns.index("updated_at")
+        copied = 0
+        while True:
+            rows = self._fetch(
+                remote,
+                f"SELECT {', '.join(table.columns)} FROM {table.name}"
+                " WHERE updated_at > ? OR (updated_at = ? AND id > ?)"
+                " ORDER BY updated_at, id LIMIT ?;",
+                (after_at, after_at, after_id, self._batch_size),
+            )
+            if not rows:
+                return copied
+            after_at, after_id = rows[-1][updated], rows[-1][0]
+            with _batch(mirror) as cursor:
+                self._upsert(cursor, table, rows)
+                self._save_state(
+                    cursor, table, changed_at=max(after_at, state.changed_at)
+                )
+            copied += len(rows)
+            if len(rows) < self._batch_size:
+                return copied
+
+    def _copy_new(self, table: MirrorTable, remote, mirror) -> int:
+        after = self._fetch(
+            mirror, f"SELECT COALESCE(MAX(id), 0) FROM {table.name};", ()
+        )[0][0]
+        copied = 0
+        while True:
+            rows = self._fetch(
+                remote,
+                f"SELECT {', '.join(table.columns)} FROM {table.name}"
+                " WHERE id > ? ORDER BY id LIMIT ?;",
+                (after, self._batch_size),
+            )
+            if not rows:
+                return copied
+            with _batch(mirror) as cursor:
+                self._upsert(cursor, table, rows)
+            copied += len(rows)
+            if len(rows) < self._batch_size:
+                return copied
+            after = rows[-1][0]
+
+    @staticmethod
+    def _fetch(connection, query: str, args: Tuple) -> List[Tuple]:
+        cursor = connection.cursor()
+        try:
+            cursor.execute(query, args)
+            return cursor.fetchall()
+        finally:
+            cursor.close()
+
+    @staticmethod
+    def _upsert(cursor, table: MirrorTable, rows: List[Tuple]):
+        if not rows:
+            return
+        cursor.executemany(
+            f"""
+            INSERT INTO {table.name} ({', '.join(table.columns)})
+            VALUES ({', '.join('?' * len(table.columns))})
+            ON DUPLICATE KEY UPDATE
+                {', '.join(f'{c} = VALUES({c})' for c in table.columns[1:])};
+            """,
+            rows,
+        )
+
+    @staticmethod
+    def _delete_gone(
+        cursor, table: MirrorTable, after: int, rows: List[Tuple], last: bool
+    ):
+        # ids between `after` and the end of the batch missing in it were deleted
+        query = f"DELETE FROM {table.name} WHERE id > ?"
+        args = [after]
+        if not last:
+            query += " AND id <= ?"
+            args.append(rows[-1][0])
+        if rows:
+            query += f" AND id NOT IN ({', '.join('?' * len(rows))})"
+            args += [r[0] for r in rows]
+        cursor.execute(query + ";", tuple(args))
+
+    def _state(self, mirror, table: MirrorTable) -> _MirrorState:
+        row = self._fetch(
+            mirror,
+            """
+            SELECT pass_started, pass_id, synced_at, changed_at
+            FROM mirror_watermarks WHERE table_name = ?;
+            """,
+            (table.name,),
+        )
+        return _MirrorState(*row[0]) if row else _MirrorState(None, None, None, None)
+
+    @staticmethod
+    def _save_state(cursor, table: MirrorTable, **values):
+        # written in the transaction of the batch it belongs to
+        columns = list(values)
+        cursor.execute(
+            f"""
+            INSERT INTO mirror_watermarks (table_name, {', '.join(columns)})
+            VALUES (?, {', '.join('?' * len(columns))})
+            ON DUPLICATE KEY UPDATE
+                {', '.join(f'{c} = VALUES({c})' for c in columns)};
+            """,
+            (table.name, *values.values()),
+        )
+
+
+def replicate_record_dbs(config, secrets):
+    for source in config.get("record_mirror", {}).get("sources", list(MIRROR_TABLES)):
+        copied = RecordMirror(config, secrets, source).run()
+        logger.debug(f"mirror {source}: {copied}")
+
+
+def main(args):
+    parser = argparse.ArgumentParser(
+        description="Kacky Records mirror of the record databases"
+    )
+    parser.add_argument(
+        "--sources",
+        default=",".join(MIRROR_TABLES),
+        help="comma separated record databases to replicate (default: all)",
+    )
+    parsed = parser.parse_args(args)
+
+    sources = [s.strip().upper() for s in parsed.sources.split(",") if s.strip()]
+    unknown = set(sources) - set(MIRROR_TABLES)
+    if unknown:
+        parser.error(f"unknown sources: {', '.join(sorted(unknown))}")
+
+    for source in sources:
+        copied = RecordMirror(config, secrets, source).run()
+        print(json.dumps({"source": source, "copied": copied}))
+
+
+def run():
+    main(sys.argv[1:])
+
+
+if __name__ == "__main__":
+    run()
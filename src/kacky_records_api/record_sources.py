@@ -0,0 +1,411 @@
+"""
+Sources of WR candidates for the update jobs. Every source fetches the raw data of
+one remote system in the format `update_records.iter_new_scores` expects for its
+`check_key`, so the update jobs can fetch all of their sources at once.
+"""
+import datetime
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime as dt
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+from nadeo_api import NadeoAPI
+
+from kacky_records_api.adaptive_scheduler import AdaptiveMapScheduler
+from kacky_records_api.map_catalog import MapCatalog, kacky_id_from_name
+from kacky_records_api.record_aggregators.circuit_breaker import (
+    CircuitOpen,
+    guarded_call,
+)
+from kacky_records_api.record_aggregators.kackiest_kacky_db import (
+    KackiestKacky_KackyRecords,
+)
+from kacky_records_api.record_aggregators.kacky_reloaded_db import (
+    KackyReloaded_KackyRecords,
+)
+from kacky_records_api.record_aggregators.tmnf_exchange import TmnfTmxApi
+
+SOURCES = ["KKDB", "KRDB", "DEDI", "TMX", "NADO"]
+
+
+def build_score(
+    score: int,
+    date: Union[str, dt],
+    source: str,
+    login: Union[str, None] = None,
+    nick: Union[str, None] = None,
+    tmx_id: Union[str, int, None] = None,
+    tm_uid: Union[str, None] = None,
+    kid: str = "",
+) -> Dict[str, Union[str, int]]:
+    # either tm_uid or tmx_id need to be set
+    if not (tm_uid or tmx_id):
+        raise ValueError("Need either tm_uid or tmx_id!")
+    # either login or nick need to be set
+    if not (login or nick):
+        raise ValueError("Need either tm_uid or tmx_id!")
+    # check if source value is legal
+    if source not in SOURCES:
+        raise ValueError("Bad value for source")
+    # build base result dict (missing tmx_id/tm_uid
+    res = {
+        "score": score,
+        "date": date if isinstance(date, str) else date.strftime("%Y-%m-%d %H:%M:%S"),
+        "source": source,
+    }
+    # add missing field for tmx_id XOR tm_uid or both
+    if tmx_id:
+        res["tmx_id"] = tmx_id if isinstance(tmx_id, str) else str(tmx_id)
+    if tm_uid:
+        res["tm_uid"] = tm_uid if isinstance(tm_uid, str) else str(tm_uid)
+    # add missing field for login XOR nick or both
+    if login:
+        res["login"] = login
+    if nick:
+        res["nick"] = nick
+    # add kacky id if given
+    if kid:
+        res["kid"] = kid if "#" not in kid else kacky_id_from_name(kid)
+    return res
+
+
+class RecordSource:
+    """
+    Base class of all sources. `fetch` runs in a worker thread of the collection
+    stage and is abandoned after `timeout` seconds (configured per source in
+    `record_sources`), `cancel` then tells it to stop at the next chance. `finalize`
+    runs in the job thread on the candidates that beat the stored WRs.
+    """
+
+    name = ""
+    check_key = ""
+    default_timeout = 30
+
+    def __init__(self, config, secrets):
+        self._config = config
+        self._secrets = secrets
+        self._logger = logging.getLogger(self._config["logger_name"])
+        self._conf = config.get("record_sources", {}).get(self.check_key, {})
+        self._cancelled = threading.Event()
+
+    @property
+    def enabled(self) -> bool:
+        return self._conf.get("enabled", True)
+
+    @property
+    def timeout(self) -> float:
+        return self._conf.get("timeout", self.default_timeout)
+
+    def fetch(self):
+        raise NotImplementedError
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def finalize(self, candidates: Iterable[Dict]) -> Iterable[Dict]:
+        return candidates
+
+
+class KackiestKackyDBSource(RecordSource):
+    name = "KKDB"
+    check_key = "kkdb"
+
+    def fetch(self):
+        return KackiestKacky_KackyRecords(self._secrets).get_recent_world_records(
+            datetime.datetime.now() - datetime.timedelta(days=7)
+        )
+
+
+class KackyReloadedDBSource(RecordSource):
+    name = "KRDB"
+    check_key = "krdb"
+
+    def fetch(self):
+        rows = KackyReloaded_KackyRecords(self._secrets).get_recent_world_records(
+            datetime.datetime.now() - datetime.timedelta(days=7)
+        )
+        return [
+            {
+                "tm_uid": r[0],
+                "kid": r[1],
+                "score": r[4],
+                "date": r[5],
+                "login": r[6],
+                "nick": r[7],
+            }
+            for r in rows
+        ]
+
+
+class TmxSource(RecordSource):
+    name = "TMX"
+    check_key = "tmx"
+    default_timeout = 15
+
+    def fetch(self):
+        return TmnfTmxApi(self._config).get_activity()
+
+
+class DedimaniaSource(RecordSource):
+    name = "DEDI"
+    check_key = "dedi"
+    default_timeout = 300
+
+    def fetch(self):
+        return TmnfTmxApi(self._config).get_all_kacky_dedimania_wrs()
+
+
+class NadeoSource(RecordSource):
+    """
+    WRs of the KR club campaigns from Nadeo. Which maps are polled is decided by
+    the `AdaptiveMapScheduler`, whose state outlives the single ticks. Players are
+    only resolved in `finalize`, i.e. for scores beating the stored WR, which saves
+    two API calls for every unchanged map.
+
+    Requests are charged to the budget of the scheduler. Callers outside the updater
+    (see `reconcile`) pass their own `spend` and only use the map level methods, the
+    scheduler is neither needed nor created for them.
+    """
+
+    name = "NADO"
+    check_key = "nado"
+    default_timeout = 60
+    # polling state of the KR maps, lives as long as the updater process
+    _scheduler = None
+    # nadeo_api sets no request timeouts, its calls run here and are abandoned
+    # after `nadeo_request_timeout` seconds
+    _executor = None
+    # authenticated client shared by all ticks, replaced before its tokens expire
+    _api_client = None
+    _api_expires = 0.0
+    _api_lock = threading.Lock()
+    # held by the running fetch, an abandoned one may still run into the next tick
+    _fetch_lock = threading.Lock()
+    # Ubisoft ticket plus the Nadeo core and live tokens
+    AUTH_REQUESTS = 3
+
+    def __init__(self, config, secrets, spend: Optional[Callable[[int], None]] = None):
+        super().__init__(config, secrets)
+        if spend is None and NadeoSource._scheduler is None:
+            NadeoSource._scheduler = AdaptiveMapScheduler(config, secrets)
+        self._spend = spend or NadeoSource._scheduler.spend
+        if NadeoSource._executor is None:
+            NadeoSource._executor = ThreadPoolExecutor(
+                max_workers=4, thread_name_prefix="nadeo"
+            )
+        self._polled = []
+        self._scores = {}
+
+    def _call(self, endpoint: str, func, *args, **kwargs):
+        return guarded_call(
+            "nadeo", endpoint, self._bounded, func, *args, config=self._config, **kwargs
+        )
+
+    def _bounded(self, func, *args, **kwargs):
+        # a timeout raises TimeoutError, which counts as failure for the breakers
+        future = NadeoSource._executor.submit(func, *args, **kwargs)
+        return future.result(timeout=self._config.get("nadeo_request_timeout", 10))
+
+    @property
+    def _api(self) -> NadeoAPI:
+        with NadeoSource._api_lock:
+            if time.monotonic() >= NadeoSource._api_expires:
+                NadeoSource._api_client = self._connect()
+                NadeoSource._api_expires = time.monotonic() + self._config.get(
+                    "nadeo_token_lifetime", 3000
+                )
+            return NadeoSource._api_client
+
+    def _connect(self) -> NadeoAPI:
+        try:
+            credentials = (
+                self._secrets["ubisoft_account"],
+                self._secrets["ubisoft_passwd"],
+                self._secrets["ubisoft-user-agent"],
+            )
+        except KeyError as ke:
+            raise ValueError("Bad Value for 'credentials_type' in secrets.yaml") from ke
+        self._logger.info("authenticating with Nadeo")
+        self._spend(self.AUTH_REQUESTS)
+        return self._call("auth", NadeoAPI, *credentials)
+
+    def _sync_campaigns(self):
+        self._logger.info("refreshing KR campaigns")
+        club_id = self._config["kacky_reloaded_club_id"]
+        live = self._api.nadeo_live_services
+        club_campaings = self._call("live", live.get_club_campaigns, club_id)
+        campaigns = []
+        for campaign in club_campaings:
+            campaing_info = self._call(
+                "live", live.get_campaign, club_id, campaign["campaignId"]
+            )
+            campaigns.append(
+                (
+                    campaign["campaignId"],
+                    campaing_info["name"],
+                    [p["mapUid"] for p in campaing_info["campaign"]["playlist"]],
+                )
+            )
+        self._spend(len(club_campaings) + 1)
+        self._scheduler.sync_campaigns(campaigns)
+
+    def fetch(self):
+        # the scheduler must not be changed by two fetches at once
+        if not NadeoSource._fetch_lock.acquire(blocking=False):
+            self._logger.warning("Skipping KR wr updates, last fetch still running.")
+            return []
+        try:
+            return self._fetch()
+        finally:
+            NadeoSource._fetch_lock.release()
+
+    def _fetch(self):
+        # authenticates before anything is polled, if the tokens are due
+        live = self._api.nadeo_live_services
+        if self._scheduler.campaigns_outdated() and not self._cancelled.is_set():
+            self._sync_campaigns()
+
+        due_maps = self._scheduler.due_maps()
+        if due_maps:
+            self._logger.info(f"updating KR wrs log for {len(due_maps)} maps")
+
+        candidates = []
+        for state in due_maps:
+            if self._cancelled.is_set():
+                # abandoned, the maps not polled stay due
+                break
+            mapscore_dbg = "uninitialized"
+            try:
+                self._spend(1)
+                mapscore_dbg = self._call(
+                    "live", live.get_worldrecord_for_map, state.tm_uid
+                )
+                self._polled.append(state)
+                mapscore = mapscore_dbg["tops"][0]["top"][0]
+            except IndexError:
+                # usually means no wr yet
+                continue
+            except CircuitOpen as e:
+                # Nadeo is down, the remaining maps stay due for the next tick
+                self._logger.warning(f"Skipping KR wr updates. {e}")
+                break
+            except Exception as e:
+                self._logger.error(f"Error in updating data from Nadeo! {e}")
+                self._logger.error(state.tm_uid)
+                self._logger.error(mapscore_dbg)
+                continue
+            self._scores[state.tm_uid] = mapscore
+            candidates.append({"score": mapscore["score"], "tm_uid": state.tm_uid})
+        return candidates
+
+    def _resolve_player(self, mapscore: Dict, tm_uid: str) -> Optional[Dict]:
+        player_dbg = "uninitialized"
+        try:
+            self._logger.debug(mapscore["accountId"])
+            webidentity = self._call(
+                "core",
+                self._api.nadeo_services.get_account_webidentities,
+                (mapscore["accountId"],),
+                merge_results=True,
+            )[0]
+            self._logger.debug(webidentity)
+            player_dbg = self._call(
+                "ubi",
+                self._api.ubisoft_services.get_player_profile,
+                webidentity["uplay_uid"],
+            )
+            self._logger.debug(player_dbg)
+            return player_dbg["profiles"][0]
+        except Exception as e:
+            self._logger.error(f"Error in resolving player from Nadeo! {e}")
+            self._logger.error(tm_uid)
+            self._logger.error(player_dbg)
+            return None
+
+    def get_map_scores(self, tm_uids: Iterable[str]) -> Iterator[Tuple[str, Dict]]:
+        """
+        Yields (tm_uid, raw Nadeo WR) of the given maps, bypassing the scheduler.
+        Maps without WR are skipped, stops early if Nadeo is down.
+        """
+        live = self._api.nadeo_live_services
+        for tm_uid in tm_uids:
+            try:
+                self._spend(1)
+                tops = self._call("live", live.get_worldrecord_for_map, tm_uid)
+                mapscore = tops["tops"][0]["top"][0]
+            except IndexError:
+                # no wr yet
+                continue
+            except CircuitOpen as e:
+                self._logger.warning(f"Skipping Nadeo wrs. {e}")
+                return
+            except Exception as e:
+                self._logger.error(f"Error in getting wr of {tm_uid} from Nadeo! {e}")
+                continue
+            yield tm_uid, mapscore
+
+    def build_map_wr(self, tm_uid: str, mapscore: Dict) -> Optional[Dict]:
+        """
+        Score (see `build_score`) of a raw Nadeo WR, None if its player could not
+        be resolved.
+        """
+        player = self._resolve_player(mapscore, tm_uid)
+        if player is None:
+            return None
+        self._spend(2)
+        return build_score(
+            mapscore["score"],
+            dt.now(),
+            "NADO",
+            login=player["nameOnPlatform"],
+            tm_uid=tm_uid,
+        )
+
+    def get_map_wrs(self, tm_uids: Iterable[str]) -> Dict[str, Dict]:
+        """
+        Current WRs of the given maps with resolved players, bypassing the
+        scheduler. Used to restore reset WRs.
+
+        Returns
+        -------
+        Dict[str, Dict]
+            tm_uid -> score (see `build_score`), maps without WR are missing
+        """
+        wrs = {}
+        for tm_uid, mapscore in self.get_map_scores(tm_uids):
+            wr = self.build_map_wr(tm_uid, mapscore)
+            if wr is not None:
+                wrs[tm_uid] = wr
+        return wrs
+
+    def finalize(self, candidates: Iterable[Dict]) -> List[Dict]:
+        improved = {c["tm_uid"] for c in candidates}
+        catalog = MapCatalog(self._config, self._secrets)
+        scores = []
+        for state in self._polled:
+            changed = state.tm_uid in improved
+            self._scheduler.mark_polled(state, changed=changed)
+            if not changed:
+                continue
+            mapscore = self._scores[state.tm_uid]
+            player = self._resolve_player(mapscore, state.tm_uid)
+            if player is None:
+                # poll again on the next tick
+                state.last_polled = 0.0
+                continue
+            self._spend(2)
+            entry = catalog.by_uid("KR", state.tm_uid)
+            scores.append(
+                build_score(
+                    mapscore["score"],
+                    dt.now(),
+                    "NADO",
+                    login=player["nameOnPlatform"],
+                    tm_uid=state.tm_uid,
+                    kid=entry.kacky_id if entry else "",
+                )
+            )
+        self._scheduler.persist(self._polled)
+        return scores
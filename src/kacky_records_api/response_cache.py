@@ -0,0 +1,384 @@
+import functools
+import sqlite3
+import threading
+import time
+import urllib.parse
+import zlib
+from typing import Callable, NamedTuple, Optional
+
+import flask
+
+from kacky_records_api import config, logger, secrets
+from kacky_records_api.data_versions import DataVersions
+from kacky_records_api.negotiation import JSON, Variant, encode, preferred_variant
+from kacky_records_api.single_flight import SingleFlight
+
+RESPONSES_TABLE_QUERY = """
+    CREATE TABLE IF NOT EXISTS cached_responses (
+        key TEXT PRIMARY KEY,
+        version INTEGER,
+        body BLOB NOT NULL,
+        status INTEGER NOT NULL,
+        mimetype TEXT NOT NULL,
+        created REAL NOT NULL,
+        fresh_until REAL NOT NULL,
+        expires REAL NOT NULL,
+        last_access REAL NOT NULL,
+        size INTEGER NOT NULL
+    );
+"""
+
+
+class CachedResponse(NamedTuple):
+    version: Optional[int]
+    body: bytes
+    status: int
+    mimetype: str
+    created: float
+    fresh_until: float
+
+    @property
+    def age(self) -> int:
+        return int(time.time() - self.created)
+
+
+class ResponseCache:
+    """
+    Response store shared by all gunicorn workers of one host. Backed by a SQLite
+    database in WAL mode, so readers in different processes do not block each
+    other. Every request key holds its last good response together with the data
+    version it was computed for. Entries are fresh for their TTL and kept for stale
+    serving until `expires`. Least recently used entries are evicted once the store
+    grows beyond `max_bytes`.
+    """
+
+    def __init__(self, path: str, max_bytes: int):
+        self._path = path
+        self._max_bytes = max_bytes
+        self._local = threading.local()
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite connections must not be shared between threads
+        con = getattr(self._local, "connection", None)
+        if con is None:
+            con = sqlite3.connect(self._path, timeout=5, isolation_level=None)
+            con.execute("PRAGMA journal_mode=WAL;")
+            con.execute("PRAGMA synchronous=NORMAL;")
+            con.execute(RESPONSES_TABLE_QUERY)
+            con.execute(
+                "CREATE INDEX IF NOT EXISTS idx_last_access "
+                "ON cached_responses (last_access);"
+            )
+            self._local.connection = con
+        return con
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        """
+        Returns the last good response for `key`, fresh or stale, as long as it
+        has not expired.
+        """
+        now = time.time()
+        row = (
+            self._connection()
+            .execute(
+                """
+                SELECT version, body, status, mimetype, created, fresh_until,
+                       expires, last_access
+                FROM cached_responses WHERE key = ?;
+                """,
+                (key,),
+            )
+            .fetchone()
+        )
+        if not row or row[6] < now:
+            return None
+        if now - row[7] > 1:
+            # LRU bookkeeping, at most one write per key and second
+            self._connection().execute(
+                "UPDATE cached_responses SET last_access = ? WHERE key = ?;",
+                (now, key),
+            )
+        return CachedResponse(*row[:6])
+
+    def set(
+        self,
+        key: str,
+        version: Optional[int],
+        body: bytes,
+        status: int,
+        mimetype: str,
+        ttl: float,
+        max_stale: float = 0,
+    ):
+        now = time.time()
+        con = self._connection()
+        con.execute(
+            """
+            INSERT OR REPLACE INTO cached_responses
+                (key, version, body, status, mimetype, created, fresh_until, expires,
+                 last_access, size)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?);
+            """,
+            (
+                key,
+                version,
+                body,
+                status,
+                mimetype,
+                now,
+                now + ttl,
+                now + max(ttl, max_stale),
+                now,
+                len(body) + len(key),
+            ),
+        )
+        self._evict(con, now)
+
+    def _evict(self, con: sqlite3.Connection, now: float):
+        total_query = "SELECT COALESCE(SUM(size), 0) FROM cached_responses;"
+        if con.execute(total_query).fetchone()[0] <= self._max_bytes:
+            return
+        con.execute("DELETE FROM cached_responses WHERE expires < ?;", (now,))
+        while con.execute(total_query).fetchone()[0] > self._max_bytes:
+            con.execute(
+                """
+                DELETE FROM cached_responses WHERE key IN (
+                    SELECT key FROM cached_responses ORDER BY last_access LIMIT 16
+                );
+                """
+            )
+
+
+_response_cache = None
+
+
+def get_response_cache() -> ResponseCache:
+    global _response_cache
+    if _response_cache is None:
+        cache_conf = config.get("response_cache", {})
+        _response_cache = ResponseCache(
+            cache_conf.get("path", "/tmp/kacky_records_api_cache.sqlite"),
+            cache_conf.get("max_mb", 64) * 1024 * 1024,
+        )
+    return _response_cache
+
+
+_single_flight = None
+
+
+def get_single_flight() -> SingleFlight:
+    global _single_flight
+    if _single_flight is None:
+        sf_conf = config.get("single_flight", {})
+        _single_flight = SingleFlight(
+            sf_conf.get("max_waiters", 64), sf_conf.get("timeout", 10)
+        )
+    return _single_flight
+
+
+def request_cache_key() -> str:
+    # route and arguments, independent of argument order
+    args = urllib.parse.urlencode(sorted(flask.request.args.items(multi=True)))
+    return f"{flask.request.path}?{args}"
+
+
+def cached_response(
+    ttl: float,
+    domain: Optional[Callable[..., str]] = None,
+    max_stale: Optional[float] = None,
+):
+    """
+    Makes the decorated GET route conditional and cached. Place below
+    `key_required`, so authentication is always checked.
+
+    Responses carry an ETag built from the data version of `domain` and the request.
+    A matching If-None-Match is answered with 304 without touching the database.
+    Successful responses are kept in the shared response cache. Concurrent
+    identical requests missing the cache are coalesced into one computation.
+
+    Outdated responses (TTL passed or data version bumped) younger than `max_stale`
+    are served right away with their `Age`, while a background thread recomputes
+    them. Slow record databases thus do not hold up request threads.
+
+    Parameters
+    ----------
+    ttl : float
+        Seconds a response is served from cache without revalidation
+    domain : Optional[Callable[..., str]]
+        Called with the view arguments, returns the data version domain of the
+        response. None to rely on the TTL only.
+    max_stale : Optional[float]
+        Seconds since computation an outdated response may still be served.
+        Defaults to `response_cache.max_stale` of the config, 0 disables.
+    """
+    if max_stale is None:
+        max_stale = config.get("response_cache", {}).get("max_stale", 0)
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if flask.request.method != "GET":
+                return func(*args, **kwargs)
+            try:
+                version = (
+                    DataVersions(config, secrets).current(domain(**kwargs))
+                    if domain
+                    else None
+                )
+            except ValueError:
+                # malformed view arguments, let the route report them
+                return func(*args, **kwargs)
+            request_key = request_cache_key()
+            etag = _etag(version, request_key)
+            if etag and _matches_variant(etag):
+                return _with_etag(flask.Response(status=304), etag)
+            cache_enabled = config.get("response_cache", {}).get("enabled", True)
+            flight_key = f"{request_key}@{version}"
+
+            def compute():
+                response = flask.make_response(func(*args, **kwargs))
+                body = response.get_data()
+                if cache_enabled and response.status_code == 200:
+                    try:
+                        get_response_cache().set(
+                            request_key,
+                            version,
+                            body,
+                            response.status_code,
+                            response.mimetype,
+                            ttl,
+                            max_stale,
+                        )
+                    except sqlite3.Error as e:
+                        logger.error(f"Writing response cache failed! {e}")
+                return body, response.status_code, response.mimetype
+
+            hit = None
+            if cache_enabled:
+                try:
+                    hit = get_response_cache().get(request_key)
+                except sqlite3.Error as e:
+                    logger.error(f"Reading response cache failed! {e}")
+            if hit and hit.version == version and hit.fresh_until >= time.time():
+                flask.g.cached_body = (request_key, hit, ttl, max_stale)
+                return _cached(hit, "HIT", etag)
+            if hit and hit.age <= max_stale:
+                _refresh_in_background(flight_key, compute)
+                flask.g.cached_body = (request_key, hit, ttl, max_stale)
+                # the stale body belongs to the version it was computed for
+                return _cached(hit, "STALE", _etag(hit.version, request_key))
+
+            # identical requests arriving together share one computation
+            computed_at = time.time()
+            body, status, mimetype = get_single_flight().do(flight_key, compute)
+            if cache_enabled:
+                flask.g.cached_body = (
+                    request_key,
+                    CachedResponse(version, body, status, mimetype, computed_at, 0),
+                    ttl,
+                    max_stale,
+                )
+            response = flask.Response(body, status, mimetype=mimetype)
+            response.headers["X-Cache"] = "MISS"
+            return _with_etag(response, etag)
+
+        return wrapper
+
+    return decorator
+
+
+def _refresh_in_background(flight_key: str, compute: Callable):
+    if get_single_flight().in_flight(flight_key):
+        return
+
+    def refresh():
+        try:
+            get_single_flight().do(flight_key, compute)
+        except Exception as e:
+            logger.error(f"Background refresh of {flight_key} failed! {e}")
+
+    threading.Thread(
+        target=flask.copy_current_request_context(refresh), daemon=True
+    ).start()
+
+
+def _cached(hit: CachedResponse, state: str, etag: Optional[str]) -> flask.Response:
+    response = flask.Response(hit.body, hit.status, mimetype=hit.mimetype)
+    response.headers["Age"] = str(hit.age)
+    response.headers["X-Cache"] = state
+    return _with_etag(response, etag)
+
+
+def _etag(version: Optional[int], request_key: str) -> Optional[str]:
+    if version is None:
+        return None
+    return f"{version}-{zlib.crc32(request_key.encode()):08x}"
+
+
+def _with_etag(response: flask.Response, etag: Optional[str]) -> flask.Response:
+    if etag and response.status_code in (200, 304):
+        response.set_etag(etag)
+        # clients may keep the response, but have to revalidate before using it
+        response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
+def _matches_variant(etag: str) -> bool:
+    # responses are tagged per variant, see `negotiate_response`
+    variant = preferred_variant(flask.request)
+    return any(
+        flask.request.if_none_match.contains(v.etag(etag))
+        for v in (variant, Variant(variant.mimetype, None))
+    )
+
+
+def _variant_body(body: bytes, variant: Variant) -> bytes:
+    # variants of cached responses are cached next to them, under their own key
+    cached_body = flask.g.get("cached_body")
+    if not cached_body or not config.get("response_cache", {}).get("enabled", True):
+        return encode(body, variant, config)
+    request_key, base, ttl, max_stale = cached_body
+    variant_key = f"{request_key}#{variant.name}"
+    try:
+        hit = get_response_cache().get(variant_key)
+        if hit and hit.version == base.version and hit.created >= base.created:
+            return hit.body
+        encoded = encode(body, variant, config)
+        get_response_cache().set(
+            variant_key, base.version, encoded, 200, variant.mimetype, ttl, max_stale
+        )
+        return encoded
+    except sqlite3.Error as e:
+        logger.error(f"Response cache of variant {variant_key} failed! {e}")
+        return encode(body, variant, config)
+
+
+def negotiate_response(response: flask.Response) -> flask.Response:
+    """
+    `after_request` hook converting JSON responses to the representation and
+    compression the client asked for. Bodies below `compression.min_bytes` are
+    not compressed. Views serving pre-encoded variants set `flask.g.negotiated`.
+    """
+    if (
+        flask.g.get("negotiated")
+        or response.status_code != 200
+        or response.is_streamed
+        or response.mimetype != JSON
+        or "Content-Encoding" in response.headers
+    ):
+        return response
+    response.vary.update(("Accept", "Accept-Encoding"))
+    variant = preferred_variant(flask.request)
+    body = response.get_data()
+    if len(body) < config.get("compression", {}).get("min_bytes", 1024):
+        variant = Variant(variant.mimetype, None)
+    if variant.is_identity:
+        return response
+    response.set_data(_variant_body(body, variant))
+    response.mimetype = variant.mimetype
+    if variant.encoding:
+        response.headers["Content-Encoding"] = variant.encoding
+    etag, _ = response.get_etag()
+    if etag:
+        response.set_etag(variant.etag(etag))
+    return response
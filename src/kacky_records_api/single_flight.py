@@ -0,0 +1,85 @@
+import threading
+from typing import Any, Callable, Dict, Hashable
+
+
+class SingleFlightError(Exception):
+    pass
+
+
+class TooManyWaiters(SingleFlightError):
+    pass
+
+
+class CoalescingTimeout(SingleFlightError):
+    pass
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key. The first caller runs the
+    computation, every other caller arriving while it is in flight waits for it and
+    shares its result (or exception, `SingleFlightError` if it was aborted by a
+    `BaseException`).
+
+    Parameters
+    ----------
+    max_waiters : int
+        Callers allowed to wait for one in-flight computation. Further callers get
+        `TooManyWaiters`.
+    timeout : float
+        Seconds a waiting caller blocks before giving up with `CoalescingTimeout`.
+        The computation itself is not interrupted.
+    """
+
+    def __init__(self, max_waiters: int = 64, timeout: float = 10):
+        self._max_waiters = max_waiters
+        self._timeout = timeout
+        self._calls: Dict[Hashable, _Call] = {}
+        self._lock = threading.Lock()
+
+    def in_flight(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._calls
+
+    def do(self, key: Hashable, func: Callable[[], Any]) -> Any:
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = _Call()
+                self._calls[key] = call
+                leader = True
+            else:
+                if call.waiters >= self._max_waiters:
+                    raise TooManyWaiters(f"{call.waiters} requests waiting for {key}")
+                call.waiters += 1
+                leader = False
+
+        if not leader:
+            if not call.done.wait(self._timeout):
+                raise CoalescingTimeout(f"Timed out waiting for {key}")
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func()
+        except BaseException as e:
+            # e.g. SystemExit of the aggregators, the waiters must not get None
+            if isinstance(e, Exception):
+                call.error = e
+            else:
+                call.error = SingleFlightError(f"Computation of {key} aborted: {e!r}")
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
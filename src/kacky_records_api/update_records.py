@@ -1,188 +1,174 @@
+import itertools
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime as dt
-from threading import Lock
-from typing import Dict, Union
+from typing import Dict, Iterable, Iterator, List
 
-from nadeo_api import NadeoAPI
 from tmformatresolver import TMString
 
 from kacky_records_api import logger
+from kacky_records_api.data_versions import (
+    EVENTS_DOMAIN,
+    DataVersions,
+    leaderboard_domain,
+    pbs_domain,
+    records_domain,
+    wrs_domain,
+)
 from kacky_records_api.db_operators.operators import DBConnection
+from kacky_records_api.map_catalog import MapCatalog, build_catalog_entry
 from kacky_records_api.record_aggregators.kackiest_kacky_db import (
     KackiestKacky_KackyRecords,
 )
-
-# TODO use kacky_records_api.record_aggregators.kacky_reloaded_db.KackyReloaded_KackyRecords
+from kacky_records_api.record_aggregators.kacky_reloaded_db import (
+    KackyReloaded_KackyRecords,
+)
 from kacky_records_api.record_aggregators.tmnf_exchange import TmnfTmxApi
+from kacky_records_api.record_sources import (
+    DedimaniaSource,
+    KackiestKackyDBSource,
+    KackyReloadedDBSource,
+    NadeoSource,
+    RecordSource,
+    TmxSource,
+    build_score,
+)
+from kacky_records_api.wr_history import record_wr_history, sync_wr_history
+from kacky_records_api.wr_stream import record_wr_event
 
 kackiest_update_counter = 1
-reloaded_update_counter = 4
-reloaded_update_counter_onlyevent = 1
-kackiest_kacky_lock = Lock()
-kacky_reloaded_lock = Lock()
-kacky_reloaded_lock_onlyevent = Lock()
-
-
-def build_score(
-    score: int,
-    date: Union[str, dt],
-    source: str,
-    login: Union[str, None] = None,
-    nick: Union[str, None] = None,
-    tmx_id: Union[str, int, None] = None,
-    tm_uid: Union[str, None] = None,
-    kid: str = "",
-) -> Dict[str, Union[str, int]]:
-    # either tm_uid or tmx_id need to be set
-    if not (tm_uid or tmx_id):
-        raise ValueError("Need either tm_uid or tmx_id!")
-    # either login or nick need to be set
-    if not (login or nick):
-        raise ValueError("Need either tm_uid or tmx_id!")
-    # check if source value is legal
-    if source not in ["KKDB", "KRDB", "DEDI", "TMX", "NADO"]:
-        raise ValueError("Bad value for source")
-    # build base result dict (missing tmx_id/tm_uid
-    res = {
-        "score": score,
-        "date": date if isinstance(date, str) else date.strftime("%Y-%m-%d %H:%M:%S"),
-        "source": source,
-    }
-    # add missing field for tmx_id XOR tm_uid or both
-    if tmx_id:
-        res["tmx_id"] = tmx_id if isinstance(tmx_id, str) else str(tmx_id)
-    if tm_uid:
-        res["tm_uid"] = tm_uid if isinstance(tm_uid, str) else str(tm_uid)
-    # add missing field for login XOR nick or both
-    if login:
-        res["login"] = login
-    if nick:
-        res["nick"] = nick
-    # add kacky id if given
-    if kid:
-        res["kid"] = kid if "#" not in kid else kid.split("#")[1].replace("\u2013", "-")
-    return res
-
-
-def check_new_scores(candidates, src: str, config, secrets):
-    update_elements = []
 
-    # set up connection to backend database
-    backend_db = DBConnection(config, secrets)
 
-    basequery = """
-                SELECT worldrecords.id
-                FROM worldrecords
-                LEFT JOIN maps
-                ON worldrecords.map_id = maps.id
-                WHERE score > ? AND maps.
-                """
+def chunked(iterable: Iterable, size: int) -> Iterator[List]:
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def map_key_column(score: Dict) -> str:
+    # same rule as in write_wr_to_db: TMX ids win over uids
+    return "tmx_id" if "tmx_id" in score else "tm_uid"
+
+
+def _parse_tmx_date(data) -> dt:
+    if "lastactivity" not in data:
+        return dt.fromtimestamp(0)
+    try:
+        return dt.strptime(data["lastactivity"], "%Y-%m-%dT%H:%M:%S.%f")
+    except ValueError:
+        # This can happen if uploaded on 0th millisec - .%f does not exist in that case
+        return dt.strptime(data["lastactivity"], "%Y-%m-%dT%H:%M:%S")
+
+
+def candidate_scores(candidates, src: str) -> Iterator[Dict]:
+    """
+    Turns the raw output of a source into score dicts (see `build_score`), lazily.
+    NADO candidates are passed through, their player is resolved later.
+    """
     if src == "tmx":
-        query = basequery + "tmx_id = ?;"
         for kid, data in candidates.items():
-            check_score = backend_db.fetchall(query, (data["wrscore"], data["tid"]))
-            if check_score:
-                try:
-                    date = (
-                        dt.strptime(data["lastactivity"], "%Y-%m-%dT%H:%M:%S.%f")
-                        if "lastactivity" in data
-                        else dt.fromtimestamp(0)
-                    )
-                except ValueError:
-                    # This can happen if uploaded on 0th millisec - .%f does not exist in that case
-                    date = (
-                        dt.strptime(data["lastactivity"], "%Y-%m-%dT%H:%M:%S")
-                        if "lastactivity" in data
-                        else dt.fromtimestamp(0)
-                    )
-                update_elements.append(
-                    build_score(
-                        data["wrscore"],
-                        date,
-                        "TMX",
-                        nick=data["wruser"],
-                        tmx_id=data["tid"],
-                        kid=kid,
-                    )
-                )
+            yield build_score(
+                data["wrscore"],
+                _parse_tmx_date(data),
+                "TMX",
+                nick=data["wruser"],
+                tmx_id=data["tid"],
+                kid=kid,
+            )
     elif src == "kkdb":
-        query = basequery + "tm_uid = ?;"
         for candidate in candidates:
-            check_score = backend_db.fetchall(query, (candidate[4], candidate[0]))
-            if check_score:
-                update_elements.append(
-                    build_score(
-                        candidate[4],
-                        candidate[5],
-                        "KKDB",
-                        login=candidate[6],
-                        nick=candidate[7],
-                        tm_uid=candidate[0],
-                        kid=candidate[1],
-                    )
-                )
+            yield build_score(
+                candidate[4],
+                candidate[5],
+                "KKDB",
+                login=candidate[6],
+                nick=candidate[7],
+                tm_uid=candidate[0],
+                kid=candidate[1],
+            )
     elif src == "dedi":
-        query = basequery + "tmx_id = ?;"
         for kid, data in candidates.items():
-            check_score = backend_db.fetchall(query, (data["wrscore"], data["tid"]))
-            if check_score:
-                date = (
-                    dt.strptime(data["lastactivity"], "%Y-%m-%d %H:%M:%S")
-                    if "lastactivity" in data
-                    else dt.fromtimestamp(0)
-                )
-                update_elements.append(
-                    build_score(
-                        data["wrscore"],
-                        date,
-                        "DEDI",
-                        nick=data["wruser"],
-                        tmx_id=data["tid"],
-                        kid=kid,
-                    )
-                )
+            date = (
+                dt.strptime(data["lastactivity"], "%Y-%m-%d %H:%M:%S")
+                if "lastactivity" in data
+                else dt.fromtimestamp(0)
+            )
+            yield build_score(
+                data["wrscore"],
+                date,
+                "DEDI",
+                nick=data["wruser"],
+                tmx_id=data["tid"],
+                kid=kid,
+            )
     elif src == "krdb":
-        query = basequery + "tm_uid = ?;"
         for candidate in candidates:
             logger.debug(candidate)
-            check_score = backend_db.fetchall(
-                query, (candidate["score"], candidate["tm_uid"])
+            yield build_score(
+                candidate["score"],
+                candidate["date"],
+                "KRDB",
+                login=candidate.get("login", ""),
+                nick=candidate.get("nick", ""),
+                tm_uid=candidate["tm_uid"],
+                kid=candidate["kid"],
             )
-            logger.debug(check_score)
-            if check_score:
-                update_elements.append(
-                    build_score(
-                        candidate["score"],
-                        candidate["date"],
-                        "KRDB",
-                        login=candidate.get("login", ""),
-                        nick=candidate.get("nick", ""),
-                        tm_uid=candidate["tm_uid"],
-                        kid=candidate["kid"],
-                    )
-                )
     elif src == "nado":
-        query = basequery + "tm_uid = ?;"
-        for candidate in candidates:
-            check_score = backend_db.fetchall(
-                query, (candidate["score"], candidate["tm_uid"])
-            )
-            if check_score:
-                update_elements.append(candidate)
-    return update_elements
+        yield from candidates
+
+
+def iter_new_scores(candidates, src: str, config, secrets) -> Iterator[Dict]:
+    """
+    Yields the candidates of source `src` beating the stored WR of their map. The
+    candidates are checked in chunks of `wr_check_chunk_size` with one query per
+    chunk, results are yielded as soon as their chunk is checked.
+    """
+    # set up connection to backend database
+    backend_db = DBConnection(config, secrets)
+
+    chunk_size = config.get("wr_check_chunk_size", 100)
+    for chunk in chunked(candidate_scores(candidates, src), chunk_size):
+        for key in ("tmx_id", "tm_uid"):
+            keyed = [c for c in chunk if map_key_column(c) == key]
+            if not keyed:
+                continue
+            stored = {}
+            for map_key, score in backend_db.fetchall(
+                f"""
+                SELECT maps.{key}, worldrecords.score
+                FROM worldrecords
+                LEFT JOIN maps
+                ON worldrecords.map_id = maps.id
+                WHERE maps.{key} IN ({", ".join("?" * len(keyed))});
+                """,
+                tuple(c[key] for c in keyed),
+            ):
+                stored[str(map_key)] = max(score, stored.get(str(map_key), score))
+            for candidate in keyed:
+                if candidate["score"] < stored.get(str(candidate[key]), -1):
+                    yield candidate
+
+
+def check_new_scores(candidates, src: str, config, secrets) -> List[Dict]:
+    return list(iter_new_scores(candidates, src, config, secrets))
 
 
 def dedup_new_scores(candidates):
     # stole stuff from https://stackoverflow.com/a/9835819
     # quick check for duplicates
-    check_lst = list(map(lambda c: c["kid"], candidates))
+    check_lst = list(map(lambda c: c.get("kid"), candidates))
     seen = set()
     dupes = [x for x in check_lst if x in seen or seen.add(x)]
-    dupes = list(set(dupes))
+    # candidates without kacky id cannot be matched across sources
+    dupes = list(set(dupes) - {None})
     best_score = {}
     weak_elements = []
     for d in dupes:
         for cand in candidates:
-            if d == cand["kid"]:
+            if d == cand.get("kid"):
                 # kacky track length limited to 10 min
                 if cand["score"] == best_score.get("score", 15 * 60 * 1000):
                     # want earliest date
@@ -207,19 +193,27 @@ def dedup_new_scores(candidates):
     return candidates
 
 
-def write_wr_to_db(db_cursor, this_new_wr):
+def write_wr_to_db(db_cursor, this_new_wr, version: int):
     logger.info(f"updating in DB: {this_new_wr}")
     # get old date
     query = f"""
-                SELECT date, login, nickname
+                SELECT date, login, nickname, events.type, events.edition, wr.score,
+                       wr.map_id, maps.kacky_id, maps.kackyevent
                 FROM worldrecords AS wr
                 LEFT JOIN maps ON wr.map_id = maps.id
+                LEFT JOIN events ON maps.kackyevent = events.id
                 WHERE maps.{'tmx_id' if 'tmx_id' in this_new_wr else 'tm_uid'} = ?
+                FOR UPDATE
             """
-    old_data = db_cursor.fetchall(
+    db_cursor.execute(
         query,
         (this_new_wr["tmx_id"] if "tmx_id" in this_new_wr else this_new_wr["tm_uid"],),
-    )[0]
+    )
+    old_data = db_cursor.fetchall()[0]
+    if this_new_wr["score"] >= old_data[5]:
+        # beaten or matched by a candidate written in an earlier batch
+        logger.info("stored wr is as good, skipping")
+        return None
     # days_diff = abs(
     #     dt.strptime(this_new_wr["date"], "%Y-%m-%d %H:%M:%S") - old_data[0]
     # ).days
@@ -268,247 +262,307 @@ def write_wr_to_db(db_cursor, this_new_wr):
             this_new_wr["tmx_id"] if "tmx_id" in this_new_wr else this_new_wr["tm_uid"],
         ),
     )
+    # outbox for the WR stream, committed together with the WR
+    record_wr_event(
+        db_cursor,
+        old_data[3],
+        old_data[4],
+        old_data[6],
+        old_data[7],
+        this_new_wr,
+        former=(old_data[5], old_data[1], old_data[2], old_data[0]),
+    )
+    record_wr_history(db_cursor, old_data[6], old_data[8], this_new_wr, version)
+    # data version domain of the changed event
+    return wrs_domain(old_data[3], old_data[4])
 
 
-def update_wrs_kackiest_kacky(config, secrets):
-    kackiest_kacky_lock.acquire(timeout=2)
-    if not kackiest_kacky_lock:
-        logger.error("Could not update wrs. Failed to acquire updating_records_lock!")
+def collect_candidates(sources: List[RecordSource], config, secrets) -> Iterator[Dict]:
+    """
+    Fetches all enabled sources at once and yields the scores beating the stored
+    WRs, source by source in the order they answer. A source failing or exceeding
+    its timeout is skipped for this tick, the others are not held up by it (its
+    worker thread is abandoned and cancelled, not killed).
+    """
+    sources = [src for src in sources if src.enabled]
+    if not sources:
         return
-    global kackiest_update_counter
+    executor = ThreadPoolExecutor(
+        max_workers=len(sources), thread_name_prefix="record_source"
+    )
+    start = time.monotonic()
+    deadlines = {
+        executor.submit(src.fetch): (src, start + src.timeout) for src in sources
+    }
+    executor.shutdown(wait=False)
+
+    pending = set(deadlines)
+    while pending:
+        now = time.monotonic()
+        for future in [f for f in pending if deadlines[f][1] <= now and not f.done()]:
+            src = deadlines[future][0]
+            logger.error(f"{src.name}: no response within {src.timeout}s, skipped")
+            src.cancel()
+            pending.discard(future)
+        if not pending:
+            return
+        done, _ = wait(
+            pending,
+            timeout=max(min(deadlines[f][1] for f in pending) - now, 0),
+            return_when=FIRST_COMPLETED,
+        )
+        for future in done:
+            pending.discard(future)
+            src = deadlines[future][0]
+            try:
+                data = future.result()
+            except (Exception, SystemExit) as e:
+                # the aggregators exit() on connection errors
+                logger.error(f"{src.name}: fetching records failed! {e!r}")
+                continue
+            logger.debug(f"{src.name}: fetched in {time.monotonic() - start:.1f}s")
+            yield from src.finalize(
+                iter_new_scores(data, src.check_key, config, secrets)
+            )
 
-    logger.info("updating KK wrs log")
-    kk_upd = KackiestKacky_KackyRecords(secrets)
-    tmx_upd = TmnfTmxApi(config)
-
-    recent_wrs_kk_db = kk_upd.get_recent_world_records()
-    # recent_wrs_kk_db = kk_upd.get_all_world_records()
-    recent_wrs_kk_tmx = tmx_upd.get_activity()
-    # all_tmx = tmx_upd.get_kacky_wrs()
-    # every 10 min check dedimania records
-    # if kackiest_update_counter == config["tmx_update_frequency"] - 1:
-    #     all_dedi_wrs = tmx_upd.get_all_kacky_dedimania_wrs()
-    # else:
-    #     all_dedi_wrs = {}
-
-    update_wrs_kk = []
-    update_wrs_kk += check_new_scores(recent_wrs_kk_db, "kkdb", config, secrets)
-    update_wrs_kk += check_new_scores(recent_wrs_kk_tmx, "tmx", config, secrets)
-    # update_wrs_kk += check_new_scores(all_tmx, "tmx", config, secrets)
-    # update_wrs_kk += check_new_scores(all_dedi_wrs, "dedi", config, secrets)
-    update_wrs_kk_dedup = dedup_new_scores(update_wrs_kk)
 
+def write_new_wrs(candidates: Iterable[Dict], config, secrets):
+    """
+    Writes new WRs in micro-batches of `wr_write_batch_size` as they come in. Every
+    batch is deduplicated, written in one transaction and published (data version
+    bump) right away, so the first WRs of a large sweep don't wait for the rest.
+    """
     # set up connection to backend database
     backend_db = DBConnection(config, secrets)
 
-    for new_wr in update_wrs_kk_dedup:
-        write_wr_to_db(backend_db, new_wr)
+    versions = DataVersions(config, secrets)
+    for batch in chunked(candidates, config.get("wr_write_batch_size", 20)):
+        update_scores = dedup_new_scores(batch)
+        logger.debug(update_scores)
+        with backend_db.transaction() as cursor:
+            # serializes the outbox writers, event ids are committed in order
+            version = versions.begin_write(cursor)
+            changed_domains = [
+                write_wr_to_db(cursor, new_wr, version) for new_wr in update_scores
+            ]
+            versions.stamp(cursor, version, *(d for d in changed_domains if d))
 
-    kackiest_update_counter = (kackiest_update_counter + 1) % 10
-    kackiest_kacky_lock.release()
 
+def update_wrs_kackiest_kacky(config, secrets):
+    # overlapping runs are prevented by the job runner (see job_runner.SingleFlightJob)
+    global kackiest_update_counter
 
-def update_wrs_kacky_reloaded(
-    config, secrets, excluded_event: int = None, only_event: int = None
-):
-    if not only_event:
-        kacky_reloaded_lock.acquire(timeout=2)
-        if not kacky_reloaded_lock:
-            logger.error("Could not update wrs. Failed to acquire kacky_reloaded_lock!")
-            return
-    if only_event:
-        kacky_reloaded_lock_onlyevent.acquire(timeout=2)
-        if not kacky_reloaded_lock_onlyevent:
-            logger.error(
-                "Could not update wrs. Failed to acquire kacky_reloaded_lock_onlyevent!"
-            )
-            return
-    global reloaded_update_counter, reloaded_update_counter_onlyevent
+    logger.info("updating KK wrs log")
+    sources = [
+        KackiestKackyDBSource(config, secrets),
+        TmxSource(config, secrets),
+    ]
+    # every tmx_update_frequency minutes check dedimania records
+    if kackiest_update_counter == config["tmx_update_frequency"] - 1:
+        sources.append(DedimaniaSource(config, secrets))
 
-    logger.info("updating KR wrs log")
+    write_new_wrs(collect_candidates(sources, config, secrets), config, secrets)
 
-    try:
-        tm20_api = NadeoAPI(
-            secrets["ubisoft_account"],
-            secrets["ubisoft_passwd"],
-            secrets["ubisoft-user-agent"],
-        )
-    except KeyError as ke:
-        raise ValueError("Bad Value for 'credentials_type' in secrets.yaml") from ke
+    kackiest_update_counter = (kackiest_update_counter + 1) % 10
 
-    club_campaings = tm20_api.nadeo_live_services.get_club_campaigns(
-        config["kacky_reloaded_club_id"]
-    )
 
+def update_wrs_kacky_reloaded(config, secrets):
+    # overlapping runs are prevented by the job runner (see job_runner.SingleFlightJob)
+    sources = [
+        NadeoSource(config, secrets),
+        KackyReloadedDBSource(config, secrets),
+    ]
+    write_new_wrs(collect_candidates(sources, config, secrets), config, secrets)
+
+
+def update_map_catalog(config, secrets):
+    logger.info("Rebuilding map catalog")
+    entries = []
+    for source, aggregator in (
+        ("KK", KackiestKacky_KackyRecords),
+        ("KR", KackyReloaded_KackyRecords),
+    ):
+        for map_id, uid, name, edition, file in aggregator(
+            secrets
+        ).get_map_catalog_rows():
+            entry = build_catalog_entry(source, uid, map_id, name, edition, file)
+            if entry:
+                entries.append(entry)
+            elif name:
+                logger.warning(f"{source} map {uid} ({name}) has no kacky id, skipped")
+    if MapCatalog(config, secrets).rebuild(entries):
+        # new maps usually come with a new edition
+        DataVersions(config, secrets).bump(EVENTS_DOMAIN)
+
+
+def update_record_versions(config, secrets):
     """
-    # update all kr maps at once
-    kr_maps = []
-    for campaign in club_campaings:
-        print(campaign["name"])
-        campaing_info = tm20_api.nadeo_live_services.get_campaign(
-            config["kacky_reloaded_club_id"],
-            campaign["campaignId"]
-        )
-        for playlist in campaing_info["campaign"]["playlist"]:
-            kr_maps.append(playlist["mapUid"])
-    print(kr_maps)
-    print(len(kr_maps))
+    Bumps the PB, leaderboard and records data versions of every player, edition
+    and event with records newer than the stored watermark of the record database.
     """
-
-    # update one campaign every iteration (we dont want to spam Nadeo's API too much)
-    while True:
-        if not only_event:
-            campaing_info = tm20_api.nadeo_live_services.get_campaign(
-                config["kacky_reloaded_club_id"],
-                club_campaings[reloaded_update_counter]["campaignId"],
-            )
-        if only_event:
-            campaing_info = tm20_api.nadeo_live_services.get_campaign(
-                config["kacky_reloaded_club_id"],
-                club_campaings[reloaded_update_counter_onlyevent]["campaignId"],
-            )
-        campaign_maps = campaing_info["campaign"]["playlist"]
-        if excluded_event or only_event:
-            if excluded_event:
-                if f"KR{excluded_event} MAPS" in campaing_info["name"]:
-                    reloaded_update_counter = (reloaded_update_counter + 1) % len(
-                        club_campaings
-                    )
-                    continue
-            if only_event:
-                if f"KR{only_event} MAPS" not in campaing_info["name"]:
-                    reloaded_update_counter_onlyevent = (
-                        reloaded_update_counter_onlyevent + 1
-                    ) % len(club_campaings)
-                    continue
-        break
-
-    logger.info(campaing_info["name"])
-
-    scores = []
-    for cmap in campaign_maps:
-        mapscore_dbg = "uninitialized"
-        player_dbg = "uninitialized"
+    versions = DataVersions(config, secrets)
+    for source, event, aggregator in (
+        ("KKDB", "KK", KackiestKacky_KackyRecords),
+        ("KRDB", "KR", KackyReloaded_KackyRecords),
+    ):
+        watermark = versions.get_watermark(source)
+        if watermark is None:
+            # first run, nothing cached can be older than now
+            versions.set_watermark(source, dt.now())
+            continue
+        changed = aggregator(secrets).get_changed_records(watermark)
+        if not changed:
+            continue
+        domains = {records_domain(event)}
+        for user, edition, _ in changed:
+            domains.add(pbs_domain(event, user))
+            if edition is not None:
+                domains.add(leaderboard_domain(event, edition))
+        version = versions.bump(*domains)
+        # delta clients syncing from `version` get the records after this watermark
+        versions.set_watermark(source, max(c[2] for c in changed), version)
+        logger.debug(f"{source}: bumped {len(domains)} data versions")
+
+
+def _reset_wr_indexes(reset_maps, config, secrets) -> Dict[str, Dict]:
+    """
+    Builds the WR indexes needed to restore `reset_maps`, all sources at once:
+    one full WR query per record DB, one TMX request for all KK maps and Nadeo
+    requests for the reset KR maps only.
+
+    Returns
+    -------
+    Dict[str, Dict]
+        source -> map key (uid or TMX id) -> WR
+    """
+    kr_uids = [m[2] for m in reset_maps if m[4].upper() == "KR"]
+
+    def kkdb_index():
+        wrs = KackiestKacky_KackyRecords(secrets).get_all_world_records()
+        # reset maps are matched by uid, or by kacky id if their uid is unknown
+        return {**wrs, **{wr["uid"]: wr for wr in wrs.values()}}
+
+    def krdb_index():
+        wrs = KackyReloaded_KackyRecords(secrets).get_all_world_records()
+        return {wr["uid"]: wr for wr in wrs.values()}
+
+    def tmx_index():
+        wrs = TmnfTmxApi(config).get_kacky_wrs()
+        return {str(wr["tid"]): wr for wr in wrs.values()}
+
+    loaders = {"KKDB": kkdb_index, "TMX": tmx_index}
+    if kr_uids:
+        loaders["KRDB"] = krdb_index
+        loaders["NADO"] = lambda: NadeoSource(config, secrets).get_map_wrs(kr_uids)
+    with ThreadPoolExecutor(
+        max_workers=len(loaders), thread_name_prefix="reset_index"
+    ) as executor:
+        futures = {name: executor.submit(loader) for name, loader in loaders.items()}
+    indexes = {}
+    for name, future in futures.items():
         try:
-            mapscore_dbg = tm20_api.nadeo_live_services.get_worldrecord_for_map(
-                cmap["mapUid"]
+            indexes[name] = future.result()
+        except (Exception, SystemExit) as e:
+            # the aggregators exit() on connection errors
+            logger.error(f"{name}: loading wrs for reset maps failed! {e!r}")
+            indexes[name] = {}
+    return indexes
+
+
+def _best_reset_wr(reset_map, indexes: Dict[str, Dict]) -> Dict:
+    map_id, tmx_id, tm_uid, kacky_id, event_type = reset_map[:5]
+    found = []
+    if event_type.upper() == "KK":
+        db_wr = indexes["KKDB"].get(tm_uid) or indexes["KKDB"].get(kacky_id)
+        if db_wr:
+            found.append(
+                {
+                    "score": db_wr["score"],
+                    "login": db_wr["login"],
+                    "nick": db_wr["nick"],
+                    "source": "KKDB",
+                    "date": db_wr["date"],
+                }
             )
-            mapscore = mapscore_dbg["tops"][0]["top"][0]
-            logger.debug(mapscore["accountId"])
-            webidentity = tm20_api.nadeo_services.get_account_webidentities(
-                (mapscore["accountId"],), merge_results=True
-            )[0]
-            logger.debug(webidentity)
-            player_dbg = tm20_api.ubisoft_services.get_player_profile(
-                webidentity["uplay_uid"]
+        tmx_wr = indexes["TMX"].get(str(tmx_id))
+        if tmx_wr:
+            found.append(
+                {"score": tmx_wr["wrscore"], "nick": tmx_wr["wruser"], "source": "TMX"}
             )
-            logger.debug(player_dbg)
-            player = player_dbg["profiles"][0]
-        except IndexError:
-            # usually means no wr yet
-            continue
-        except Exception as e:
-            logger.error(f"Error in updating data from Nadeo! {e}")
-            logger.error(cmap)
-            logger.error(mapscore_dbg)
-            logger.error(player_dbg)
-            continue
-        #            kacky_reloaded_lock.release()
-        #            return
-        scores.append(
-            build_score(
-                mapscore["score"],
-                dt.now(),
-                "NADO",
-                login=player["nameOnPlatform"],
-                tm_uid=cmap["mapUid"],
+    else:
+        db_wr = indexes["KRDB"].get(tm_uid)
+        if db_wr:
+            found.append(
+                {
+                    "score": db_wr["score"],
+                    "login": db_wr["login"],
+                    "nick": db_wr["nick"],
+                    "source": "KRDB",
+                    "date": db_wr["date"],
+                }
             )
-        )
-
-    update_scores = check_new_scores(scores, "nado", config, secrets)
-    logger.debug("=========================================================")
-    logger.debug(update_scores)
-
-    # no deduplication needed, as we have only one data source
-
-    # set up connection to backend database
-    backend_db = DBConnection(config, secrets)
-
-    for new_wr in update_scores:
-        write_wr_to_db(backend_db, new_wr)
-
-    if not only_event:
-        reloaded_update_counter = (reloaded_update_counter + 1) % len(club_campaings)
-    if only_event:
-        reloaded_update_counter_onlyevent = (
-            reloaded_update_counter_onlyevent + 1
-        ) % len(club_campaings)
-
-    if kacky_reloaded_lock and not only_event:
-        kacky_reloaded_lock.release()
-    if kacky_reloaded_lock_onlyevent and only_event:
-        kacky_reloaded_lock_onlyevent.release()
+        if tm_uid in indexes["NADO"]:
+            found.append(indexes["NADO"][tm_uid])
+    # record DB first on equal scores, it knows the date the WR was driven
+    return min(found, key=lambda wr: wr["score"], default=None)
 
 
 def restore_wr_after_reset(config, secrets):
     logger.info("Checking for reset WRs")
 
     backend_db = DBConnection(config, secrets)
-    # keep this minimal, because this most of the time will be empty
-    reset_check_query = """SELECT id FROM worldrecords WHERE score = 1;"""
-    reset_candidates = backend_db.fetchall(reset_check_query, ())
-    if not reset_candidates:
-        logger.debug("No reset WRs need updating")
-
-    # get information of reset map
+    # get information of reset maps
     reset_map_query = """
-        SELECT map_id, tmx_id, tm_uid, kacky_id, type
+        SELECT map_id, tmx_id, tm_uid, kacky_id, type, edition
         FROM worldrecords
         INNER JOIN maps ON maps.id = worldrecords.map_id
         INNER JOIN events ON events.id = maps.kackyevent
         WHERE score = 1;
     """
     reset_maps = backend_db.fetchall(reset_map_query, ())
+    if not reset_maps:
+        logger.debug("No reset WRs need updating")
+        return
+    logger.info(f"Restoring {len(reset_maps)} reset WRs")
 
+    indexes = _reset_wr_indexes(reset_maps, config, secrets)
+    restored = []
+    updates = []
     for reset_map in reset_maps:
-        if reset_map[4].upper() == "KK":
-            # this is inefficient af, but will run so rarely, should be fine
-            db_wr = KackiestKacky_KackyRecords(secrets).get_all_world_records()[
-                reset_map[3]
-            ]
-            tmx_wr = TmnfTmxApi(config).get_map_wr(reset_map[1])
-            if db_wr["score"] < tmx_wr[1]:
-                new_wr = {
-                    "score": db_wr["score"],
-                    "login": db_wr["login"],
-                    "nick": db_wr["nick"],
-                    "source": "KKDB",
-                    "date": db_wr["date"],
-                }
-            else:
-                new_wr = {"score": tmx_wr[1], "nick": tmx_wr[0], "source": "TMX"}
-        else:
-            raise NotImplementedError
-        query = """
-                 UPDATE worldrecords AS wr
-                 LEFT JOIN maps
-                 ON wr.map_id = maps.id
-                 SET score = ?, login = ?, nickname = ?, source = ?, date = ?
-                 WHERE maps.tm_uid = ?;
-                 """
-        backend_db.execute(
-            query,
+        new_wr = _best_reset_wr(reset_map, indexes)
+        if new_wr is None:
+            logger.warning(f"No WR found for reset map {reset_map[3]} ({reset_map[2]})")
+            continue
+        date = new_wr.get("date", dt.now())
+        updates.append(
             (
                 new_wr["score"],
-                new_wr["login"] if "login" in new_wr else "",
-                new_wr["nick"] if "nick" in new_wr else "",
+                new_wr.get("login", ""),
+                new_wr.get("nick", ""),
                 new_wr["source"],
-                new_wr["date"]
-                if "date" in new_wr
-                else dt.now().strftime("%Y-%m-%d %H:%M:%S"),
-                reset_map[2],
-            ),
+                date if isinstance(date, str) else date.strftime("%Y-%m-%d %H:%M:%S"),
+                reset_map[0],
+            )
+        )
+        restored.append(reset_map)
+
+    if not updates:
+        return
+    versions = DataVersions(config, secrets)
+    with backend_db.transaction() as cursor:
+        # serialized with the WR writers, history ids are committed in order
+        version = versions.begin_write(cursor)
+        # score = 1 again, so a WR found by the update jobs in the meantime stays
+        cursor.executemany(
+            """
+            UPDATE worldrecords
+            SET score = ?, login = ?, nickname = ?, source = ?, date = ?
+            WHERE map_id = ? AND score = 1;
+            """,
+            updates,
         )
+        sync_wr_history(cursor, version, [m[0] for m in restored])
+        versions.stamp(cursor, version, *(wrs_domain(m[4], m[5]) for m in restored))
 
 
 if __name__ == "__main__":
@@ -1,7 +1,8 @@
 import mariadb
 import requests
 
-from kacky_records_api import logger, secrets
+from kacky_records_api import config, logger, secrets
+from kacky_records_api.data_versions import EVENTS_DOMAIN, DataVersions
 
 playlist_ids_kk = (
     "PLXfxs_aJsOl5tXaWq_n7JFfsfttOhDI5p",  # kk1
@@ -72,3 +73,5 @@ for playlist_id in playlist_ids_kk:
         cursor.execute(query, clip)
     connection.commit()
 connection.close()
+# clips are part of the event bundles
+DataVersions(config, secrets).bump(EVENTS_DOMAIN)
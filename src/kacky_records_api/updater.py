@@ -0,0 +1,173 @@
+"""
+Standalone updater process. Runs all record update jobs, so the web workers only
+serve reads. Any number of updater instances may run (e.g. one per API host), a
+leader lease in the backend database makes sure exactly one of them runs the jobs.
+
+Started through the `kacky-records-updater` console script.
+"""
+import argparse
+import datetime
+import signal
+import sys
+import threading
+from typing import Optional
+
+from apscheduler.schedulers.background import BackgroundScheduler
+
+from kacky_records_api import config, logger, secrets
+from kacky_records_api.data_versions import DataVersions
+from kacky_records_api.db_operators.leader_lease import LeaderLease
+from kacky_records_api.db_operators.operators import DBConnection
+from kacky_records_api.job_runner import SingleFlightJob
+from kacky_records_api.reconcile import reconcile_wrs
+from kacky_records_api.record_mirror import replicate_record_dbs
+from kacky_records_api.update_records import (
+    restore_wr_after_reset,
+    update_map_catalog,
+    update_record_versions,
+    update_wrs_kackiest_kacky,
+    update_wrs_kacky_reloaded,
+)
+from kacky_records_api.wr_history import WR_HISTORY_TABLE_QUERY, sync_wr_history
+from kacky_records_api.wr_stream import (
+    WR_EVENTS_TABLE_QUERY,
+    WR_OUTBOX_CONSUMERS_TABLE_QUERY,
+)
+
+LEADER_LOCK_NAME = "kacky_records_api_updater"
+# single flight wrappers by job name, kept across leadership terms so a run left
+# over from an earlier term still blocks new ticks of the same job
+_jobs = {}
+
+
+def add_update_jobs(scheduler, config, secrets):
+    stats_db = DBConnection(config, secrets)
+    # outbox written together with every new WR
+    stats_db.execute(WR_EVENTS_TABLE_QUERY, ())
+    stats_db.execute(WR_OUTBOX_CONSUMERS_TABLE_QUERY, ())
+    stats_db.execute(WR_HISTORY_TABLE_QUERY, ())
+    with stats_db.transaction() as db_cursor:
+        # WRs stored before the history existed. Serialized with the WR writers
+        version = DataVersions(config, secrets).begin_write(db_cursor)
+        sync_wr_history(db_cursor, version)
+
+    def add_job(
+        name: str, func, seconds: int, deadline: Optional[int] = None, **kwargs
+    ):
+        # every job is single flight. max_instances=2 lets overlapping ticks reach
+        # the runner, which coalesces them into one catch-up run and counts them.
+        # Runs are overruns after `deadline` seconds, by default the interval
+        if name not in _jobs:
+            _jobs[name] = SingleFlightJob(
+                name, func, deadline or seconds, config, stats_db
+            )
+        scheduler.add_job(
+            func=_jobs[name],
+            args=(config, secrets),
+            trigger="interval",
+            seconds=seconds,
+            max_instances=2,
+            coalesce=True,
+            **kwargs,
+        )
+
+    mirror_conf = config.get("record_mirror", {})
+    if mirror_conf.get("enabled", False):
+        add_job(
+            "replicate_record_dbs",
+            replicate_record_dbs,
+            mirror_conf.get("interval_seconds", 10),
+            next_run_time=datetime.datetime.now(),
+        )
+    add_job("update_wrs_kackiest_kacky", update_wrs_kackiest_kacky, 60)
+    # short ticks, the adaptive scheduler decides which maps are actually polled.
+    # A run may take far longer than a tick, e.g. waiting for the Nadeo timeout
+    adaptive_conf = config.get("adaptive_updates", {})
+    add_job(
+        "update_wrs_kacky_reloaded",
+        update_wrs_kacky_reloaded,
+        adaptive_conf.get("tick_seconds", 5),
+        deadline=adaptive_conf.get("deadline_seconds", 120),
+    )
+    add_job(
+        "update_map_catalog",
+        update_map_catalog,
+        60 * 10,
+        next_run_time=datetime.datetime.now(),
+    )
+    add_job(
+        "update_record_versions",
+        update_record_versions,
+        config.get("record_version_poll_seconds", 15),
+    )
+    add_job("restore_wr_after_reset", restore_wr_after_reset, 60 * 10)
+    reconcile_hours = config.get("reconcile", {}).get("interval_hours", 0)
+    if reconcile_hours:
+        add_job("reconcile_wrs", reconcile_wrs, reconcile_hours * 60 * 60)
+
+
+def run_all_jobs_once(config, secrets):
+    if config.get("record_mirror", {}).get("enabled", False):
+        replicate_record_dbs(config, secrets)
+    update_map_catalog(config, secrets)
+    update_wrs_kackiest_kacky(config, secrets)
+    update_wrs_kacky_reloaded(config, secrets)
+    update_record_versions(config, secrets)
+    restore_wr_after_reset(config, secrets)
+
+
+def lead_while_elected(lease: LeaderLease, stop: threading.Event):
+    """
+    Runs the update jobs for as long as `lease` is held. Returns when leadership
+    is lost or `stop` is set, once the running jobs have finished.
+    """
+    logger.info("Became updater leader, starting update jobs")
+    scheduler = BackgroundScheduler()
+    add_update_jobs(scheduler, config, secrets)
+    scheduler.start()
+    try:
+        while not stop.wait(config.get("leader_check_seconds", 10)):
+            if not lease.is_held():
+                logger.warning("Lost updater leadership, stopping update jobs")
+                break
+    finally:
+        # runs still writing would overlap with a new leader (or our next term)
+        logger.info("Waiting for running update jobs to finish")
+        scheduler.shutdown(wait=True)
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description="Kacky Records API updater")
+    parser.add_argument(
+        "--once",
+        action="store_true",
+        help="run every update job once and exit (no leader election)",
+    )
+    parsed = parser.parse_args(args)
+
+    if parsed.once:
+        run_all_jobs_once(config, secrets)
+        return
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+
+    lease = LeaderLease(config, secrets, LEADER_LOCK_NAME)
+    try:
+        while not stop.is_set():
+            if lease.acquire():
+                lead_while_elected(lease, stop)
+            else:
+                logger.debug("Another updater is leader, standing by")
+            stop.wait(config.get("leader_check_seconds", 10))
+    finally:
+        lease.release()
+
+
+def run():
+    main(sys.argv[1:])
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,198 @@
+import datetime
+from typing import Dict, Iterable, List, Optional
+
+from kacky_records_api.db_operators.operators import DBConnection
+
+# one row per WR ever held, superseded_at is NULL for the current one and never
+# before date (sources report epoch or backdated dates for some WRs). event_id is
+# maps.kackyevent, kept here so boards of an event are read from a single index.
+# version is the data version of the transaction that wrote the entry
+WR_HISTORY_TABLE_QUERY = """
+    CREATE TABLE IF NOT EXISTS wr_history (
+        id BIGINT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY,
+        map_id INT NOT NULL,
+        event_id INT NOT NULL,
+        score INT NOT NULL,
+        login VARCHAR(64) NOT NULL DEFAULT '',
+        nickname VARCHAR(255) NOT NULL DEFAULT '',
+        source VARCHAR(4) NOT NULL,
+        date DATETIME NOT NULL,
+        superseded_at DATETIME NULL,
+        version BIGINT UNSIGNED NOT NULL DEFAULT 0,
+        INDEX idx_wr_history_map (map_id, date),
+        INDEX idx_wr_history_event (event_id, date, superseded_at),
+        INDEX idx_wr_history_version (event_id, version)
+    );
+"""
+
+
+def record_wr_history(db_cursor, map_id: int, event_id: int, wr: Dict, version: int):
+    """
+    Closes the current history entry of the map and appends `wr`. Call with the
+    cursor of the transaction updating `worldrecords` and the data version it drew
+    with `DataVersions.begin_write`.
+    """
+    db_cursor.execute(
+        """
+        UPDATE wr_history SET superseded_at = GREATEST(date, ?)
+        WHERE map_id = ? AND superseded_at IS NULL;
+        """,
+        (wr["date"], map_id),
+    )
+    db_cursor.execute(
+        """
+        INSERT INTO wr_history
+            (map_id, event_id, score, login, nickname, source, date, version)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?);
+        """,
+        (
+            map_id,
+            event_id,
+            wr["score"],
+            wr.get("login", ""),
+            wr.get("nick", ""),
+            wr["source"],
+            wr["date"],
+            version,
+        ),
+    )
+
+
+def sync_wr_history(
+    db_cursor, version: int, map_ids: Optional[Iterable[int]] = None
+) -> int:
+    """
+    Appends the current WR of every map whose history does not end with it yet.
+    Backfills maps stored before the history existed and WRs restored after a
+    reset. Limited to `map_ids` if given. `version` as for `record_wr_history`.
+
+    Returns
+    -------
+    int
+        number of appended entries
+    """
+    filters, args = "", ()
+    if map_ids is not None:
+        args = tuple(map_ids)
+        if not args:
+            return 0
+        filters = f" AND wr.map_id IN ({', '.join('?' * len(args))})"
+    db_cursor.execute(
+        f"""
+        SELECT wr.map_id, maps.kackyevent, wr.score, wr.login, wr.nickname,
+               wr.source, wr.date
+        FROM worldrecords AS wr
+        INNER JOIN maps ON wr.map_id = maps.id
+        LEFT JOIN wr_history AS h
+            ON h.map_id = wr.map_id AND h.superseded_at IS NULL
+        WHERE wr.score != 1
+            AND (h.id IS NULL OR h.score != wr.score){filters};
+        """,
+        args,
+    )
+    rows = db_cursor.fetchall()
+    if not rows:
+        return 0
+    db_cursor.executemany(
+        """
+        UPDATE wr_history SET superseded_at = GREATEST(date, ?)
+        WHERE map_id = ? AND superseded_at IS NULL;
+        """,
+        [(r[6], r[0]) for r in rows],
+    )
+    db_cursor.executemany(
+        """
+        INSERT INTO wr_history
+            (map_id, event_id, score, login, nickname, source, date, version)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?);
+        """,
+        [(r[0], r[1], r[2], r[3] or "", r[4] or "", r[5], r[6], version) for r in rows],
+    )
+    return len(rows)
+
+
+class WRHistory:
+    """Read side of `wr_history`."""
+
+    def __init__(self, config, secrets):
+        self._backend_db = DBConnection(config, secrets)
+
+    def map_progression(self, eventtype: str, kacky_id: str) -> List[Dict]:
+        """All WRs ever held on the map, oldest first."""
+        rows = self._backend_db.fetchall(
+            """
+            SELECT maps.name, maps.kacky_id, h.score, h.nickname, h.login, h.source,
+                   h.date, h.superseded_at
+            FROM maps
+            INNER JOIN events ON events.id = maps.kackyevent
+            INNER JOIN wr_history AS h ON h.map_id = maps.id
+            WHERE events.type = ? AND maps.kacky_id = ?
+            ORDER BY h.date, h.id;
+            """,
+            (eventtype.upper(), kacky_id),
+        )
+        return [
+            {
+                "map": r[0],
+                "kid": r[1],
+                "score": r[2],
+                "nick": r[3],
+                "login": r[4],
+                "source": r[5],
+                "date": r[6],
+                "superseded_at": r[7],
+            }
+            for r in rows
+        ]
+
+    def board_as_of(self, event_id: int, as_of: datetime.datetime) -> List[Dict]:
+        """WR of every map of the event as it stood at `as_of`."""
+        rows = self._backend_db.fetchall(
+            """
+            SELECT maps.name, maps.kacky_id, h.score, h.nickname, h.login, h.date
+            FROM wr_history AS h
+            INNER JOIN maps ON h.map_id = maps.id
+            WHERE h.event_id = ? AND h.date <= ?
+                AND (h.superseded_at IS NULL OR h.superseded_at > ?);
+            """,
+            (event_id, as_of, as_of),
+        )
+        return [
+            {
+                "map": r[0],
+                "kid": r[1],
+                "score": r[2],
+                "nick": r[3],
+                "login": r[4],
+                "date": r[5],
+            }
+            for r in rows
+        ]
+
+    def changes_since(self, event_id: int, since: int, version: int) -> List[Dict]:
+        """
+        Current WRs of the maps of the event whose WR changed in a data version
+        after `since` and up to `version`, all maps for `since` 0. `version` must be
+        a committed data version (`DataVersions.current`). Entries up to it are
+        complete, `DataVersions.begin_write` serializes their writers.
+        """
+        query = """
+            SELECT maps.name, maps.kacky_id, wr.score, wr.nickname, wr.login
+            FROM worldrecords AS wr
+            INNER JOIN maps ON wr.map_id = maps.id
+            WHERE maps.kackyevent = ?
+        """
+        args = (event_id,)
+        if since:
+            query += """
+                AND wr.map_id IN (
+                    SELECT map_id FROM wr_history
+                    WHERE event_id = ? AND version > ? AND version <= ?
+                )
+            """
+            args += (event_id, since, version)
+        rows = self._backend_db.fetchall(query, args)
+        return [
+            {"map": r[0], "kid": r[1], "score": r[2], "nick": r[3], "login": r[4]}
+            for r in rows
+        ]
@@ -0,0 +1,383 @@
+import collections
+import json
+import threading
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from kacky_records_api.db_operators.operators import DBConnection
+
+try:
+    from gevent import monkey
+except ImportError:  # pragma: no cover
+    monkey = None
+
+WR_EVENTS_TABLE_QUERY = """
+    CREATE TABLE IF NOT EXISTS wr_events (
+        id BIGINT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY,
+        event_type VARCHAR(4) NULL,
+        edition INT NULL,
+        map_id INT NOT NULL,
+        kacky_id VARCHAR(32) NULL,
+        score INT NOT NULL,
+        login VARCHAR(64) NOT NULL DEFAULT '',
+        nickname VARCHAR(255) NOT NULL DEFAULT '',
+        source VARCHAR(4) NOT NULL,
+        date DATETIME NOT NULL,
+        former_score INT NULL,
+        former_login VARCHAR(64) NULL,
+        former_nickname VARCHAR(255) NULL,
+        former_date DATETIME NULL,
+        created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        INDEX idx_wr_events_event (event_type, edition, id),
+        INDEX idx_wr_events_map (map_id, id)
+    );
+"""
+
+WR_OUTBOX_CONSUMERS_TABLE_QUERY = """
+    CREATE TABLE IF NOT EXISTS wr_outbox_consumers (
+        consumer VARCHAR(64) NOT NULL PRIMARY KEY,
+        acked_id BIGINT UNSIGNED NOT NULL DEFAULT 0,
+        claimed_id BIGINT UNSIGNED NOT NULL DEFAULT 0,
+        lease_until DATETIME NULL
+    );
+"""
+
+_EVENT_COLUMNS = (
+    "id, event_type, edition, map_id, kacky_id, score, login, nickname, source, date, "
+    "former_score, former_login, former_nickname, former_date"
+)
+
+
+def record_wr_event(
+    db_cursor,
+    event_type: str,
+    edition: int,
+    map_id: int,
+    kacky_id: str,
+    wr: Dict,
+    former: Tuple = (None, None, None, None),
+):
+    """
+    Appends a new WR to the `wr_events` outbox. Call with the cursor of the
+    transaction updating `worldrecords`, so the event exists iff the WR was stored.
+    `former` is (score, login, nickname, date) of the beaten WR.
+    """
+    db_cursor.execute(
+        """
+        INSERT INTO wr_events
+            (event_type, edition, map_id, kacky_id, score, login, nickname, source,
+             date, former_score, former_login, former_nickname, former_date)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);
+        """,
+        (
+            event_type,
+            edition,
+            map_id,
+            kacky_id,
+            wr["score"],
+            wr.get("login", ""),
+            wr.get("nick", ""),
+            wr["source"],
+            wr["date"],
+            *former,
+        ),
+    )
+
+
+def _isoformat(value):
+    return value.isoformat() if hasattr(value, "isoformat") else value
+
+
+def _event_dict(row) -> Dict:
+    event = {
+        "id": row[0],
+        "event": row[1],
+        "edition": row[2],
+        "kid": row[4],
+        "score": row[5],
+        "login": row[6],
+        "nick": row[7],
+        "source": row[8],
+        "date": _isoformat(row[9]),
+        "former": None,
+    }
+    # reset WRs (score 1) have no holder to beat
+    if row[10] is not None and row[10] != 1:
+        event["former"] = {
+            "score": row[10],
+            "login": row[11],
+            "nick": row[12],
+            "date": _isoformat(row[13]),
+            "time_diff": row[10] - row[5],
+            "days_passed": abs((row[9] - row[13]).days) if row[13] else None,
+        }
+    return event
+
+
+class WRBroadcaster:
+    """
+    Fans new WRs out to the `/stream/wrs` clients of one process. A single thread
+    per process polls the `wr_events` outbox (written by the updater in the same
+    transaction as the WR) and keeps the most recent events in memory, all clients
+    of the process wait on that buffer instead of querying the database. Clients
+    resuming from an event older than the buffer catch up from the table.
+    """
+
+    _events = collections.deque()
+    _last_id = None
+    _thread = None
+    _clients = 0
+    _cond = threading.Condition()
+
+    def __init__(self, config, secrets):
+        self._config = config
+        self._conf = config.get("wr_stream", {})
+        self._backend_db = DBConnection(config, secrets)
+        self._ensure_polling()
+
+    def _ensure_polling(self):
+        with WRBroadcaster._cond:
+            if WRBroadcaster._thread is not None:
+                return
+            self._backend_db.execute(WR_EVENTS_TABLE_QUERY, ())
+            WRBroadcaster._events = collections.deque(
+                maxlen=self._conf.get("buffer_events", 1000)
+            )
+            WRBroadcaster._last_id = self._backend_db.fetchone(
+                "SELECT COALESCE(MAX(id), 0) FROM wr_events;", ()
+            )[0]
+            WRBroadcaster._thread = threading.Thread(
+                target=self._poll, name="wr_broadcaster", daemon=True
+            )
+            WRBroadcaster._thread.start()
+
+    def _poll(self):
+        while True:
+            time.sleep(self._conf.get("poll_seconds", 1))
+            try:
+                rows = self._backend_db.fetchall(
+                    f"""
+                    SELECT {_EVENT_COLUMNS} FROM wr_events
+                    WHERE id > ? ORDER BY id LIMIT 500;
+                    """,
+                    (WRBroadcaster._last_id,),
+                )
+            except Exception:
+                # database hiccup, clients just wait a little longer
+                continue
+            if not rows:
+                continue
+            with WRBroadcaster._cond:
+                WRBroadcaster._events.extend(_event_dict(r) for r in rows)
+                WRBroadcaster._last_id = rows[-1][0]
+                WRBroadcaster._cond.notify_all()
+
+    def last_id(self) -> int:
+        return WRBroadcaster._last_id
+
+    def max_clients(self) -> int:
+        # a green worker holds a stream in a greenlet, not in one of its threads
+        if monkey is not None and monkey.is_module_patched("threading"):
+            return self._conf.get("green_max_clients", 1000)
+        return self._conf.get("max_clients", 2)
+
+    def connect(self) -> bool:
+        """Registers a client, False if this process serves too many streams."""
+        with WRBroadcaster._cond:
+            if WRBroadcaster._clients >= self.max_clients():
+                return False
+            WRBroadcaster._clients += 1
+            return True
+
+    def disconnect(self):
+        with WRBroadcaster._cond:
+            WRBroadcaster._clients -= 1
+
+    def _catch_up(
+        self, after: int, event: Optional[str], edition: Optional[int]
+    ) -> Tuple[List[Dict], int]:
+        seen_until = WRBroadcaster._last_id
+        filters, args = "", [after]
+        if event:
+            filters += " AND event_type = ?"
+            args.append(event)
+        if edition is not None:
+            filters += " AND edition = ?"
+            args.append(edition)
+        rows = self._backend_db.fetchall(
+            f"""
+            SELECT {_EVENT_COLUMNS} FROM wr_events
+            WHERE id > ?{filters} ORDER BY id LIMIT 1000;
+            """,
+            tuple(args),
+        )
+        if len(rows) == 1000:
+            seen_until = rows[-1][0]
+        return [_event_dict(r) for r in rows], seen_until
+
+    def events(
+        self,
+        after: int,
+        event: Optional[str] = None,
+        edition: Optional[int] = None,
+        timeout: float = 15,
+    ) -> Tuple[List[Dict], int]:
+        """
+        Events with id > `after` matching the filters. Blocks up to `timeout`
+        seconds if there are none yet.
+
+        Returns
+        -------
+        Tuple[List[Dict], int]
+            the events and the id up to which events were looked at, resume from
+            there
+        """
+        with WRBroadcaster._cond:
+            buffer_start = (
+                WRBroadcaster._events[0]["id"]
+                if WRBroadcaster._events
+                else WRBroadcaster._last_id + 1
+            )
+        if after + 1 < buffer_start:
+            # older than the buffer, resume from the table
+            return self._catch_up(after, event, edition)
+
+        def matching():
+            return [
+                e
+                for e in WRBroadcaster._events
+                if e["id"] > after
+                and (not event or (e["event"] or "").upper() == event)
+                and (edition is None or e["edition"] == edition)
+            ]
+
+        with WRBroadcaster._cond:
+            found = matching()
+            if not found:
+                WRBroadcaster._cond.wait(timeout)
+                found = matching()
+            return found, max(WRBroadcaster._last_id, after)
+
+
+def sse_stream(
+    broadcaster: WRBroadcaster,
+    after: int,
+    event: Optional[str],
+    edition: Optional[int],
+    max_seconds: float,
+) -> Iterator[str]:
+    """
+    Server-Sent Events of new WRs. Sends a comment as keep-alive while idle and
+    ends after `max_seconds`, clients reconnect with the Last-Event-ID they got.
+    """
+    yield "retry: 3000\n\n"
+    end = time.monotonic() + max_seconds
+    while time.monotonic() < end:
+        found, seen_until = broadcaster.events(
+            after, event, edition, timeout=max(min(15, end - time.monotonic()), 0)
+        )
+        for e in found:
+            yield f"id: {e['id']}\nevent: wr\ndata: {json.dumps(e)}\n\n"
+        if seen_until > after and (not found or found[-1]["id"] < seen_until):
+            # skipped events of other editions, move the client's resume point
+            yield f"id: {seen_until}\n\n"
+        elif not found:
+            yield ": keep-alive\n\n"
+        after = seen_until
+
+
+class WROutbox:
+    """
+    Batched delivery of the `wr_events` outbox to named consumers (e.g. the Discord
+    bot). Every consumer has a cursor: `claim` hands out the events after its last
+    acknowledged id and leases them for `lease_seconds`, `ack` moves the cursor once
+    they are delivered. Unacknowledged batches are handed out again after the
+    lease expired, so every WR is delivered at least once.
+    """
+
+    _tables_created = False
+
+    def __init__(self, config, secrets):
+        self._conf = config.get("wr_outbox", {})
+        self._backend_db = DBConnection(config, secrets)
+        if not WROutbox._tables_created:
+            for query in (
+                WR_EVENTS_TABLE_QUERY,
+                WR_OUTBOX_CONSUMERS_TABLE_QUERY,
+            ):
+                self._backend_db.execute(query, ())
+            WROutbox._tables_created = True
+
+    def claim(self, consumer: str, limit: int) -> Optional[Tuple[List[Dict], int]]:
+        """
+        Leases the next batch of events of `consumer`. New consumers start after the
+        newest event, they do not get the whole history.
+
+        Returns
+        -------
+        Optional[Tuple[List[Dict], int]]
+            the events and the cursor to acknowledge them with, None if the
+            previous batch is still leased
+        """
+        with self._backend_db.transaction() as db_cursor:
+            db_cursor.execute(
+                """
+                INSERT IGNORE INTO wr_outbox_consumers (consumer, acked_id, claimed_id)
+                SELECT ?, COALESCE(MAX(id), 0), COALESCE(MAX(id), 0) FROM wr_events;
+                """,
+                (consumer,),
+            )
+            db_cursor.execute(
+                """
+                SELECT acked_id, claimed_id > acked_id AND lease_until > NOW()
+                FROM wr_outbox_consumers WHERE consumer = ? FOR UPDATE;
+                """,
+                (consumer,),
+            )
+            acked_id, leased = db_cursor.fetchone()
+            if leased:
+                return None
+            db_cursor.execute(
+                f"""
+                SELECT {_EVENT_COLUMNS} FROM wr_events
+                WHERE id > ? ORDER BY id LIMIT ?;
+                """,
+                (acked_id, limit),
+            )
+            rows = db_cursor.fetchall()
+            if not rows:
+                return [], acked_id
+            db_cursor.execute(
+                """
+                UPDATE wr_outbox_consumers
+                SET claimed_id = ?, lease_until = NOW() + INTERVAL ? SECOND
+                WHERE consumer = ?;
+                """,
+                (rows[-1][0], self._conf.get("lease_seconds", 60), consumer),
+            )
+        return [_event_dict(r) for r in rows], rows[-1][0]
+
+    def ack(self, consumer: str, cursor: int) -> bool:
+        """
+        Marks the events of `consumer` up to `cursor` as delivered. False if
+        `cursor` was not handed out by `claim`.
+        """
+        with self._backend_db.transaction() as db_cursor:
+            db_cursor.execute(
+                """
+                SELECT acked_id, claimed_id FROM wr_outbox_consumers
+                WHERE consumer = ? FOR UPDATE;
+                """,
+                (consumer,),
+            )
+            row = db_cursor.fetchone()
+            if row is None or not row[0] <= cursor <= row[1]:
+                return False
+            db_cursor.execute(
+                """
+                UPDATE wr_outbox_consumers SET acked_id = ?, lease_until = NULL
+                WHERE consumer = ?;
+                """,
+                (cursor, consumer),
+            )
+        return True
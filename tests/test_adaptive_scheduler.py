@@ -0,0 +1,134 @@
+import datetime
+
+import pytest
+
+from kacky_records_api import adaptive_scheduler
+from kacky_records_api.adaptive_scheduler import AdaptiveMapScheduler, MapState
+
+NOW = 1_700_000_000.0
+CONFIG = {
+    "live_events": [{"type": "KR", "edition": 5}, {"type": "KK", "edition": 8}],
+    "adaptive_updates": {
+        "hot_interval": 10,
+        "warm_interval": 300,
+        "cold_interval": 3600,
+        "warm_window_hours": 48,
+        "requests_per_minute": 60,
+        "campaign_refresh_seconds": 3600,
+    },
+}
+
+
+class FakeDB:
+    def __init__(self, rows=()):
+        self.rows = list(rows)
+        self.written = []
+
+    def execute(self, query, args):
+        pass
+
+    def fetchall(self, query, args):
+        return self.rows
+
+    def executemany(self, query, args):
+        self.written.extend(args)
+
+
+class Clock:
+    def __init__(self):
+        self.now = NOW
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(adaptive_scheduler.time, "time", clock)
+    return clock
+
+
+def make_scheduler(monkeypatch, rows=()):
+    db = FakeDB(rows)
+    monkeypatch.setattr(adaptive_scheduler, "DBConnection", lambda c, s: db)
+    return AdaptiveMapScheduler(CONFIG, {}), db
+
+
+def ts(seconds_ago: float) -> datetime.datetime:
+    return datetime.datetime.fromtimestamp(NOW - seconds_ago)
+
+
+def test_interval_by_priority(monkeypatch, clock):
+    scheduler, _ = make_scheduler(monkeypatch)
+    # KK editions are not polled from Nadeo, only KR 5 is live
+    assert scheduler.live_editions() == [5]
+    assert scheduler.interval(MapState("hot", 1, 5), NOW) == 10
+    warm = MapState("warm", 1, 4, last_change=NOW - 3600)
+    assert scheduler.interval(warm, NOW) == 300
+    cold = MapState("cold", 1, 4, last_change=NOW - 49 * 3600)
+    assert scheduler.interval(cold, NOW) == 3600
+    assert scheduler.interval(MapState("never", 1, None), NOW) == 3600
+
+
+def test_due_maps_most_overdue_first(monkeypatch, clock):
+    rows = [
+        # (tm_uid, campaign id, edition, last polled, last change)
+        ("hot_late", 1, 5, ts(100), None),
+        ("hot_fresh", 1, 5, ts(5), None),
+        ("warm_due", 1, 4, ts(600), ts(3600)),
+        ("cold_fresh", 1, 3, ts(600), None),
+        ("never_polled", 1, 3, None, None),
+    ]
+    scheduler, _ = make_scheduler(monkeypatch, rows)
+    scheduler.load_state()
+    due = [s.tm_uid for s in scheduler.due_maps()]
+    assert due == ["never_polled", "hot_late", "warm_due"]
+
+
+def test_request_budget_limits_and_refills(monkeypatch, clock):
+    rows = [(f"map{i}", 1, 5, None, None) for i in range(100)]
+    scheduler, _ = make_scheduler(monkeypatch, rows)
+    scheduler.load_state()
+    assert len(scheduler.due_maps()) == 60
+    scheduler.spend(60)
+    assert scheduler.due_maps() == []
+    # one request per second comes back, never more than a minute's worth
+    clock.now += 10
+    assert len(scheduler.due_maps()) == 10
+    clock.now += 3600
+    assert len(scheduler.due_maps()) == 60
+
+
+def test_overspent_budget_recovers_within_a_minute(monkeypatch, clock):
+    rows = [(f"map{i}", 1, 5, None, None) for i in range(100)]
+    scheduler, _ = make_scheduler(monkeypatch, rows)
+    scheduler.load_state()
+    scheduler.spend(1000)
+    clock.now += 60
+    assert scheduler.due_maps() == []
+    clock.now += 60
+    assert len(scheduler.due_maps()) == 60
+
+
+def test_mark_polled_and_persist(monkeypatch, clock):
+    scheduler, db = make_scheduler(monkeypatch)
+    unchanged = MapState("a", 1, 5)
+    changed = MapState("b", 1, 5, last_change=NOW - 3600)
+    scheduler.mark_polled(unchanged, changed=False)
+    scheduler.mark_polled(changed, changed=True)
+    assert unchanged.last_polled == NOW and unchanged.last_change is None
+    assert changed.last_polled == NOW and changed.last_change == NOW
+    scheduler.persist([unchanged, changed])
+    assert [row[0] for row in db.written] == ["a", "b"]
+
+
+def test_campaigns_outdated(monkeypatch, clock):
+    scheduler, _ = make_scheduler(monkeypatch)
+    # nothing known yet
+    assert scheduler.campaigns_outdated()
+    scheduler._states = {"a": MapState("a", 1, 5)}
+    scheduler._campaigns_synced_at = NOW
+    assert not scheduler.campaigns_outdated()
+    clock.now += 3601
+    assert scheduler.campaigns_outdated()
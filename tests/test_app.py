@@ -0,0 +1,11 @@
+import sys
+
+
+def test_app_imports(monkeypatch):
+    # outside gunicorn, importing the module starts the development server
+    monkeypatch.setenv("SERVER_SOFTWARE", "gunicorn/test")
+    from kacky_records_api.app import app
+
+    assert "get_map_leaderboard" in app.view_functions
+    # without embedded_updater, the web workers don't load the update jobs
+    assert "kacky_records_api.updater" not in sys.modules
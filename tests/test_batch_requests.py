@@ -0,0 +1,92 @@
+import flask
+import pytest
+
+from kacky_records_api.batch_requests import run_batch, validate_subrequest
+
+
+@pytest.fixture
+def app():
+    app = flask.Flask(__name__)
+    app.closed = []
+
+    @app.route("/wrs/<eventtype>")
+    def wrs(eventtype):
+        response = flask.jsonify(
+            {
+                "event": eventtype,
+                "args": dict(flask.request.args),
+                "key": flask.request.headers.get("X-ApiKey"),
+            }
+        )
+        response.set_etag("v1")
+        return response
+
+    @app.route("/text")
+    def text():
+        return "plain"
+
+    @app.route("/boom")
+    def boom():
+        raise RuntimeError("broken view")
+
+    @app.route("/lines")
+    def lines():
+        response = flask.Response(iter(["a\n", "b\n"]), mimetype="text/plain")
+        response.call_on_close(lambda: app.closed.append("lines"))
+        return response
+
+    return app
+
+
+@pytest.mark.parametrize(
+    "sub, path",
+    [
+        ({"path": "/wrs/kk"}, "/wrs/kk"),
+        ({"path": "/wrs/kk", "args": {"since": 5}}, "/wrs/kk?since=5"),
+        (
+            {"path": "/wrs/kk?html=false", "args": {"since": 5}},
+            "/wrs/kk?html=false&since=5",
+        ),
+    ],
+)
+def test_validate_subrequest(sub, path):
+    assert validate_subrequest(sub) == path
+
+
+@pytest.mark.parametrize(
+    "sub",
+    [
+        "/wrs/kk",
+        {"args": {}},
+        {"path": "wrs/kk"},
+        {"path": "/batch"},
+        {"path": "/stream/wrs"},
+        {"path": "/export/kk/8/pbs"},
+        {"path": "/wrs/kk", "args": ["since", 5]},
+    ],
+)
+def test_invalid_subrequests(sub):
+    with pytest.raises(ValueError):
+        validate_subrequest(sub)
+
+
+def test_run_batch_keeps_order_and_forwards_headers(app):
+    headers = {"X-ApiKey": "key", "Accept-Encoding": "gzip"}
+    results = run_batch(app, ["/wrs/kk?since=3", "/text", "/wrs/kr"], headers, 2)
+    assert [r["path"] for r in results] == ["/wrs/kk?since=3", "/text", "/wrs/kr"]
+    assert results[0]["body"] == {"event": "kk", "args": {"since": "3"}, "key": "key"}
+    assert results[0]["etag"] == '"v1"'
+    assert results[1] == {"path": "/text", "status": 200, "body": "plain"}
+    assert results[2]["body"]["event"] == "kr"
+
+
+def test_run_batch_reports_errors_per_request(app):
+    results = run_batch(app, ["/boom", "/missing", "/text"], {}, 3)
+    assert [r["status"] for r in results] == [500, 404, 200]
+
+
+def test_streamed_responses_are_closed_not_batched(app):
+    (result,) = run_batch(app, ["/lines"], {}, 1)
+    assert result["status"] == 400
+    # closing ran the hooks that release e.g. export slots
+    assert app.closed == ["lines"]
@@ -0,0 +1,126 @@
+import pytest
+
+from kacky_records_api.record_aggregators import circuit_breaker
+from kacky_records_api.record_aggregators.circuit_breaker import (
+    CLOSED,
+    HALF_OPEN,
+    OPEN,
+    CircuitBreaker,
+    CircuitOpen,
+    guarded_call,
+)
+
+CONFIG = {
+    "logger_name": "kacky_records_api_tests",
+    "circuit_breakers": {"failure_threshold": 3, "cooldown": 10, "max_cooldown": 30},
+}
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(circuit_breaker.time, "monotonic", clock)
+    return clock
+
+
+@pytest.fixture(autouse=True)
+def fresh_registry(monkeypatch):
+    monkeypatch.setattr(CircuitBreaker, "_breakers", {})
+
+
+def fail():
+    raise ConnectionError("source down")
+
+
+def trip(breaker):
+    for _ in range(3):
+        with pytest.raises(ConnectionError):
+            breaker.call(fail)
+
+
+def test_opens_after_consecutive_failures(clock):
+    breaker = CircuitBreaker("tmx", failure_threshold=3, cooldown=10)
+    with pytest.raises(ConnectionError):
+        breaker.call(fail)
+    # a success in between resets the count
+    assert breaker.call(lambda: "ok") == "ok"
+    trip(breaker)
+    assert breaker.state == OPEN
+    with pytest.raises(CircuitOpen):
+        breaker.call(lambda: "not called")
+
+
+def test_single_probe_after_cooldown(clock):
+    breaker = CircuitBreaker("tmx", failure_threshold=3, cooldown=10)
+    trip(breaker)
+    clock.now += 9
+    assert not breaker.allow()
+    clock.now += 1
+    assert breaker.allow()
+    assert breaker.state == HALF_OPEN
+    # only one probe at a time
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CLOSED
+    assert breaker.failures == 0
+
+
+def test_failed_probes_back_off_up_to_max_cooldown(clock):
+    breaker = CircuitBreaker("tmx", failure_threshold=3, cooldown=10, max_cooldown=30)
+    trip(breaker)
+    for expected in (20, 30, 30):
+        clock.now += breaker.cooldown
+        with pytest.raises(ConnectionError):
+            breaker.call(fail)
+        assert breaker.state == OPEN
+        assert breaker.cooldown == expected
+    clock.now += breaker.cooldown
+    breaker.call(lambda: None)
+    # recovered, the next outage starts with the base cool-down again
+    assert breaker.cooldown == 10
+
+
+def test_released_probe_can_be_retried(clock):
+    breaker = CircuitBreaker("tmx", failure_threshold=3, cooldown=10)
+    trip(breaker)
+    clock.now += 10
+    assert breaker.allow()
+    breaker.release_probe()
+    assert breaker.allow()
+
+
+def test_breakers_are_shared_by_name():
+    breaker = CircuitBreaker.get("nadeo", CONFIG)
+    assert CircuitBreaker.get("nadeo") is breaker
+    assert CircuitBreaker.get("nadeo:live") is not breaker
+    assert set(CircuitBreaker.all()) == {"nadeo", "nadeo:live"}
+
+
+def test_guarded_call_counts_for_source_and_endpoint(clock):
+    for _ in range(3):
+        with pytest.raises(ConnectionError):
+            guarded_call("nadeo", "live", fail, config=CONFIG)
+    assert CircuitBreaker.get("nadeo").state == OPEN
+    assert CircuitBreaker.get("nadeo:live").state == OPEN
+    with pytest.raises(CircuitOpen):
+        guarded_call("nadeo", "core", lambda: None, config=CONFIG)
+
+
+def test_broken_endpoint_does_not_open_source(clock):
+    for _ in range(3):
+        with pytest.raises(ConnectionError):
+            guarded_call("nadeo", "live", fail, config=CONFIG)
+        guarded_call("nadeo", "core", lambda: None, config=CONFIG)
+    assert CircuitBreaker.get("nadeo:live").state == OPEN
+    assert CircuitBreaker.get("nadeo").state == CLOSED
+    assert guarded_call("nadeo", "core", lambda: "ok", config=CONFIG) == "ok"
+    with pytest.raises(CircuitOpen):
+        guarded_call("nadeo", "live", lambda: None, config=CONFIG)
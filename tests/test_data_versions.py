@@ -0,0 +1,57 @@
+import pytest
+
+from kacky_records_api import data_versions
+from kacky_records_api.data_versions import DataVersions, wrs_domain
+
+CONFIG = {"data_version_poll_seconds": 0}
+
+
+class FakeDB:
+    """data_versions table as a dict, answers the polling queries of DataVersions"""
+
+    def __init__(self):
+        self.table = {}
+        self.polled_after = []
+
+    def execute(self, query, args):
+        pass
+
+    def fetchall(self, query, args):
+        if "WHERE version > ?" in query:
+            self.polled_after.append(args[0])
+            return [(d, v) for d, v in self.table.items() if v > args[0]]
+        return list(self.table.items())
+
+
+class FakeCursor:
+    class connection:
+        autocommit = True
+
+
+@pytest.fixture
+def db(monkeypatch):
+    db = FakeDB()
+    monkeypatch.setattr(data_versions, "DBConnection", lambda c, s: db)
+    monkeypatch.setattr(DataVersions, "_versions", {})
+    monkeypatch.setattr(DataVersions, "_last_seen", None)
+    monkeypatch.setattr(DataVersions, "_fetched_at", 0.0)
+    monkeypatch.setattr(DataVersions, "_schema_ready", True)
+    return db
+
+
+def test_polls_versions_above_the_highest_seen(db):
+    db.table = {"global": 2, wrs_domain("kk", 8): 2, "events": 1}
+    versions = DataVersions(CONFIG, {})
+    assert versions.current(wrs_domain("KK", 8)) == 2
+    assert versions.current("unknown") == 0
+    db.table.update({"global": 3, "events": 3})
+    assert versions.current("events") == 3
+    # however late a version committed, it is above the highest one seen
+    db.table.update({"global": 4, wrs_domain("kk", 8): 4})
+    assert versions.current(wrs_domain("kk", 8)) == 4
+    assert db.polled_after == [2, 2, 3]
+
+
+def test_begin_write_needs_a_transaction(db):
+    with pytest.raises(ValueError):
+        DataVersions(CONFIG, {}).begin_write(FakeCursor())
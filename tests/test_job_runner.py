@@ -0,0 +1,60 @@
+import threading
+
+from kacky_records_api.job_runner import SingleFlightJob
+
+CONFIG = {"logger_name": "kacky_records_api_tests"}
+
+
+def test_runs_and_passes_arguments():
+    calls = []
+    job = SingleFlightJob("job", lambda *a: calls.append(a), 60, CONFIG)
+    job("config", "secrets")
+    job("config", "secrets")
+    assert calls == [("config", "secrets")] * 2
+    assert job.stats.runs == 2
+    assert job.stats.skips == 0
+
+
+def test_overlapping_ticks_coalesce_into_one_catch_up_run():
+    release = threading.Event()
+    started = threading.Event()
+    runs = []
+
+    def func():
+        runs.append(threading.current_thread().name)
+        started.set()
+        release.wait(5)
+
+    job = SingleFlightJob("job", func, 60, CONFIG)
+    first = threading.Thread(target=job, name="first")
+    first.start()
+    assert started.wait(5)
+    # three ticks while the first run is active, none of them runs itself
+    for _ in range(3):
+        job()
+    release.set()
+    first.join(5)
+    # the catch-up run happens in the thread of the active run
+    assert runs == ["first", "first"]
+    assert job.stats.runs == 2
+    assert job.stats.skips == 3
+    assert job.stats.catch_up_runs == 1
+
+
+def test_failures_are_counted_and_do_not_block():
+    def fail():
+        raise RuntimeError("database gone")
+
+    job = SingleFlightJob("job", fail, 60, CONFIG)
+    job()
+    job()
+    assert job.stats.runs == 2
+    assert job.stats.failures == 2
+    assert job.stats.last_error == "database gone"
+
+
+def test_overruns_are_counted():
+    job = SingleFlightJob("job", lambda: None, -1, CONFIG)
+    job()
+    assert job.stats.overruns == 1
+    assert job.stats.max_duration >= job.stats.last_duration >= 0
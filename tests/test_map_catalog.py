@@ -0,0 +1,46 @@
+import pytest
+
+from kacky_records_api.map_catalog import (
+    CatalogEntry,
+    build_catalog_entry,
+    kacky_id_from_name,
+    parse_map_name,
+)
+
+
+@pytest.mark.parametrize(
+    "name, expected",
+    [
+        ("Kacky Reloaded #201", ("201", "")),
+        ("$f00Kacky $oReloaded $fff#201 [v2]", ("201", "v2")),
+        ("Kackiest Kacky # 75 [1.1]", ("75", "1.1")),
+        ("Kacky Reloaded #2–1", ("2-1", "")),
+        ("Kackiest Kacky Lobby", ("", "")),
+        ("", ("", "")),
+    ],
+)
+def test_parse_map_name(name, expected):
+    assert parse_map_name(name) == expected
+
+
+def test_kacky_id_from_name():
+    assert kacky_id_from_name("Kackiest Kacky #123") == "123"
+    assert kacky_id_from_name("Kacky Reloaded #2–1") == "2-1"
+
+
+def test_build_catalog_entry():
+    assert build_catalog_entry("KR", "uid", 7, "Kacky Reloaded #201 [v2]", 4) == (
+        CatalogEntry("KR", "uid", 7, "Kacky Reloaded #201 [v2]", "201", "v2", 4, False)
+    )
+
+
+def test_build_catalog_entry_lobby():
+    entry = build_catalog_entry("KK", "uid", 1, "Welcome", None, "Lobby.Map.Gbx")
+    assert entry.is_lobby
+    assert entry.kacky_id == ""
+
+
+def test_build_catalog_entry_skips_unindexable():
+    # deleted maps have no name, names without kacky id would all share ""
+    assert build_catalog_entry("KK", "uid", 1, "", 8) is None
+    assert build_catalog_entry("KK", "uid", 1, "Some Map", 8, "some.Map.Gbx") is None
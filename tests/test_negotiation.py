@@ -0,0 +1,93 @@
+import gzip
+import json
+import zlib
+
+import flask
+import pytest
+
+from kacky_records_api import negotiation
+from kacky_records_api.negotiation import (
+    COLUMNAR_JSON,
+    JSON,
+    MSGPACK,
+    Variant,
+    columnar,
+    encode,
+    preferred_variant,
+)
+
+CONFIG = {"compression": {"gzip_level": 6, "zstd_level": 3}}
+BODY = json.dumps([{"kid": "1", "score": 100}, {"kid": "2", "score": 200}]).encode()
+
+
+def request(accept=None, accept_encoding=None):
+    headers = {}
+    if accept:
+        headers["Accept"] = accept
+    if accept_encoding:
+        headers["Accept-Encoding"] = accept_encoding
+    return flask.Request.from_values(headers=headers)
+
+
+def test_variant_names_and_etags():
+    assert Variant(JSON, None).is_identity
+    assert Variant(JSON, None).etag("v5") == "v5"
+    assert not Variant(JSON, "gzip").is_identity
+    assert Variant(JSON, "gzip").etag("v5") == "v5.json.gzip"
+    assert Variant(MSGPACK, None).etag("v5") == "v5.msgpack.identity"
+
+
+def test_plain_request_gets_identity():
+    assert preferred_variant(request()) == Variant(JSON, None)
+    assert preferred_variant(request("*/*")) == Variant(JSON, None)
+
+
+def test_preferred_representation_and_encoding():
+    assert preferred_variant(request(COLUMNAR_JSON, "gzip")) == Variant(
+        COLUMNAR_JSON, "gzip"
+    )
+    assert preferred_variant(request(accept_encoding="gzip;q=0.5, deflate")) == (
+        Variant(JSON, "deflate")
+    )
+    # nothing acceptable offered, fall back to plain JSON
+    assert preferred_variant(request("text/html", "br")) == Variant(JSON, None)
+
+
+def test_optional_variants_are_not_offered_without_packages(monkeypatch):
+    monkeypatch.setattr(negotiation, "msgpack", None)
+    monkeypatch.setattr(negotiation, "zstandard", None)
+    assert preferred_variant(request(MSGPACK, "zstd")) == Variant(JSON, None)
+
+
+def test_columnar():
+    assert columnar([{"a": 1, "b": 2}, {"a": 3, "b": 4}]) == {
+        "columns": ["a", "b"],
+        "rows": [[1, 2], [3, 4]],
+    }
+    page = {"entries": [{"a": 1}], "next": None}
+    assert columnar(page) == {
+        "entries": {"columns": ["a"], "rows": [[1]]},
+        "next": None,
+    }
+    # anything not a list of objects with the same keys stays as it is
+    for data in ([], [{"a": 1}, {"b": 2}], [1, 2], {"a": 1}):
+        assert columnar(data) == data
+
+
+def test_encode_compressions():
+    assert encode(BODY, Variant(JSON, None), CONFIG) == BODY
+    assert gzip.decompress(encode(BODY, Variant(JSON, "gzip"), CONFIG)) == BODY
+    assert zlib.decompress(encode(BODY, Variant(JSON, "deflate"), CONFIG)) == BODY
+
+
+def test_encode_columnar():
+    encoded = encode(BODY, Variant(COLUMNAR_JSON, None), CONFIG)
+    assert json.loads(encoded) == columnar(json.loads(BODY))
+
+
+def test_encode_msgpack_zstd():
+    msgpack = pytest.importorskip("msgpack")
+    zstandard = pytest.importorskip("zstandard")
+    encoded = encode(BODY, Variant(MSGPACK, "zstd"), CONFIG)
+    unpacked = zstandard.ZstdDecompressor().decompress(encoded)
+    assert msgpack.unpackb(unpacked) == json.loads(BODY)
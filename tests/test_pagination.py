@@ -0,0 +1,62 @@
+import base64
+import datetime
+import decimal
+
+import pytest
+
+from kacky_records_api.pagination import decode_cursor, encode_cursor
+from kacky_records_api.record_aggregators.kackiest_kacky_db import _board_ranks
+
+
+def test_cursor_round_trip():
+    key = [
+        12,
+        decimal.Decimal("3.1415"),
+        datetime.datetime(2023, 7, 1, 12, 30, 15, 250000),
+        "login",
+    ]
+    cursor = encode_cursor(key)
+    assert "=" not in cursor
+    decoded = decode_cursor(cursor, 4)
+    assert decoded == key
+    # exact types, the next page compares against them in SQL
+    assert isinstance(decoded[1], decimal.Decimal)
+    assert isinstance(decoded[2], datetime.datetime)
+
+
+def test_empty_cursor_is_first_page():
+    assert decode_cursor(None, 3) is None
+    assert decode_cursor("", 3) is None
+
+
+@pytest.mark.parametrize(
+    "cursor",
+    [
+        "not base64 at all!",
+        base64.urlsafe_b64encode(b"{not json").decode(),
+        base64.urlsafe_b64encode(b'{"a": 1}').decode(),
+        base64.urlsafe_b64encode(b'[{"unknown": 1}]').decode(),
+    ],
+)
+def test_malformed_cursor(cursor):
+    with pytest.raises(ValueError):
+        decode_cursor(cursor, 1)
+
+
+def test_cursor_length_is_checked():
+    with pytest.raises(ValueError):
+        decode_cursor(encode_cursor([1, 2]), 3)
+
+
+def test_board_ranks_share_ties_across_pages():
+    # (fins, login, nick, player id, avg) like the leaderboard rows
+    board = [
+        (75, "a", "a", 1, 1.5),
+        (75, "b", "b", 2, 2.0),
+        (75, "c", "c", 3, 2.0),
+        (70, "d", "d", 4, 2.0),
+    ]
+    assert [r for r, _ in _board_ranks(board)] == [1, 2, 2, 4]
+    # second page after "b", continuing position 2 and rank 2
+    ranks = _board_ranks(board[2:], 2, (75, 2.0), 2)
+    assert [r for r, _ in ranks] == [2, 4]
@@ -0,0 +1,67 @@
+import pytest
+
+from kacky_records_api import response_cache
+from kacky_records_api.response_cache import ResponseCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(response_cache.time, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return ResponseCache(str(tmp_path / "cache.sqlite"), 1024 * 1024)
+
+
+def test_set_and_get(cache, clock):
+    cache.set("/wrs/kk/8?", 5, b'{"a":1}', 200, "application/json", 60)
+    hit = cache.get("/wrs/kk/8?")
+    assert hit.version == 5
+    assert hit.body == b'{"a":1}'
+    assert hit.status == 200
+    assert hit.mimetype == "application/json"
+    assert hit.fresh_until == clock.now + 60
+    assert cache.get("/wrs/kk/9?") is None
+
+
+def test_stale_entries_are_kept_until_max_stale(cache, clock):
+    cache.set("key", None, b"body", 200, "application/json", 10, max_stale=100)
+    clock.now += 50
+    hit = cache.get("key")
+    assert hit is not None
+    assert hit.fresh_until < clock.now
+    assert hit.age == 50
+    clock.now += 51
+    assert cache.get("key") is None
+
+
+def test_overwrite_replaces_entry(cache, clock):
+    cache.set("key", 1, b"old", 200, "application/json", 10)
+    cache.set("key", 2, b"new", 200, "application/json", 10)
+    hit = cache.get("key")
+    assert (hit.version, hit.body) == (2, b"new")
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path, clock):
+    # room for 20 entries of 101 bytes, evicted 16 at a time
+    cache = ResponseCache(str(tmp_path / "cache.sqlite"), 20 * 101)
+    for i in range(20):
+        cache.set(f"k{i:02d}", None, b"x" * 98, 200, "application/json", 600)
+        clock.now += 10
+    # k00 becomes the most recently used one
+    assert cache.get("k00") is not None
+    clock.now += 10
+    cache.set("k20", None, b"x" * 98, 200, "application/json", 600)
+    kept = [k for k in (f"k{i:02d}" for i in range(21)) if cache.get(k) is not None]
+    assert kept == ["k00", "k17", "k18", "k19", "k20"]
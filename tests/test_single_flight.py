@@ -0,0 +1,167 @@
+import threading
+import time
+
+import pytest
+
+from kacky_records_api.single_flight import (
+    CoalescingTimeout,
+    SingleFlight,
+    SingleFlightError,
+    TooManyWaiters,
+)
+
+
+def start_leader(sf, key, release, result="result"):
+    """Starts a computation of `key` that blocks until `release` is set."""
+    started = threading.Event()
+    results = []
+
+    def compute():
+        started.set()
+        release.wait(5)
+        return result
+
+    thread = threading.Thread(target=lambda: results.append(sf.do(key, compute)))
+    thread.start()
+    assert started.wait(5)
+    return thread, results
+
+
+def wait_for_waiters(sf, key, count):
+    # waiters register under the lock before blocking
+    for _ in range(500):
+        with sf._lock:
+            if sf._calls[key].waiters >= count:
+                return
+        time.sleep(0.01)
+    raise AssertionError("waiters did not arrive")
+
+
+def test_concurrent_calls_share_one_computation():
+    sf = SingleFlight()
+    release = threading.Event()
+    leader, leader_results = start_leader(sf, "key", release)
+    computations = []
+    results = []
+
+    def follower():
+        results.append(sf.do("key", lambda: computations.append(1)))
+
+    followers = [threading.Thread(target=follower) for _ in range(5)]
+    for t in followers:
+        t.start()
+    wait_for_waiters(sf, "key", 5)
+    release.set()
+    for t in followers + [leader]:
+        t.join(5)
+    assert computations == []
+    assert results == ["result"] * 5
+    assert leader_results == ["result"]
+    assert not sf.in_flight("key")
+
+
+def test_errors_are_shared_and_not_cached():
+    sf = SingleFlight()
+    release = threading.Event()
+    errors = []
+
+    def fail():
+        release.wait(5)
+        raise ValueError("upstream down")
+
+    def call():
+        try:
+            sf.do("key", fail)
+        except ValueError as e:
+            errors.append(e)
+
+    leader = threading.Thread(target=call)
+    leader.start()
+    for _ in range(500):
+        if sf.in_flight("key"):
+            break
+        time.sleep(0.01)
+    follower = threading.Thread(target=call)
+    follower.start()
+    wait_for_waiters(sf, "key", 1)
+    release.set()
+    leader.join(5)
+    follower.join(5)
+    assert len(errors) == 2
+    assert errors[0] is errors[1]
+    # the next call computes again
+    assert sf.do("key", lambda: "recovered") == "recovered"
+
+
+def test_aborted_computation_fails_waiters():
+    sf = SingleFlight()
+    release = threading.Event()
+    errors = []
+
+    def leave():
+        release.wait(5)
+        raise SystemExit(1)
+
+    def lead():
+        try:
+            sf.do("key", leave)
+        except SystemExit as e:
+            errors.append(e)
+
+    def follow():
+        try:
+            sf.do("key", lambda: "not called")
+        except SingleFlightError as e:
+            errors.append(e)
+
+    leader = threading.Thread(target=lead)
+    leader.start()
+    for _ in range(500):
+        if sf.in_flight("key"):
+            break
+        time.sleep(0.01)
+    follower = threading.Thread(target=follow)
+    follower.start()
+    wait_for_waiters(sf, "key", 1)
+    release.set()
+    leader.join(5)
+    follower.join(5)
+    assert sorted(type(e).__name__ for e in errors) == [
+        "SingleFlightError",
+        "SystemExit",
+    ]
+
+
+def test_different_keys_do_not_wait():
+    sf = SingleFlight()
+    release = threading.Event()
+    leader, _ = start_leader(sf, "a", release)
+    assert sf.do("b", lambda: "b") == "b"
+    release.set()
+    leader.join(5)
+
+
+def test_too_many_waiters():
+    sf = SingleFlight(max_waiters=1)
+    release = threading.Event()
+    leader, _ = start_leader(sf, "key", release)
+    follower = threading.Thread(target=lambda: sf.do("key", lambda: None))
+    follower.start()
+    wait_for_waiters(sf, "key", 1)
+    with pytest.raises(TooManyWaiters):
+        sf.do("key", lambda: None)
+    release.set()
+    leader.join(5)
+    follower.join(5)
+
+
+def test_waiting_times_out():
+    sf = SingleFlight(timeout=0.05)
+    release = threading.Event()
+    leader, results = start_leader(sf, "key", release)
+    with pytest.raises(CoalescingTimeout):
+        sf.do("key", lambda: None)
+    # the computation itself goes on
+    release.set()
+    leader.join(5)
+    assert results == ["result"]
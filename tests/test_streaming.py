@@ -0,0 +1,51 @@
+from kacky_records_api.record_aggregators.streaming import stream_query
+
+
+class FakeCursor:
+    description = [("login",), ("score",)]
+
+    def __init__(self, rows):
+        self.rows = list(rows)
+        self.fetched = 0
+        self.closed = False
+
+    def execute(self, query, args):
+        pass
+
+    def fetchmany(self, size):
+        chunk = self.rows[self.fetched : self.fetched + size]
+        self.fetched += len(chunk)
+        return chunk
+
+    def close(self):
+        self.closed = True
+
+
+class FakeConnection:
+    def __init__(self, rows):
+        self.cursors = []
+        self.rows = rows
+
+    def cursor(self, buffered=True):
+        assert not buffered
+        self.cursors.append(FakeCursor(self.rows))
+        return self.cursors[-1]
+
+
+def test_rows_are_fetched_in_chunks():
+    connection = FakeConnection([("a", 1), ("b", 2), ("c", 3)])
+    columns, rows = stream_query(connection, "SELECT", (), chunk_size=2)
+    assert columns == ["login", "score"]
+    assert next(rows) == ("a", 1)
+    assert connection.cursors[0].fetched == 2
+    assert list(rows) == [("b", 2), ("c", 3)]
+    # exhausted rows release the cursor
+    assert connection.cursors[0].closed
+
+
+def test_close_before_the_first_row():
+    connection = FakeConnection([("a", 1)])
+    _, rows = stream_query(connection, "SELECT", ())
+    rows.close()
+    assert connection.cursors[0].closed
+    assert list(rows) == []